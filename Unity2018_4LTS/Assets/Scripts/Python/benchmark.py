@@ -0,0 +1,265 @@
+"""Benchmarks of reading and writing NRRD files with pynrrd
+
+Writes synthetic float32 volumes, from a small 3D volume up to multi-GB 4D tensor fields, with every combination of
+encoding, index order and attached or detached header, and times :func:`pynrrd.write`, :func:`pynrrd.read_header`,
+:func:`pynrrd.read_data` and :func:`pynrrd.read` on them. Each run is done in a fresh process, so its peak resident
+memory is its own. Reads run right after the file is written, so the file is usually in the page cache.
+
+The results are saved as JSON, with the wall time in seconds, the throughput in MB/s of the uncompressed data and the
+peak RSS in MB of each run. Given a baseline saved by an earlier run, runs that are slower than the baseline by more
+than a threshold, and by more than a few milliseconds, are reported as regressions, and the exit code is 1 if there
+are any. Each run is repeated 3 times by default and the fastest time is compared.
+
+    python benchmark.py --sizes small medium --output results.json
+    python benchmark.py --sizes small medium --baseline results.json --threshold 0.1
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import pynrrd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Sizes of the synthetic volumes in the order of the NRRD file, x first
+SIZES = {
+    'small': (64, 64, 64),
+    'medium': (9, 128, 128, 96),
+    'large': (9, 256, 256, 192),
+    'huge': (9, 512, 512, 384),
+}
+
+ENCODINGS = ['raw', 'gzip', 'bzip2', 'ascii']
+
+OPERATIONS = ['write', 'read_header', 'read_data', 'read']
+
+# Volumes larger than this many MB are not benchmarked with the ascii encoding unless requested
+_ASCII_LIMIT_MB = 64
+
+# Number of times read_header is timed in a run, since a single read is too short to time
+_HEADER_REPEAT = 100
+
+# Runs that are slower than the baseline by less than this many seconds are not regressions, whatever the fraction,
+# since timings of a few milliseconds are mostly noise
+_NOISE_FLOOR = 0.005
+
+
+def _peak_rss_mb():
+    """Peak resident memory of this process in MB, or :obj:`None` if it can't be measured"""
+
+    if resource is None:
+        return None
+
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def synthetic_volume(sizes, index_order='F'):
+    """Smooth float32 volume with noise, with the shape :obj:`sizes` for index order F or reversed for C
+
+    The volume is filled one slab of the slowest axis at a time, so no temporaries of its full size are made.
+    """
+
+    shape = tuple(reversed(sizes))
+    data = np.empty(shape, dtype=np.float32)
+    rng = np.random.RandomState(0)
+    grid = np.meshgrid(*[np.linspace(0, 4 * np.pi, size, dtype=np.float32) for size in shape[1:]], indexing='ij')
+    pattern = sum(np.sin(axis) for axis in grid)
+    for index in range(shape[0]):
+        data[index] = pattern * np.float32(np.cos(index * 0.1)) + rng.standard_normal(pattern.shape) * 0.01
+
+    return data if index_order == 'C' else data.T
+
+
+def _filename(directory, size, encoding, detached):
+    return os.path.join(directory, '%s_%s.%s' % (size, encoding, 'nhdr' if detached else 'nrrd'))
+
+
+def _run(operation, filename, size, encoding, index_order, detached, threads):
+    """Time one operation, in a process of its own. Returns the seconds it took and the peak RSS"""
+
+    if operation == 'write':
+        data = synthetic_volume(SIZES[size], index_order)
+        start = time.perf_counter()
+        pynrrd.write(filename, data, {'encoding': encoding}, detached_header=detached, index_order=index_order,
+                     threads=threads)
+        seconds = time.perf_counter() - start
+    elif operation == 'read_header':
+        start = time.perf_counter()
+        for _ in range(_HEADER_REPEAT):
+            pynrrd.read_header(filename)
+        seconds = (time.perf_counter() - start) / _HEADER_REPEAT
+    elif operation == 'read_data':
+        with open(filename, 'rb') as fh:
+            header = pynrrd.read_header(fh)
+            start = time.perf_counter()
+            pynrrd.read_data(header, fh, filename, index_order=index_order, threads=threads)
+            seconds = time.perf_counter() - start
+    else:
+        start = time.perf_counter()
+        pynrrd.read(filename, index_order=index_order, threads=threads)
+        seconds = time.perf_counter() - start
+
+    return seconds, _peak_rss_mb()
+
+
+def _key(result):
+    return tuple(result[field] for field in ['size', 'encoding', 'index_order', 'header', 'operation', 'threads'])
+
+
+def run_benchmarks(sizes, encodings=ENCODINGS, index_orders=('F', 'C'), headers=('attached', 'detached'),
+                   operations=OPERATIONS, threads=1, repeat=3, directory=None, ascii_limit=_ASCII_LIMIT_MB):
+    """Run the benchmarks and return their results
+
+    Parameters
+    ----------
+    sizes : :class:`list` (:class:`str`)
+        Names of the volume sizes in :obj:`SIZES`
+    encodings, index_orders, headers, operations : :class:`list` (:class:`str`), optional
+        Encodings, index orders, 'attached' and/or 'detached' headers and operations to benchmark
+    threads : :class:`int`, optional
+        Number of threads passed to :func:`pynrrd.read`, :func:`pynrrd.read_data` and :func:`pynrrd.write`
+    repeat : :class:`int`, optional
+        Number of times each run is repeated, the fastest is kept
+    directory : :class:`str`, optional
+        Directory to write the volumes to, defaults to a temporary directory. The volumes are removed afterwards
+    ascii_limit : :class:`float`, optional
+        Volumes larger than this many MB are skipped for the ascii encoding
+
+    Returns
+    -------
+    results : :class:`list` (:class:`dict`)
+        One result per run, with the 'size', 'encoding', 'index_order', 'header', 'operation' and 'threads' of the run,
+        the 'mb' of data, the fastest 'seconds', its 'mb_per_s' (:obj:`None` for read_header) and the largest
+        'peak_rss_mb'
+    """
+
+    directory = tempfile.mkdtemp(dir=directory)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        for size, encoding, header in itertools.product(sizes, encodings, headers):
+            detached = header == 'detached'
+            mb = np.prod(SIZES[size]) * 4 / 2 ** 20
+            if encoding == 'ascii' and mb > ascii_limit:
+                continue
+
+            filename = _filename(directory, size, encoding, detached)
+            for index_order, operation in itertools.product(index_orders, OPERATIONS):
+                # The file is always written before it is read, but the write is only reported if requested
+                if operation not in operations and operation != 'write':
+                    continue
+
+                runs = []
+                for _ in range(repeat):
+                    with ProcessPoolExecutor(1, mp_context=context) as executor:
+                        runs.append(executor.submit(_run, operation, filename, size, encoding, index_order, detached,
+                                                    threads).result())
+                if operation not in operations:
+                    continue
+
+                seconds = min(seconds for seconds, _ in runs)
+                peaks = [peak for _, peak in runs if peak is not None]
+                result = {'size': size, 'encoding': encoding, 'index_order': index_order,
+                          'header': 'detached' if detached else 'attached', 'operation': operation, 'threads': threads,
+                          'mb': mb, 'seconds': seconds,
+                          'mb_per_s': mb / seconds if seconds > 0 and operation != 'read_header' else None,
+                          'peak_rss_mb': max(peaks) if peaks else None}
+                results.append(result)
+                print('%-6s %-5s %s %-8s %-11s %10.4f s %10s MB/s %8s MB peak' % (
+                    size, encoding, index_order, result['header'], operation, seconds,
+                    '-' if result['mb_per_s'] is None else '%.1f' % result['mb_per_s'],
+                    '-' if result['peak_rss_mb'] is None else '%.0f' % result['peak_rss_mb']))
+                sys.stdout.flush()
+
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline, threshold=0.1, noise_floor=_NOISE_FLOOR):
+    """Compare results to the results of a baseline
+
+    Returns
+    -------
+    regressions : :class:`list` (:class:`tuple`)
+        The result and the baseline result of each run that took more than 1 + :obj:`threshold` times as long as in
+        the baseline and more than :obj:`noise_floor` seconds longer
+    """
+
+    baseline = dict((_key(result), result) for result in baseline)
+    regressions = []
+    for result in results:
+        reference = baseline.get(_key(result))
+        if reference is not None and result['seconds'] > reference['seconds'] * (1 + threshold) and \
+                result['seconds'] - reference['seconds'] > noise_floor:
+            regressions.append((result, reference))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reading and writing NRRD files with pynrrd')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium'],
+                        help='volume sizes to benchmark (default: small medium)')
+    parser.add_argument('--encodings', nargs='+', choices=ENCODINGS, default=ENCODINGS, help='encodings to benchmark')
+    parser.add_argument('--index-orders', nargs='+', choices=('F', 'C'), default=['F', 'C'],
+                        help='index orders to benchmark')
+    parser.add_argument('--headers', nargs='+', choices=('attached', 'detached'), default=['attached', 'detached'],
+                        help='attached and/or detached headers')
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS,
+                        help='operations to benchmark')
+    parser.add_argument('--threads', type=int, default=1, help='threads used by read and write (default: 1)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='repetitions of each run, the fastest is kept (default: 3)')
+    parser.add_argument('--directory', help='directory to write the volumes to, defaults to the temporary directory')
+    parser.add_argument('--ascii-limit', type=float, default=_ASCII_LIMIT_MB,
+                        help='skip ascii for volumes larger than this many MB (default: %d)' % _ASCII_LIMIT_MB)
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to save the results to')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare the results to')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction a run may be slower than the baseline before it is a regression (default: 0.1)')
+    parser.add_argument('--noise-floor', type=float, default=_NOISE_FLOOR,
+                        help='seconds a run may be slower than the baseline before it is a regression, whatever the '
+                             'fraction (default: %g)' % _NOISE_FLOOR)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.encodings, args.index_orders, args.headers, args.operations,
+                             args.threads, args.repeat, args.directory, args.ascii_limit)
+    with open(args.output, 'w') as fh:
+        json.dump({'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                   'results': results}, fh, indent=1)
+    print('saved to ', args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)['results']
+        regressions = compare(results, baseline, args.threshold, args.noise_floor)
+        for result, reference in regressions:
+            print('regression: %s %s %s %s %s took %.4f s, baseline %.4f s (%+.0f%%)' % (
+                result['size'], result['encoding'], result['index_order'], result['header'], result['operation'],
+                result['seconds'], reference['seconds'], 100 * (result['seconds'] / reference['seconds'] - 1)))
+        print('%d regressions against %s' % (len(regressions), args.baseline))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
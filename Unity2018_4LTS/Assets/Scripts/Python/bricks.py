@@ -0,0 +1,279 @@
+"""Tiled storage of NRRD volumes in independently compressed bricks
+
+A brick file holds a volume split along its three spatial axes into bricks of e.g. 32x32x32 voxels with all their
+components. Each brick is compressed on its own, so a region of the volume is read by decompressing only the bricks it
+touches, and the bricks are compressed and decompressed in parallel by a thread pool.
+
+The file starts with the magic bytes, the length of the JSON header as a little endian uint32 and the JSON header, with
+the 'dtype' and 'shape' of the volume in C order (the spatial axes first, like pynrrd.read with index_order='C'), the
+'brick' shape, the 'codec' of the bricks and the NRRD 'header' of the source file as text. Then comes the index of the
+bricks, a little endian uint64 offset and size of each brick in C order, followed by the bricks. A brick holds its
+voxels in C order and little endian; bricks at the end of an axis are cut off at the end of the volume.
+
+    python bricks.py DTIBrain.nrrd DTIBrain.nbrk --brick 32 --codec zlib
+"""
+import argparse
+import bz2
+import json
+import lzma
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pynrrd import NrrdVolume, read_header
+
+_BRICK_MAGIC = b'NRRDBRK1'
+_BRICK_HEADER_SIZE = struct.Struct('<I')
+_BRICK_INDEX_ENTRY = struct.Struct('<QQ')
+
+# Compress and decompress functions of the codecs by name, the compress functions take the compression level
+_CODECS = {
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    'bz2': (lambda data, level: bz2.compress(data, max(level, 1)), bz2.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+    'none': (lambda data, level: bytes(data), bytes),
+}
+
+
+def _brick_ranges(shape, brick):
+    """Ranges of the bricks along each axis of a volume of :obj:`shape` split into bricks of :obj:`brick`"""
+
+    return [[(start, min(start + size, axis_size)) for start in range(0, axis_size, size)]
+            for axis_size, size in zip(shape, brick)]
+
+
+def convert(filename, output, brick=(32, 32, 32), codec='zlib', level=6, threads=None):
+    """Convert the NRRD file :obj:`filename` to the brick file :obj:`output`
+
+    The NRRD file is read one slab of bricks at a time with :class:`pynrrd.NrrdVolume`, so the whole volume is never in
+    memory. The spatial axes are the last three axes of the NRRD file (the first three in C order), any other axes are
+    kept whole in each brick.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Filename of the NRRD file
+    output : :class:`str`
+        Filename of the brick file to write
+    brick : :class:`tuple` of :class:`int`, optional
+        Shape of the bricks along the spatial axes in C order
+    codec : {'zlib', 'bz2', 'lzma', 'none'}, optional
+        Compression of the bricks
+    level : :class:`int`, optional
+        Compression level of the codec
+    threads : :class:`int`, optional
+        Number of threads compressing bricks, defaults to the number of CPUs
+    """
+
+    if codec not in _CODECS:
+        raise ValueError('Unknown codec %r' % codec)
+    compress = _CODECS[codec][0]
+
+    volume = NrrdVolume(filename, index_order='C')
+    if volume.ndim < 3:
+        raise ValueError('Expected a volume with at least 3 axes, got %d' % volume.ndim)
+
+    with open(filename, 'rb') as fh:
+        header_lines = []
+        for line in fh:
+            if not line.strip():
+                break
+            header_lines.append(line.decode('ascii', 'ignore').rstrip())
+
+    brick = tuple(int(size) for size in brick)
+    ranges = _brick_ranges(volume.shape[:3], brick)
+    brick_count = len(ranges[0]) * len(ranges[1]) * len(ranges[2])
+    header = json.dumps({'dtype': volume.dtype.newbyteorder('<').str, 'shape': list(volume.shape),
+                         'brick': list(brick), 'codec': codec, 'header': '\n'.join(header_lines)}).encode('utf-8')
+
+    def compress_brick(data):
+        return compress(np.ascontiguousarray(data, dtype=volume.dtype.newbyteorder('<')).data, level)
+
+    with open(output, 'wb') as fh, ThreadPoolExecutor(threads or os.cpu_count() or 1) as executor:
+        fh.write(_BRICK_MAGIC + _BRICK_HEADER_SIZE.pack(len(header)) + header)
+        index_offset = fh.tell()
+        fh.write(b'\0' * (_BRICK_INDEX_ENTRY.size * brick_count))
+
+        index = []
+        for z_start, z_stop in ranges[0]:
+            slab = volume[z_start:z_stop]
+            bricks = (slab[:, y_start:y_stop, x_start:x_stop] for y_start, y_stop in ranges[1]
+                      for x_start, x_stop in ranges[2])
+            for compressed in executor.map(compress_brick, bricks):
+                index.append(_BRICK_INDEX_ENTRY.pack(fh.tell(), len(compressed)))
+                fh.write(compressed)
+
+        fh.seek(index_offset)
+        fh.write(b''.join(index))
+
+
+class BrickVolume(object):
+    """Brick file whose bricks are read on demand
+
+    Indexing the volume with integers and slices, e.g. ``volume[30:40, 60:90, 60:90]``, decompresses only the bricks
+    the region touches, in parallel, and returns it as a new :class:`numpy.ndarray`.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Filename of the brick file
+    index_order : {'C', 'F'}, optional
+        Index order used for indexing the volume. With 'C' the spatial axes come first, z first, like in the brick
+        file, with 'F' the order of the axes is reversed like in the NRRD file. Defaults to 'C'
+    threads : :class:`int`, optional
+        Number of threads decompressing bricks, defaults to the number of CPUs
+
+    Attributes
+    ----------
+    header : :class:`dict` (:class:`str`, :obj:`Object`)
+        Header of the NRRD file the brick file was converted from
+    shape : :class:`tuple` of :class:`int`
+        Shape of the volume in the requested index order
+    dtype : :class:`numpy.dtype`
+        Datatype of the volume
+    """
+
+    def __init__(self, filename, index_order='C', threads=None):
+        if index_order not in ['F', 'C']:
+            raise ValueError('Invalid index order')
+
+        self.filename = filename
+        self.index_order = index_order
+        self._executor = ThreadPoolExecutor(threads or os.cpu_count() or 1)
+        self._lock = threading.Lock()
+        self._fh = open(filename, 'rb')
+
+        if self._fh.read(len(_BRICK_MAGIC)) != _BRICK_MAGIC:
+            self.close()
+            raise ValueError('Not a brick file: %s' % filename)
+
+        header_size, = _BRICK_HEADER_SIZE.unpack(self._fh.read(_BRICK_HEADER_SIZE.size))
+        info = json.loads(self._fh.read(header_size).decode('utf-8'))
+
+        self.dtype = np.dtype(info['dtype'])
+        self._shape = tuple(info['shape'])
+        self._brick = tuple(info['brick'])
+        self._decompress = _CODECS[info['codec']][1]
+        self.header = read_header(info['header'].splitlines())
+        self.shape = self._shape if index_order == 'C' else self._shape[::-1]
+
+        self._ranges = _brick_ranges(self._shape[:3], self._brick)
+        brick_count = len(self._ranges[0]) * len(self._ranges[1]) * len(self._ranges[2])
+        index = np.frombuffer(self._fh.read(_BRICK_INDEX_ENTRY.size * brick_count), dtype='<u8')
+        self._index = index.reshape(len(self._ranges[0]), len(self._ranges[1]), len(self._ranges[2]), 2)
+
+    def close(self):
+        self._executor.shutdown()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_brick(self, position):
+        """Read and decompress the brick at brick index :obj:`position`"""
+
+        offset, size = self._index[position]
+        with self._lock:
+            self._fh.seek(int(offset))
+            compressed = self._fh.read(int(size))
+
+        shape = tuple(self._ranges[axis][position[axis]][1] - self._ranges[axis][position[axis]][0]
+                      for axis in range(3)) + self._shape[3:]
+        return np.frombuffer(self._decompress(compressed), dtype=self.dtype).reshape(shape)
+
+    def read_region(self, start, stop):
+        """Read the region from :obj:`start` to :obj:`stop` of the spatial axes in C order, with all components"""
+
+        region = np.empty(tuple(b - a for a, b in zip(start, stop)) + self._shape[3:], dtype=self.dtype)
+        if region.size == 0:
+            return region
+
+        # Bricks the region touches along each axis
+        touched = [range(a // size, -(-b // size)) for a, b, size in zip(start, stop, self._brick)]
+        positions = [(z, y, x) for z in touched[0] for y in touched[1] for x in touched[2]]
+
+        for position, brick in zip(positions, self._executor.map(self._read_brick, positions)):
+            brick_start = [self._ranges[axis][position[axis]][0] for axis in range(3)]
+            source = tuple(slice(max(a - s, 0), min(b - s, brick.shape[axis]))
+                           for axis, (a, b, s) in enumerate(zip(start, stop, brick_start)))
+            target = tuple(slice(max(s - a, 0), max(s - a, 0) + (r.stop - r.start))
+                           for a, s, r in zip(start, brick_start, source))
+            region[target] = brick[source]
+
+        return region
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(item is Ellipsis for item in key):
+            index = key.index(Ellipsis)
+            key = key[:index] + (slice(None),) * (self.ndim - len(key) + 1) + key[index + 1:]
+        if len(key) > self.ndim:
+            raise IndexError('Too many indices for volume: volume is %i-dimensional, but %i were indexed'
+                             % (self.ndim, len(key)))
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if self.index_order == 'F':
+            key = key[::-1]
+
+        # Read the bounding range of each spatial axis and index the region with the key shifted to that range
+        start, stop, shifted = [], [], []
+        for item, size in zip(key[:3], self._shape[:3]):
+            if isinstance(item, slice):
+                indices = range(*item.indices(size))
+                if not indices:
+                    start.append(0)
+                    stop.append(0)
+                    shifted.append(slice(0, 0))
+                    continue
+                first, last = min(indices), max(indices)
+                start.append(first)
+                stop.append(last + 1)
+                shifted.append(slice(indices.start - first, None if indices.stop - first < 0 else
+                                     indices.stop - first, indices.step))
+            elif isinstance(item, (int, np.integer)):
+                if not -size <= item < size:
+                    raise IndexError('Index %i is out of bounds for axis with size %i' % (item, size))
+                start.append(int(item) % size)
+                stop.append(int(item) % size + 1)
+                shifted.append(0)
+            else:
+                raise IndexError('BrickVolume only supports integers, slices and ellipsis as indices')
+
+        region = self.read_region(start, stop)[tuple(shifted) + key[3:]]
+        if self.index_order == 'F':
+            region = np.ascontiguousarray(region.T) if isinstance(region, np.ndarray) else region
+
+        return region
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a NRRD file to a brick file')
+    parser.add_argument('path', help='path to the nrrd file')
+    parser.add_argument('output', help='path of the brick file to write')
+    parser.add_argument('--brick', type=int, default=32, help='size of the bricks along each axis (default: 32)')
+    parser.add_argument('--codec', choices=sorted(_CODECS), default='zlib', help='compression of the bricks')
+    parser.add_argument('--level', type=int, default=6, help='compression level (default: 6)')
+    parser.add_argument('--threads', type=int, help='number of compressing threads (default: number of CPUs)')
+    args = parser.parse_args()
+
+    convert(args.path, args.output, (args.brick,) * 3, args.codec, args.level, args.threads)
+    print('wrote ', args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""Catalog of the NRRD and npy files in a directory
+
+Lists the .nrrd, .nhdr and .npy files in a directory and its subdirectories with their header fields, sizes,
+dimensions, spacing and encoding, without reading their data. Only the header of each file is read, in small blocks up
+to the blank line that ends it, and parsed with :func:`pynrrd.read_header`.
+
+The catalog is saved as JSON, by default as .nrrdcatalog.json in the directory, with an entry per file keyed by its
+path relative to the directory. Rescanning only reads the headers of files whose modification time or size changed,
+and drops the entries of removed files.
+
+    python catalog.py .\\Assets\\Data --list
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+from pynrrd import read_header
+
+_CATALOG_NAME = '.nrrdcatalog.json'
+
+# Size of the blocks the header is read in, and the size after which a header is given up on
+_HEADER_BLOCK_SIZE = 2 ** 12
+_HEADER_SIZE_LIMIT = 2 ** 20
+
+_EXTENSIONS = ['.nrrd', '.nhdr', '.npy']
+
+# End of a NRRD header, a line that is empty after removing trailing whitespace
+_HEADER_END = re.compile(br'\n[ \t\r]*\n')
+
+
+def _read_header_block(fh):
+    """Read the NRRD header from :obj:`fh` in blocks, returns its bytes including the blank line that ends it"""
+
+    data = b''
+    while len(data) < _HEADER_SIZE_LIMIT:
+        block = fh.read(_HEADER_BLOCK_SIZE)
+        if not block:
+            # A detached header can end at the end of the file without a blank line
+            return data
+
+        # Search from the last line break read before, in case the blank line starts in the previous block
+        start = max(data.rfind(b'\n'), 0)
+        data += block
+        match = _HEADER_END.search(data, start)
+        if match is not None:
+            return data[:match.end()]
+
+    raise ValueError('Header is longer than %d bytes' % _HEADER_SIZE_LIMIT)
+
+
+def _to_json(value):
+    """Make a header value JSON serializable, NaN becoming None"""
+
+    if isinstance(value, np.ndarray):
+        return [_to_json(item) for item in value.tolist()]
+    if isinstance(value, list):
+        return [_to_json(item) for item in value]
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def scan_nrrd(filename):
+    """Catalog entry of the NRRD file :obj:`filename`, read from its header only
+
+    Returns
+    -------
+    entry : :class:`dict`
+        'header' with the header fields, 'shape' with the sizes of the axes in the order of the file (x first),
+        'spacing' with the length of the space directions of the spatial axes, 'encoding', 'data file' with the
+        absolute path of the detached data file or :obj:`None`, 'data offset' with the position after the header of an
+        attached header and 'data size' with the size of the data file after that offset, before any line skip or byte
+        skip
+    """
+
+    with open(filename, 'rb') as fh:
+        header_bytes = _read_header_block(fh)
+    header = read_header(header_bytes.splitlines(True))
+
+    data_file = header.get('datafile', header.get('data file'))
+    if data_file is not None:
+        data_file = os.path.abspath(os.path.join(os.path.dirname(filename), data_file))
+        data_offset = 0
+        data_size = os.path.getsize(data_file) if os.path.exists(data_file) else None
+    else:
+        data_offset = len(header_bytes)
+        data_size = os.path.getsize(filename) - data_offset
+
+    spacing = None
+    if 'space directions' in header:
+        directions = header['space directions']
+        spacing = [_to_json(length) for length in np.linalg.norm(directions, axis=1)]
+    elif 'spacings' in header:
+        spacing = _to_json(header['spacings'])
+
+    return {'header': dict((field, _to_json(value)) for field, value in header.items()),
+            'shape': [int(size) for size in header['sizes']], 'spacing': spacing, 'encoding': header['encoding'],
+            'data file': data_file, 'data offset': data_offset, 'data size': data_size}
+
+
+def scan_npy(filename):
+    """Catalog entry of the npy file :obj:`filename`, read from its header only
+
+    Returns
+    -------
+    entry : :class:`dict`
+        'dtype', 'shape' and 'fortran order' of the array, 'data offset' with the position of its data and 'data size'
+    """
+
+    with open(filename, 'rb') as fh:
+        version = np.lib.format.read_magic(fh)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fh)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fh)
+        data_offset = fh.tell()
+
+    return {'dtype': dtype.str, 'shape': list(shape), 'fortran order': fortran_order, 'encoding': 'raw',
+            'data offset': data_offset, 'data size': os.path.getsize(filename) - data_offset}
+
+
+def _data_file_unchanged(entry):
+    """Whether the detached data file of a catalog entry still has the size in the entry"""
+
+    data_file = entry.get('data file')
+    if data_file is None:
+        return True
+    size = os.path.getsize(data_file) if os.path.exists(data_file) else None
+    return size == entry['data size']
+
+
+class Catalog(object):
+    """Catalog of the NRRD and npy files in :obj:`directory`, see the module documentation
+
+    Parameters
+    ----------
+    directory : :class:`str`
+        Directory to catalog
+    filename : :class:`str`, optional
+        Filename of the catalog, defaults to .nrrdcatalog.json in :obj:`directory`
+
+    Attributes
+    ----------
+    entries : :class:`dict` (:class:`str`, :class:`dict`)
+        Entries by path relative to :obj:`directory` with '/' separators. Each entry has the 'mtime_ns' and 'size' of
+        the file and the fields of :func:`scan_nrrd` or :func:`scan_npy`, or an 'error' if the header could not be read
+    """
+
+    def __init__(self, directory, filename=None):
+        self.directory = directory
+        self.filename = filename if filename is not None else os.path.join(directory, _CATALOG_NAME)
+        self.entries = {}
+        if os.path.exists(self.filename):
+            with open(self.filename) as fh:
+                self.entries = json.load(fh)
+
+    def scan(self):
+        """Update the entries of new and changed files and remove the entries of removed files
+
+        Returns
+        -------
+        scanned, unchanged, removed : :class:`int`
+            Number of files whose header was read, of files whose entry was kept and of entries removed
+        """
+
+        entries = {}
+        scanned = 0
+        for root, _, names in os.walk(self.directory):
+            for name in sorted(names):
+                extension = os.path.splitext(name)[1].lower()
+                if extension not in _EXTENSIONS:
+                    continue
+
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.directory).replace(os.sep, '/')
+                stat = os.stat(path)
+                entry = self.entries.get(key)
+                if entry is not None and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size \
+                        and _data_file_unchanged(entry):
+                    entries[key] = entry
+                    continue
+
+                entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+                try:
+                    entry.update(scan_npy(path) if extension == '.npy' else scan_nrrd(path))
+                except Exception as e:
+                    entry['error'] = '%s: %s' % (type(e).__name__, e)
+                entries[key] = entry
+                scanned += 1
+
+        removed = len(set(self.entries) - set(entries))
+        self.entries = entries
+        return scanned, len(entries) - scanned, removed
+
+    def save(self):
+        """Save the catalog, it is renamed into place so a reader never sees a partly written one"""
+
+        with open(self.filename + '.tmp', 'w') as fh:
+            json.dump(self.entries, fh)
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Catalog the headers of the NRRD and npy files in a directory')
+    parser.add_argument('path', help='directory to catalog')
+    parser.add_argument('--catalog', help='catalog file, defaults to %s in the directory' % _CATALOG_NAME)
+    parser.add_argument('--list', action='store_true', help='print the shape, spacing and encoding of each file')
+    args = parser.parse_args()
+
+    catalog = Catalog(args.path, args.catalog)
+    start = time.time()
+    scanned, unchanged, removed = catalog.scan()
+    elapsed = time.time() - start
+    catalog.save()
+
+    if args.list:
+        for key, entry in sorted(catalog.entries.items()):
+            if 'error' in entry:
+                print('%s: %s' % (key, entry['error']))
+            else:
+                print('%s: shape %s, spacing %s, %s, %d bytes' % (key, entry['shape'], entry.get('spacing'),
+                                                                  entry['encoding'], entry['size']))
+    print('scanned %d, unchanged %d, removed %d in %.3f s, saved to %s' % (scanned, unchanged, removed, elapsed,
+                                                                           catalog.filename))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
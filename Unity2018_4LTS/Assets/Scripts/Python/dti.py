@@ -0,0 +1,244 @@
+"""Eigen decomposition of a DTI tensor field
+
+Computes the eigenvalues, the principal eigenvector, the fractional anisotropy (FA) and the mean diffusivity (MD) of
+every voxel of a tensor field like DTIBrain.nrrd, whose first axis holds the 9 components of the 3x3 tensor, and saves
+them as float32 NRRD files. The tensors are decomposed in chunks of voxels, so the float64 temporaries of
+:func:`numpy.linalg.eigh` stay small.
+
+    python dti.py DTIBrain.nrrd --output .\\Assets\\tmp
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from pynrrd import NrrdVolume, write
+
+# Number of voxels decomposed at once
+_CHUNK_VOXELS = 2 ** 14
+
+# Number of voxels write_eigen_maps reads from the file at once, rounded to whole z slices
+_SLAB_VOXELS = 2 ** 20
+
+# Maps written by write_eigen_maps, with the NRRD kind of their component axis, None for scalar maps
+_EIGEN_MAPS = [('eigenvalues', 'list'), ('evec', '3-vector'), ('fa', None), ('md', None)]
+
+
+def tensor_matrices(data):
+    """View the last axis of 9 components of :obj:`data` as 3x3 matrices, copying :obj:`data` if it isn't contiguous"""
+
+    if data.shape[-1] != 9:
+        raise ValueError('Expected 9 tensor components in the last axis, got %d' % data.shape[-1])
+
+    return np.ascontiguousarray(data).reshape(data.shape[:-1] + (3, 3))
+
+
+def mean_diffusivity(eigenvalues):
+    """Mean diffusivity of the eigenvalues in the last axis of :obj:`eigenvalues`"""
+
+    return eigenvalues.mean(axis=-1)
+
+
+def _anisotropy(deviation, norm, out):
+    """FA from the squared norms of the deviation of the eigenvalues from their mean and of the eigenvalues, into
+    :obj:`out`, which is left as it is where the norm is 0"""
+
+    np.divide(np.sqrt(1.5 * deviation), np.sqrt(norm), out=out, where=norm > 0, casting='unsafe')
+    return out
+
+
+def fractional_anisotropy(eigenvalues):
+    """Fractional anisotropy of the eigenvalues in the last axis of :obj:`eigenvalues`, 0 for a zero tensor"""
+
+    deviation = eigenvalues - eigenvalues.mean(axis=-1, keepdims=True)
+    norm = (eigenvalues ** 2).sum(axis=-1)
+    return _anisotropy((deviation ** 2).sum(axis=-1), norm, np.zeros_like(norm))
+
+
+def eigen_maps(data, chunk_size=_CHUNK_VOXELS):
+    """Decompose every tensor of a tensor field
+
+    Parameters
+    ----------
+    data : :class:`numpy.ndarray`
+        Tensor field with the 9 tensor components in the last axis, as read with index_order='C'. The tensors are
+        assumed to be symmetric, only their lower triangle is used
+    chunk_size : :class:`int`, optional
+        Number of voxels to decompose at once
+
+    Returns
+    -------
+    maps : :class:`dict` (:class:`str`, :class:`numpy.ndarray`)
+        float32 maps with the shape of :obj:`data` without its last axis: 'eigenvalues' with the 3 eigenvalues in
+        descending order and 'evec' with the eigenvector of the largest eigenvalue in a last axis of 3, 'fa' and
+        'md'. Voxels with non-finite components are treated as zero tensors
+    """
+
+    tensors = tensor_matrices(data).reshape(-1, 3, 3)
+    shape = data.shape[:-1]
+    size = tensors.shape[0]
+
+    eigenvalues = np.empty((size, 3), dtype=np.float32)
+    evec = np.empty((size, 3), dtype=np.float32)
+    for start in range(0, size, chunk_size):
+        chunk = tensors[start:start + chunk_size].astype(np.float64)
+        chunk[~np.isfinite(chunk).all(axis=(1, 2))] = 0
+
+        # eigh returns the eigenvalues in ascending order, with the eigenvectors in the columns
+        values, vectors = np.linalg.eigh(chunk)
+        eigenvalues[start:start + chunk_size] = values[:, ::-1]
+        evec[start:start + chunk_size] = vectors[:, :, -1]
+
+    return {'eigenvalues': eigenvalues.reshape(shape + (3,)), 'evec': evec.reshape(shape + (3,)),
+            'fa': fractional_anisotropy(eigenvalues).reshape(shape),
+            'md': mean_diffusivity(eigenvalues).reshape(shape)}
+
+
+def magnitude_map(data, chunk_size=_CHUNK_VOXELS):
+    """Largest norm of the columns of each tensor of a tensor field, the magnitude computeMag computes in Unity
+
+    Parameters
+    ----------
+    data : :class:`numpy.ndarray`
+        Tensor field with the 9 tensor components in the last axis, as read with index_order='C'
+    chunk_size : :class:`int`, optional
+        Number of voxels to compute at once
+
+    Returns
+    -------
+    magnitude : :class:`numpy.ndarray`
+        float32 map with the shape of :obj:`data` without its last axis
+    """
+
+    tensors = tensor_matrices(data).reshape(-1, 3, 3)
+    magnitude = np.empty(tensors.shape[0], dtype=np.float32)
+    for start in range(0, tensors.shape[0], chunk_size):
+        chunk = tensors[start:start + chunk_size].astype(np.float32)
+        magnitude[start:start + chunk_size] = np.sqrt(np.square(chunk).sum(axis=1)).max(axis=1)
+
+    return magnitude.reshape(data.shape[:-1])
+
+
+def fa_map(data, chunk_size=_CHUNK_VOXELS):
+    """Fractional anisotropy of each tensor of a tensor field without decomposing the tensors
+
+    Like :func:`eigen_maps`, the tensors are taken to be symmetric and only their lower triangle is used, and tensors
+    with non-finite components are zero. The FA is then computed from the Frobenius norms of the tensor and of its
+    deviatoric part, which equal the norms of its eigenvalues and of their deviation from the mean, so it is the 'fa'
+    of :func:`eigen_maps` without the cost of the decomposition.
+
+    Parameters
+    ----------
+    data : :class:`numpy.ndarray`
+        Tensor field with the 9 tensor components in the last axis, as read with index_order='C'
+    chunk_size : :class:`int`, optional
+        Number of voxels to compute at once
+
+    Returns
+    -------
+    fa : :class:`numpy.ndarray`
+        float32 map with the shape of :obj:`data` without its last axis, 0 for zero and non-finite tensors
+    """
+
+    tensors = tensor_matrices(data).reshape(-1, 3, 3)
+    fa = np.zeros(tensors.shape[0], dtype=np.float32)
+    for start in range(0, tensors.shape[0], chunk_size):
+        chunk = tensors[start:start + chunk_size].astype(np.float64)
+        chunk[~np.isfinite(chunk).all(axis=(1, 2))] = 0
+
+        # Squared norm of the symmetric tensor with the lower triangle of the chunk
+        diagonal = np.diagonal(chunk, axis1=1, axis2=2)
+        norm = np.square(diagonal).sum(axis=1) + 2 * np.square(chunk[:, [1, 2, 2], [0, 0, 1]]).sum(axis=1)
+        trace = diagonal.sum(axis=1)
+        # The squared norm of the deviatoric part T - tr(T) / 3 * I is |T|^2 - tr(T)^2 / 3
+        _anisotropy(np.maximum(norm - trace ** 2 / 3, 0), norm, fa[start:start + chunk_size])
+
+    return fa.reshape(data.shape[:-1])
+
+
+def derived_header(header, kind=None):
+    """Header for a map derived from a tensor field with header :obj:`header`
+
+    The spatial fields of :obj:`header` are kept. If :obj:`kind` is :obj:`None`, the map is a scalar volume and the
+    tensor axis is removed. Otherwise it replaces the tensor axis by an axis of that kind, and the measurement frame is
+    kept for the components.
+    """
+
+    derived = {}
+    for field in ['space', 'space units', 'space origin']:
+        if field in header:
+            derived[field] = header[field]
+
+    if 'space directions' in header:
+        directions = header['space directions']
+        derived['space directions'] = directions if kind is not None else directions[1:]
+
+    kinds = ['domain'] * (header['dimension'] - 1)
+    if kind is not None:
+        kinds = [kind] + kinds
+        if 'measurement frame' in header:
+            derived['measurement frame'] = header['measurement frame']
+    derived['kinds'] = kinds
+
+    return derived
+
+
+def write_eigen_maps(filename, directory, chunk_size=_CHUNK_VOXELS, encoding='raw'):
+    """Compute the eigen maps of the tensor field in NRRD file :obj:`filename` and write them to :obj:`directory`
+
+    The maps of :func:`eigen_maps` are written as <name>_<map>.nrrd, where <name> is the name of :obj:`filename`
+    without its extension. The component axis of the eigenvalues and eigenvectors is the first axis, like the tensor
+    axis of the tensor field, and the eigenvectors are in the measurement frame of the tensors.
+
+    The tensor field is read one slab of z slices at a time with :class:`pynrrd.NrrdVolume`, so it is never in memory
+    as a whole. The maps are, at 32 bytes per voxel, until they are written.
+
+    Returns
+    -------
+    filenames : :class:`list` (:class:`str`)
+        Filenames of the written maps
+    """
+
+    volume = NrrdVolume(filename, index_order='C')
+    header = volume.header
+    shape = volume.shape[:-1]
+    maps = {'eigenvalues': np.empty(shape + (3,), dtype=np.float32), 'evec': np.empty(shape + (3,), dtype=np.float32),
+            'fa': np.empty(shape, dtype=np.float32), 'md': np.empty(shape, dtype=np.float32)}
+
+    slab_size = max(1, _SLAB_VOXELS // max(int(np.prod(shape[1:])), 1))
+    for start in range(0, shape[0], slab_size):
+        for map_name, values in eigen_maps(volume[start:start + slab_size], chunk_size).items():
+            maps[map_name][start:start + slab_size] = values
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    name = os.path.splitext(os.path.basename(filename))[0]
+    filenames = []
+    for map_name, kind in _EIGEN_MAPS:
+        map_header = derived_header(header, kind)
+        map_header['encoding'] = encoding
+        map_filename = os.path.join(directory, '%s_%s.nrrd' % (name, map_name))
+        write(map_filename, maps[map_name], map_header, index_order='C')
+        filenames.append(map_filename)
+
+    return filenames
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute eigenvalues, principal eigenvector, FA and MD maps of a '
+                                                 'NRRD tensor field')
+    parser.add_argument('path', help='path to the nrrd file')
+    parser.add_argument('--output', default='.\\Assets\\tmp', help='directory to write the maps to')
+    parser.add_argument('--chunk', type=int, default=_CHUNK_VOXELS, help='number of voxels to decompose at once')
+    parser.add_argument('--encoding', choices=('raw', 'gzip'), default='raw', help='encoding of the written maps')
+    args = parser.parse_args()
+
+    for map_filename in write_eigen_maps(args.path, args.output, args.chunk, args.encoding):
+        print('wrote ', map_filename)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""Isosurface meshes of NRRD volumes
+
+Extracts the surface where a volume crosses a threshold, e.g. the surface of the brain in the FA or magnitude map of a
+tensor field, as one triangle mesh, so it can be drawn as one mesh instead of one object per voxel.
+
+The surface is extracted with surface nets: every cell of 2x2x2 voxels that the surface passes through gets one vertex,
+at the mean of the points where the surface crosses the edges of the cell, and every crossed edge between two voxels
+gets a quad between the vertices of the 4 cells around it. All cells and edges are handled at once with numpy. The
+mesh is decimated to a triangle budget by vertex clustering, merging the vertices in each cell of a coarser grid.
+
+Meshes are written as a compact binary file of the magic bytes, the little endian uint32 vertex count, triangle count
+and size of an index in bytes, the float32 vertices and normals, and the triangles as uint16 indices if there are
+fewer than 65536 vertices, uint32 indices otherwise. Vertices are in world space, given by the space directions and
+space origin of the header, and the triangles wind counterclockwise seen from outside in a right-handed frame.
+
+    python isosurface.py DTIBrain.nrrd --map fa --threshold 0.2 --triangles 100000
+"""
+import argparse
+import struct
+
+import numpy as np
+
+import dti
+from pynrrd import read
+from pyramid import is_tensor_field
+
+_MESH_MAGIC = b'NRRDMSH1'
+_MESH_HEADER = struct.Struct('<III')
+
+MAPS = {'fa': dti.fa_map, 'magnitude': dti.magnitude_map}
+
+
+def surface_nets(volume, threshold):
+    """Extract the surface where a volume crosses a threshold with surface nets
+
+    The volume is padded with voxels below the threshold, so the surface is closed where the volume touches its
+    border.
+
+    Parameters
+    ----------
+    volume : :class:`numpy.ndarray`
+        3D volume
+    threshold : :class:`float`
+        Value of the surface, voxels with at least this value are inside
+
+    Returns
+    -------
+    vertices : :class:`numpy.ndarray`
+        (N, 3) vertices in voxel coordinates in the index order of :obj:`volume`
+    triangles : :class:`numpy.ndarray`
+        (M, 3) vertex indices of the triangles, wound so their normals point out of the surface in those coordinates
+    """
+
+    volume = np.asarray(volume, dtype=np.float32)
+    if volume.ndim != 3:
+        raise ValueError('Expected a 3D volume, got %d axes' % volume.ndim)
+
+    outside = min(float(np.nanmin(volume)) if volume.size else threshold, threshold) - 1
+    volume = np.pad(np.nan_to_num(volume, nan=outside), 1, mode='constant', constant_values=outside)
+    inside = volume >= threshold
+
+    # Crossed edges along each axis, by the index of their lower voxel, and the points where they are crossed
+    edges, points, entering = [], [], []
+    for axis in range(3):
+        lower = [slice(None)] * 3
+        upper = [slice(None)] * 3
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        axis_edges = np.nonzero(inside[tuple(lower)] != inside[tuple(upper)])
+        a = volume[axis_edges]
+        b = volume[tuple(index + (other == axis) for other, index in enumerate(axis_edges))]
+
+        axis_points = np.stack(axis_edges, axis=1).astype(float)
+        axis_points[:, axis] += (threshold - a) / (b - a)
+        edges.append(axis_edges)
+        points.append(axis_points)
+        entering.append(a >= threshold)
+
+    # Each edge along an axis belongs to the 4 cells around it along the other two axes, a cell (i, j, k) spanning
+    # voxels i..i+1, j..j+1 and k..k+1. The vertex of a cell is the mean of the points of its crossed edges
+    cell_shape = tuple(size - 1 for size in volume.shape)
+    quads = []
+    for axis in range(3):
+        b, c = (axis + 1) % 3, (axis + 2) % 3
+        quad = []
+        for offset_b, offset_c in [(0, 0), (1, 0), (1, 1), (0, 1)]:
+            cell = list(edges[axis])
+            cell[b] = cell[b] - 1 + offset_b
+            cell[c] = cell[c] - 1 + offset_c
+            quad.append(np.ravel_multi_index(cell, cell_shape))
+        quads.append(np.stack(quad, axis=1))
+
+    cells, numbers = np.unique(np.concatenate([quad.ravel() for quad in quads]), return_inverse=True)
+    numbers = numbers.ravel()
+    weights = np.concatenate([np.repeat(axis_points, 4, axis=0) for axis_points in points])
+    counts = np.bincount(numbers, minlength=len(cells))
+    vertices = np.stack([np.bincount(numbers, weights[:, axis], len(cells)) for axis in range(3)], axis=1)
+    vertices = vertices / counts[:, None] - 1
+
+    triangles = []
+    for axis, quad in enumerate(quads):
+        quad = np.searchsorted(cells, quad)
+
+        # The quad winds around +axis, which is outwards if the surface is entered along the axis
+        flip = ~entering[axis]
+        quad[flip] = quad[flip][:, ::-1]
+        triangles.append(quad[:, [0, 1, 2]])
+        triangles.append(quad[:, [0, 2, 3]])
+
+    return vertices, np.concatenate(triangles)
+
+
+def _cluster(vertices, triangles, size):
+    """Merge the vertices in each cell of a grid of :obj:`size` and drop the triangles that collapse"""
+
+    keys = np.floor(vertices / size).astype(np.int64)
+    keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    counts = np.bincount(inverse, minlength=len(keys))
+    merged = np.stack([np.bincount(inverse, vertices[:, axis], len(keys)) for axis in range(3)], axis=1)
+    merged /= counts[:, None]
+
+    triangles = inverse[triangles]
+    triangles = triangles[(triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) &
+                          (triangles[:, 2] != triangles[:, 0])]
+    _, unique = np.unique(np.sort(triangles, axis=1), axis=0, return_index=True)
+    return merged, triangles[np.sort(unique)]
+
+
+def _compact(vertices, triangles):
+    """Remove the vertices no triangle uses"""
+
+    used, inverse = np.unique(triangles, return_inverse=True)
+    return vertices[used], inverse.reshape(triangles.shape)
+
+
+def decimate(vertices, triangles, max_triangles):
+    """Decimate a mesh to at most :obj:`max_triangles` triangles by vertex clustering
+
+    The vertices are merged in the cells of grids growing by a factor 1.25 until the mesh fits the budget.
+
+    Parameters
+    ----------
+    vertices : :class:`numpy.ndarray`
+        (N, 3) vertices, in voxel coordinates so the grid starts at the size of a voxel
+    triangles : :class:`numpy.ndarray`
+        (M, 3) vertex indices of the triangles
+    max_triangles : :class:`int`
+        Triangle budget
+
+    Returns
+    -------
+    vertices, triangles : :class:`numpy.ndarray`
+        Decimated mesh
+    """
+
+    size = 1.0
+    decimated = vertices, triangles
+    while len(decimated[1]) > max_triangles:
+        decimated = _cluster(vertices, triangles, size)
+        size *= 1.25
+
+    return _compact(*decimated)
+
+
+def vertex_normals(vertices, triangles):
+    """Unit normals of the vertices of a mesh, the area weighted mean of the normals of their triangles"""
+
+    corners = vertices[triangles]
+    face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+
+    normals = np.stack([np.bincount(triangles.ravel(), np.repeat(face_normals[:, axis], 3), len(vertices))
+                        for axis in range(3)], axis=1)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, lengths, out=normals, where=lengths > 0)
+    return normals
+
+
+def to_world(vertices, space_directions=None, space_origin=None):
+    """World space positions of vertices in voxel coordinates in C order"""
+
+    directions = np.eye(3) if space_directions is None else np.asarray(space_directions, dtype=float)
+    origin = np.zeros(3) if space_origin is None else np.asarray(space_origin, dtype=float)
+    return np.dot(vertices[:, ::-1], directions) + origin
+
+
+def extract(filename, threshold, map_name='fa', max_triangles=None):
+    """Extract the isosurface of the NRRD file :obj:`filename` in world space
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Filename of the NRRD file, a 3D volume or a tensor field
+    threshold : :class:`float`
+        Value of the surface
+    map_name : {'fa', 'magnitude'}, optional
+        Map of a tensor field to extract the surface from, see :func:`dti.fa_map` and :func:`dti.magnitude_map`
+    max_triangles : :class:`int`, optional
+        Triangle budget to decimate the mesh to, see :func:`decimate`
+
+    Returns
+    -------
+    vertices, normals : :class:`numpy.ndarray`
+        (N, 3) float32 world space vertices and their unit normals
+    triangles : :class:`numpy.ndarray`
+        (M, 3) vertex indices of the triangles
+    """
+
+    data, header = read(filename, index_order='C')
+    directions = header.get('space directions', np.eye(3))
+    if is_tensor_field(header):
+        data = MAPS[map_name](data)
+        directions = directions[1:] if 'space directions' in header else directions
+    elif data.ndim != 3:
+        raise ValueError('Expected a 3D volume or a tensor field, got %d axes' % data.ndim)
+
+    vertices, triangles = surface_nets(data, threshold)
+    if max_triangles is not None:
+        vertices, triangles = decimate(vertices, triangles, max_triangles)
+
+    # Reversing the axes from C order to world space mirrors the mesh, which reverses the winding of the triangles
+    # unless the space directions mirror it back
+    vertices = to_world(vertices, directions, header.get('space origin'))
+    if np.linalg.det(directions) > 0:
+        triangles = triangles[:, ::-1]
+
+    return vertices.astype(np.float32), vertex_normals(vertices, triangles).astype(np.float32), triangles
+
+
+def write_mesh(filename, vertices, normals, triangles):
+    """Write a mesh as vertex and index buffers, see the module documentation"""
+
+    index_dtype = '<u2' if len(vertices) < 2 ** 16 else '<u4'
+    with open(filename, 'wb') as fh:
+        fh.write(_MESH_MAGIC + _MESH_HEADER.pack(len(vertices), len(triangles), np.dtype(index_dtype).itemsize))
+        fh.write(np.ascontiguousarray(vertices, dtype='<f4').data)
+        fh.write(np.ascontiguousarray(normals, dtype='<f4').data)
+        fh.write(np.ascontiguousarray(triangles, dtype=index_dtype).data)
+
+
+def read_mesh(filename):
+    """Read a mesh written by :func:`write_mesh`, returns the vertices, normals and triangles"""
+
+    with open(filename, 'rb') as fh:
+        if fh.read(len(_MESH_MAGIC)) != _MESH_MAGIC:
+            raise ValueError('Not a mesh file: %s' % filename)
+
+        vertex_count, triangle_count, index_size = _MESH_HEADER.unpack(fh.read(_MESH_HEADER.size))
+        vertices = np.fromfile(fh, dtype='<f4', count=3 * vertex_count).reshape(-1, 3)
+        normals = np.fromfile(fh, dtype='<f4', count=3 * vertex_count).reshape(-1, 3)
+        triangles = np.fromfile(fh, dtype='<u%d' % index_size, count=3 * triangle_count).reshape(-1, 3)
+
+    return vertices, normals, triangles
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract the isosurface of a NRRD volume or of the FA or magnitude '
+                                                 'map of a NRRD tensor field as a mesh')
+    parser.add_argument('path', help='path to the nrrd file')
+    parser.add_argument('--output', default='.\\Assets\\tmp\\mesh.bin', help='mesh file to write')
+    parser.add_argument('--threshold', type=float, required=True, help='value of the surface')
+    parser.add_argument('--map', choices=sorted(MAPS), default='fa', help='map of a tensor field (default: fa)')
+    parser.add_argument('--triangles', type=int, help='triangle budget to decimate the mesh to')
+    args = parser.parse_args()
+
+    vertices, normals, triangles = extract(args.path, args.threshold, args.map, args.triangles)
+    write_mesh(args.output, vertices, normals, triangles)
+    print('wrote %d vertices and %d triangles to %s' % (len(vertices), len(triangles), args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
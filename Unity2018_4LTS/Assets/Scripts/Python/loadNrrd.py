@@ -1,24 +1,463 @@
+import argparse
+import glob
+import json
 import os
+import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 from pynrrd import *
+from nrrdcache import ConversionCache, conversion_key
+import sharedvolume
+import dti
+from pyramid import build_pyramid
+
+# Scalar maps convert can save next to the tensor field
+MAPS = {'magnitude': dti.magnitude_map, 'fa': dti.fa_map}
+
+# The 'int64' format stores the values times this factor
+INT64_SCALE = 10**15
+
+def parse_slices(value):
+    """Parse START:STOP into a slice of the slowest (z) axis"""
+    start, stop = value.split(':')
+    return slice(int(start) if start else None, int(stop) if stop else None)
+
+def load_tensor(pathToFile, slices=None, out_dtype=None, scale=None):
+    """Read the tensor field, or only the given slices of the z axis, with the z axis first, and its header
+
+    The values are multiplied by scale and converted to out_dtype if given. The whole field is converted while it is
+    decoded, see read_data, a slab of slices after it is read.
+    """
+    if slices is not None:
+        # With index_order='C' the z axis is the first one, so this reads just the slab of the requested slices
+        volume = NrrdVolume(pathToFile, index_order='C')
+        data = volume[slices]
+        if scale is not None:
+            data = data * scale
+        if out_dtype is not None:
+            data = data.astype(out_dtype)
+        return data, volume.header
+    data, header=read(pathToFile,index_order='C',out_dtype=out_dtype,scale=scale)
+    return data, header
+
+def load_shared_tensor(pathToFile, half=False, use_shared_memory=False):
+    """Read the tensor field straight into shared memory, with the z axis first, and return the volume and header
+
+    The values are decoded into the published array, as float16 if half is True, so the field is only in memory once.
+    See sharedvolume.SharedVolume.allocate.
+    """
+    volume = NrrdVolume(pathToFile, index_order='C')
+    dtype = np.float16 if half else volume.dtype
+    shared = sharedvolume.SharedVolume.allocate(volume.shape, dtype, volume.header, 'C', use_shared_memory)
+    try:
+        read(pathToFile, index_order='C', out=shared.array)
+        shared.flush()
+    except BaseException:
+        sharedvolume.release(shared.descriptor['name'])
+        raise
+    return shared, volume.header
+
+def output_name(output_format):
+    """Name of the file save_tensor writes for the given format"""
+    return {'raw': 'sample.nhdr', 'shm': 'sample.json'}.get(output_format, 'sample.npy')
+
+def save_tensor(data, output_format='int64', half=False, directory='.\\Assets\\tmp', header=None,
+                use_shared_memory=False, converted=False):
+    """Save the tensor field to directory in the given format and return the path of the written file
+
+    'int64' is the format read by the Unity side: the values times 10^15 as int64 in sample.npy. 'npy' saves the
+    values in their own dtype, or float16 if :obj:`half` is True, in sample.npy. 'raw' writes them as a little endian
+    raw blob, sample.raw, described by the detached NRRD header sample.nhdr. 'shm' publishes them like 'npy' in shared
+    memory, see sharedvolume, and writes the descriptor of the volume to sample.json. For 'shm' data can also be a
+    SharedVolume from load_shared_tensor, which is already published. The volume is in a file that
+    must be removed by the consumer, or in a shared memory segment that lives as long as this process if
+    use_shared_memory is True. converted tells that data is already in the 'int64' format, scaled by INT64_SCALE
+    while it was read.
+    """
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+    filename = directory + '/' + output_name(output_format)
+    if output_format == 'int64':
+        #convert type, unless load_tensor already did
+        if not converted:
+            data=data*INT64_SCALE
+            data=data.astype(np.int64)
+        np.save(filename, data)
+    elif output_format == 'npy':
+        if half:
+            data = data.astype(np.float16)
+        np.save(filename, data.astype(data.dtype.newbyteorder('<'), copy=False))
+    elif output_format == 'shm':
+        if isinstance(data, sharedvolume.SharedVolume):
+            # Already decoded into shared memory by load_shared_tensor
+            volume = data
+        else:
+            if half:
+                data = data.astype(np.float16)
+            volume = sharedvolume.SharedVolume.publish(data, header, 'C', use_shared_memory)
+        # The descriptor is renamed into place so that a reader never sees a partly written one
+        with open(filename + '.tmp', 'w') as fh:
+            json.dump(volume.descriptor, fh)
+        os.replace(filename + '.tmp', filename)
+    else:
+        # NRRD has no half precision type, so the raw blob always keeps the dtype of the file
+        write(filename, data.astype(data.dtype.newbyteorder('<'), copy=False), {'encoding': 'raw'},
+              detached_header=True, index_order='C')
+    return filename
+
+def save_map(volume, name, output_format='int64', directory='.\\Assets\\tmp', header=None):
+    """Save a float32 scalar map of the tensor field next to it and return the path of the written file
+
+    The map is written as sample_<name>.nhdr with a raw blob, like save_tensor, for the 'raw' format and as
+    sample_<name>.npy for the other formats.
+    """
+    if output_format == 'raw':
+        filename = directory + '/sample_%s.nhdr' % name
+        map_header = dti.derived_header(header) if header is not None else {}
+        map_header['encoding'] = 'raw'
+        write(filename, volume, map_header, detached_header=True, index_order='C')
+    else:
+        filename = directory + '/sample_%s.npy' % name
+        np.save(filename, volume)
+    return filename
+
+def convert(pathToFile, output_format='int64', half=False, slices=None, cache_dir=None, cache_size=2048,
+            directory='.\\Assets\\tmp', progress=None, use_shared_memory=False, maps=()):
+    """Convert the tensor field with save_tensor, through the cache in cache_dir if given
+
+    maps are the names of the scalar maps in MAPS to compute and save with save_map. progress is called with the name
+    of each stage, 'reading', 'saving' and 'computing <map>'. Returns the path of the converted file and whether it was
+    found in the cache.
+    """
+    def run(directory):
+        if progress is not None:
+            progress('reading')
+        # Convert to int64 while reading, unless the maps need the values themselves
+        converted = output_format == 'int64' and not maps
+        # The maps are computed from the values before they are converted to float16
+        shared = output_format == 'shm' and slices is None and not (half and maps)
+        if converted:
+            data, header = load_tensor(pathToFile, slices, np.int64, INT64_SCALE)
+        elif shared:
+            # Decode straight into shared memory instead of copying the field there after reading it
+            data, header = load_shared_tensor(pathToFile, half, use_shared_memory)
+        else:
+            data, header = load_tensor(pathToFile, slices)
+        if progress is not None:
+            progress('saving')
+        filename = save_tensor(data, output_format, half, directory, header, use_shared_memory, converted)
+        for name in maps:
+            if progress is not None:
+                progress('computing ' + name)
+            save_map(MAPS[name](data.array if shared else data), name, output_format, directory, header)
+        return filename
+
+    if cache_dir is None:
+        return run(directory), False
+    if output_format == 'shm':
+        raise ValueError('Volumes in shared memory are not cached')
+    cache = ConversionCache(cache_dir, cache_size * 2 ** 20)
+    key = conversion_key(pathToFile, format=output_format, float16=half, slices=slices, maps=sorted(maps))
+    entry = cache.get(key)
+    cached = entry is not None
+    if not cached:
+        entry = cache.put(key, run)
+    return os.path.join(entry, output_name(output_format)), cached
+
+def header_to_json(header):
+    """Make the values of a header read by pynrrd JSON serializable"""
+    return dict((field, value.tolist() if isinstance(value, np.ndarray) else value) for field, value in header.items())
+
+def serve(args, stdin=sys.stdin, stdout=sys.stdout):
+    """Answer JSON requests, one per line on stdin, with JSON responses on stdout until stdin is closed
+
+    A request is an object with an optional "id" that is copied to its responses and a "command":
+      "convert": convert "path" with the optional "format", "float16", "slices" (START:STOP), "maps" (a list of
+                 names in MAPS), "cache" and "directory" options, which default to the command line options.
+                 Responds with "output", the path of the converted file, and "cached". Without a cache the files
+                 are written to a new directory in "directory" for each request, named after its "id", so
+                 concurrent requests never write the same files. That directory is removed when the volume of a
+                 "shm" conversion is released, and otherwise when the server exits, so the files must be read or
+                 moved before then
+      "header": responds with "header", the header of "path"
+      "build-index": builds the gzip index of "path" and responds with its path in "output"
+      "release": releases the volume "name" published by a "shm" conversion and responds with "released", whether
+                 it was published by this server. Shared memory segments stay alive until released
+      "shutdown": stops reading requests, the server exits once the running requests are done, releases the
+                  volumes that are still published and removes the request directories that are left
+    Requests are handled concurrently by --workers threads, so responses can come in any order. Every request gets
+    one final response with "status" "done" or "error", and "convert" also sends "progress" responses with a "stage"
+    before it.
+    """
+    lock = threading.Lock()
+    # Request directories to remove, by the name of the volume published in them for "shm" conversions and by their
+    # path otherwise
+    directories = {}
+    directories_lock = threading.Lock()
+
+    def remove_directory(key):
+        with directories_lock:
+            directory = directories.pop(key, None)
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def send(message):
+        with lock:
+            stdout.write(json.dumps(message) + '\n')
+            stdout.flush()
+
+    def handle(request):
+        request_id = request.get('id')
+        try:
+            command = request.get('command', 'convert')
+            if command == 'convert':
+                output_format = request.get('format', args.format)
+                half = request.get('float16', args.float16)
+                if half and output_format not in ('npy', 'shm'):
+                    raise ValueError('float16 is only supported with format npy or shm')
+                slices = request.get('slices')
+                cache_dir = request.get('cache', args.cache)
+                directory = request.get('directory', '.\\Assets\\tmp')
+                if cache_dir is None:
+                    if not os.path.exists(directory):
+                        os.makedirs(directory)
+                    directory = tempfile.mkdtemp(prefix='request-%s-' % re.sub(r'[^\w.-]', '_', str(request_id)),
+                                                 dir=directory)
+                    with directories_lock:
+                        directories[directory] = directory
+                try:
+                    filename, cached = convert(request['path'], output_format, half,
+                                               args.slices if slices is None else parse_slices(slices),
+                                               cache_dir, args.cache_size, directory,
+                                               lambda stage: send({'id': request_id, 'status': 'progress',
+                                                                   'stage': stage}),
+                                               use_shared_memory=True, maps=request.get('maps', map_names(args)))
+                except BaseException:
+                    remove_directory(directory)
+                    raise
+                if cache_dir is None and output_format == 'shm':
+                    # The directory goes with the volume, which is named in the descriptor written to it
+                    with open(filename) as fh:
+                        name = json.load(fh)['name']
+                    with directories_lock:
+                        directories[name] = directories.pop(directory)
+                response = {'output': filename, 'cached': cached}
+            elif command == 'header':
+                response = {'header': header_to_json(read_header(request['path']))}
+            elif command == 'build-index':
+                response = {'output': build_gzip_index(request['path'])}
+            elif command == 'release':
+                response = {'released': sharedvolume.release(request['name'])}
+                remove_directory(request['name'])
+            else:
+                raise ValueError('Unknown command %r' % command)
+            response.update(id=request_id, status='done')
+        except Exception as e:
+            response = {'id': request_id, 'status': 'error', 'error': '%s: %s' % (type(e).__name__, e)}
+        send(response)
+
+    with ThreadPoolExecutor(args.workers) as executor:
+        for line in iter(stdin.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('expected an object')
+            except ValueError as e:
+                send({'id': None, 'status': 'error', 'error': 'Invalid request: %s' % e})
+                continue
+            if request.get('command') == 'shutdown':
+                break
+            executor.submit(handle, request)
+    sharedvolume.release_all()
+    for key in list(directories):
+        remove_directory(key)
+    return 0
+
+def find_studies(pattern, exclude=None):
+    """The .nrrd and .nhdr files in the directory pattern and its subdirectories, or matching the glob pattern
+
+    Files in the directory exclude, where the batch writes its outputs, are left out.
+    """
+    if os.path.isdir(pattern):
+        paths = [os.path.join(dirpath, name) for dirpath, _, names in os.walk(pattern) for name in names]
+    else:
+        paths = glob.glob(pattern)
+    paths = [path for path in paths if os.path.splitext(path)[1].lower() in ('.nrrd', '.nhdr')]
+    if exclude is not None:
+        exclude = os.path.join(os.path.abspath(exclude), '')
+        paths = [path for path in paths if not os.path.abspath(path).startswith(exclude)]
+    return sorted(paths)
+
+def convert_study(pathToFile, directory, output_format='int64', half=False, maps=(), levels=0):
+    """Convert one study of a batch into directory with convert, unless it is up to date, and write its pyramid
+
+    The manifest of the study, batch.json in directory, records the conversion key of the file and options, the
+    files written, the size of the data and the seconds each stage took. The study is up to date if the key in the
+    manifest is the same and the files it lists exist. Returns the manifest and whether the study was up to date.
+    """
+    manifest_path = os.path.join(directory, 'batch.json')
+    key = conversion_key(pathToFile, format=output_format, float16=half, maps=sorted(maps), levels=levels)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as fh:
+            manifest = json.load(fh)
+        if manifest.get('key') == key and all(os.path.exists(os.path.join(directory, name))
+                                              for name in manifest['outputs']):
+            return manifest, True
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    stages = []
+    def progress(stage):
+        stages.append((stage, time.time()))
+    convert(pathToFile, output_format, half, directory=directory, progress=progress, maps=maps)
+    if levels > 0:
+        progress('pyramid')
+        build_pyramid(pathToFile, levels, directory)
+    stages.append((None, time.time()))
+
+    volume = NrrdVolume(pathToFile)
+    manifest = {'key': key, 'path': os.path.abspath(pathToFile),
+                'outputs': sorted(name for name in os.listdir(directory) if name != 'batch.json'),
+                'bytes': int(np.prod(volume.shape)) * volume.dtype.itemsize,
+                'voxels': int(np.prod(volume.shape[-3:])),
+                'stages': dict((stage, end - start) for (stage, start), (_, end) in zip(stages, stages[1:]))}
+    # The manifest is written last and renamed into place, so an interrupted study is converted again
+    with open(manifest_path + '.tmp', 'w') as fh:
+        json.dump(manifest, fh)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest, False
+
+def batch(pattern, output, output_format='int64', half=False, maps=(), levels=0, workers=None):
+    """Convert every study found by find_studies(pattern) with convert_study on a pool of worker processes
+
+    Each study is written to its own directory in output, named after its path relative to the directory pattern,
+    or to the common directory of the files matching the glob pattern, without the extension. Prints a line per study
+    and a summary of the throughput of each stage, and returns the number of studies that failed.
+    """
+    studies = find_studies(pattern, output)
+    if not studies:
+        print('no .nrrd or .nhdr files found in ', pattern)
+        return 0
+    if os.path.isdir(pattern):
+        root = os.path.abspath(pattern)
+    else:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in studies])
+
+    start = time.time()
+    totals, converted, skipped, failed = {}, 0, 0, 0
+    with ProcessPoolExecutor(workers) as executor:
+        futures = []
+        for path in studies:
+            directory = os.path.join(output, os.path.splitext(os.path.relpath(os.path.abspath(path), root))[0])
+            futures.append((path, executor.submit(convert_study, path, directory, output_format, half, maps, levels)))
+        for path, future in futures:
+            try:
+                manifest, up_to_date = future.result()
+            except Exception as e:
+                failed += 1
+                print('failed ', path, ': %s: %s' % (type(e).__name__, e))
+                continue
+            if up_to_date:
+                skipped += 1
+                print('up to date ', path)
+                continue
+            converted += 1
+            print('converted ', path)
+            for stage, seconds in manifest['stages'].items():
+                total = totals.setdefault(stage, [0.0, 0, 0])
+                total[0] += seconds
+                total[1] += manifest['bytes']
+                total[2] += manifest['voxels']
+    elapsed = time.time() - start
+
+    print('%d converted, %d up to date, %d failed in %.1f s' % (converted, skipped, failed, elapsed))
+    # Stage times are summed over the workers, so the stage throughput is per worker process
+    for stage, (seconds, data_bytes, voxels) in totals.items():
+        seconds = max(seconds, 1e-9)
+        print('  %-20s %8.1f s %10.1f MB/s %14.0f voxels/s' % (stage, seconds, data_bytes / 2 ** 20 / seconds,
+                                                              voxels / seconds))
+    return failed
+
+def map_names(args):
+    """Names of the maps requested by the --magnitude and --fa options"""
+    return [name for name in ('magnitude', 'fa') if getattr(args, name)]
 
 def main():
+    parser = argparse.ArgumentParser(description='Convert a NRRD tensor field to .\\Assets\\tmp/sample.npy')
+    parser.add_argument('path', nargs='?', help='path to the nrrd file')
+    parser.add_argument('--slices', type=parse_slices,
+                        help='only convert slices START:STOP of the z axis, e.g. 30:40. Only the data of those slices '
+                             'is read from the file')
+    parser.add_argument('--build-index', action='store_true',
+                        help='build a random access index for gzip encoded data next to the file and exit. Later '
+                             '--slices reads of the file start from the nearest point in the index')
+    parser.add_argument('--format', choices=('int64', 'npy', 'raw', 'shm'), default='int64',
+                        help='int64 (default) saves the values times 10^15 as int64 for the Unity side. npy saves '
+                             'them in their own dtype and raw writes them as a little endian blob with a detached '
+                             'NRRD header, both at a quarter of the size of int64 for float data. shm puts them in '
+                             'a file in shared memory, described by sample.json, that the consumer maps and removes')
+    parser.add_argument('--float16', action='store_true', help='save half precision values with --format npy or shm')
+    parser.add_argument('--magnitude', action='store_true',
+                        help='also save the largest column norm of each tensor as a float32 volume next to the tensor '
+                             'field, sample_magnitude.npy or sample_magnitude.nhdr for --format raw')
+    parser.add_argument('--fa', action='store_true',
+                        help='also save the fractional anisotropy of each tensor, as sample_fa.npy or sample_fa.nhdr')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='keep converted files in the cache directory DIR instead of .\\Assets\\tmp and skip the '
+                             'conversion if the file was converted with the same options before')
+    parser.add_argument('--cache-size', type=int, default=2048, metavar='MB',
+                        help='disk budget of the cache in MB, least recently used files are removed to stay within it '
+                             '(default: 2048)')
+    parser.add_argument('--serve', action='store_true',
+                        help='keep running and convert files on requests read from stdin, one JSON object per line. '
+                             'See serve() for the protocol')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of requests --serve handles at once, or of studies --batch converts at once '
+                             '(default: 4)')
+    parser.add_argument('--batch', metavar='DIR',
+                        help='convert every .nrrd and .nhdr file in the directory path and its subdirectories, or '
+                             'matching the glob path, on --workers processes. Each study is written to its own '
+                             'directory in DIR and skipped if it is up to date')
+    parser.add_argument('--levels', type=int, default=0,
+                        help='number of pyramid levels --batch writes for each study (default: 0)')
+    # Extra arguments passed by the Unity side are ignored
+    args, _ = parser.parse_known_args()
+    if args.float16 and args.format not in ('npy', 'shm'):
+        parser.error('--float16 is only supported with --format npy or shm')
+    if args.cache is not None and args.format == 'shm':
+        parser.error('--cache is not supported with --format shm')
+    if args.batch is not None and args.format == 'shm':
+        parser.error('--batch is not supported with --format shm')
+    if args.serve:
+        return serve(args)
+    if args.batch is not None:
+        if args.path is None:
+            parser.error('--batch requires a directory or glob path')
+        return 1 if batch(args.path, args.batch, args.format, args.float16, map_names(args), args.levels,
+                          args.workers) else 0
     print('Hello')
-    if len(sys.argv) >=2:
-        pathToFile = sys.argv[1]
+    if args.path is not None:
+        pathToFile = args.path
         print('dir to nrrd is ', pathToFile)
-        data, header=read(pathToFile,index_order='C')
-        #convert type
-        data=data*10**15
-        data=data.astype(np.int64)
-        if not os.path.exists('.\\Assets\\tmp'):
-            os.mkdir('.\\Assets\\tmp')
-        np.save('.\\Assets\\tmp/sample.npy', data)
+        if args.build_index:
+            print('wrote index to ', build_gzip_index(pathToFile))
+            return 0
+        filename, cached = convert(pathToFile, args.format, args.float16, args.slices, args.cache, args.cache_size,
+                                   maps=map_names(args))
+        if cached:
+            print('found in cache')
+        print('saved to ', filename)
     else:
         print ('Required to specify path to nrrd')
     return 0
  
  
 if __name__=='__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
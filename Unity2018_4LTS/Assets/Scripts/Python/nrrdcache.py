@@ -0,0 +1,173 @@
+"""Cache of converted NRRD files
+
+Each entry is a directory in the cache directory that holds the output of one conversion. Entries are named by a key
+computed from the path, modification time and size of the source file and its data file, the bytes of its header and
+the conversion parameters, so a changed source file never hits an old entry.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+from pynrrd import read_header
+
+# Headers longer than this are not read any further when computing a key
+_HEADER_SIZE_LIMIT = 2 ** 20
+
+_DEFAULT_MAX_SIZE = 2 * 2 ** 30
+
+
+def _read_header_lines(filename):
+    """Read the lines of the NRRD header in :obj:`filename`, up to and including the blank line that ends it"""
+
+    lines = []
+    size = 0
+    with open(filename, 'rb') as fh:
+        for line in fh:
+            lines.append(line)
+            size += len(line)
+            if not line.strip() or size > _HEADER_SIZE_LIMIT:
+                break
+
+    return lines
+
+
+def _directory_size(path):
+    """Total size in bytes of the files in directory :obj:`path`"""
+
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+
+    return size
+
+
+def conversion_key(filename, **params):
+    """Compute the cache key of converting NRRD file :obj:`filename` with the conversion parameters :obj:`params`
+
+    Only the header of the file is read. If the header refers to a detached data file, the modification time and size
+    of that file are part of the key as well.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Filename of the NRRD file
+    params
+        Conversion parameters, for example the output format. Their :func:`repr` is part of the key
+
+    Returns
+    -------
+    key : :class:`str`
+        Hexadecimal key of the conversion
+    """
+
+    lines = _read_header_lines(filename)
+    header = read_header(lines)
+
+    sources = [filename]
+    data_filename = header.get('datafile', header.get('data file', None))
+    if data_filename is not None:
+        if not os.path.isabs(data_filename):
+            data_filename = os.path.join(os.path.dirname(filename), data_filename)
+        sources.append(data_filename)
+
+    sha = hashlib.sha1()
+    for source in sources:
+        stat = os.stat(source)
+        sha.update(('%s %d %d\n' % (os.path.abspath(source), stat.st_mtime_ns, stat.st_size)).encode('utf-8'))
+    sha.update(b''.join(lines))
+    for name in sorted(params):
+        sha.update(('%s=%r\n' % (name, params[name])).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+class ConversionCache(object):
+    """Directory of converted NRRD files with least recently used eviction
+
+    An entry is written to a hidden temporary directory and renamed to its key once complete, so an entry that exists
+    is always complete. The modification time of an entry is the time it was last used, which eviction goes by.
+
+    Parameters
+    ----------
+    directory : :class:`str`
+        Cache directory, created if it doesn't exist
+    max_size : :class:`int`, optional
+        Disk budget in bytes. After storing an entry, the least recently used other entries are removed until the cache
+        fits in the budget. Defaults to 2 GiB
+    """
+
+    def __init__(self, directory, max_size=_DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        """Return the directory of the entry :obj:`key` and mark it as used, or :obj:`None` if it isn't cached"""
+
+        entry = os.path.join(self.directory, key)
+        try:
+            os.utime(entry)
+        except OSError:
+            return None
+
+        return entry
+
+    def put(self, key, convert):
+        """Store the entry :obj:`key` and return its directory
+
+        :obj:`convert` is called with the path of an empty directory to write the output of the conversion to. If
+        another process stored the same entry in the meantime, that entry is kept.
+        """
+
+        entry = os.path.join(self.directory, key)
+        directory = tempfile.mkdtemp(prefix='.%s-' % key, dir=self.directory)
+        try:
+            convert(directory)
+            try:
+                os.rename(directory, entry)
+            except OSError:
+                if not os.path.isdir(entry):
+                    raise
+                shutil.rmtree(directory, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+        self.evict(keep=key)
+        return entry
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries, except :obj:`keep`, until the cache fits in :obj:`max_size`"""
+
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            # Entries that are still being written are hidden
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+
+            try:
+                last_used = os.path.getmtime(path)
+            except OSError:
+                continue
+
+            size = _directory_size(path)
+            entries.append((last_used, name, size))
+            total_size += size
+
+        for _, name, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if name == keep:
+                continue
+
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total_size -= size
@@ -1,12 +1,26 @@
+import bisect
 import bz2
+import ctypes
+import ctypes.util
+import itertools
+import numbers
 import os
+import struct
 import zlib
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 import re
 import warnings
 import numpy as np
 
+
+class NRRDError(Exception):
+    """Exceptions for NRRD class."""
+    pass
+
+
 def format_number(x):
     """Format number to string
 
@@ -382,12 +396,49 @@ def parse_number_auto_dtype(x):
     
 # Older versions of Python had issues when uncompressed data was larger than 4GB (2^32). This should be fixed in latest
 # version of Python 2.7 and all versions of Python 3. The fix for this issue is to read the data in smaller chunks.
-# Chunk size is set to be large at 1GB to improve performance. If issues arise decompressing larger files, try to reduce
-# this value
-_READ_CHUNKSIZE = 2 ** 32
+# Compressed data is streamed from the file and decompressed this many bytes at a time, so at most one chunk of
+# compressed and one chunk of decompressed data are held in memory next to the output array.
+_READ_CHUNKSIZE = 2 ** 20
+
+# NrrdVolume saves the state of the gzip decompressor every this many bytes of decompressed data, so that later reads
+# can resume from the nearest saved state instead of decompressing from the start of the data. Each saved state holds
+# the 32KB DEFLATE window.
+_CHECKPOINT_INTERVAL = 2 ** 24
+
+# ASCII data is parsed a chunk of about this many bytes of text at a time, split at whitespace so no number is cut in
+# two, and written a chunk of about as much text at a time. With more than one thread the chunks are parsed and
+# formatted in worker processes instead, since parsing and formatting text holds the GIL.
+_TEXT_CHUNKSIZE = 2 ** 22
+
+# Characters that separate the numbers of ASCII data
+_TEXT_WHITESPACE = b' \t\n\r\x0b\x0c'
+
+# Size of a DEFLATE window, the most data a compressed block can refer back to
+_DEFLATE_WINDOW_SIZE = 2 ** 15
+
+# Sidecar gzip index files, see build_gzip_index. The header holds the magic, the data file size and modification time
+# the index was built for, the data offset, the decompressed size and the number of points. Each point holds the
+# decompressed position, the file offset, the number of unused bits in the byte before the offset (-1 for the start of
+# a gzip member) and the size of the zlib compressed window that follows it.
+_GZIP_INDEX_MAGIC = b'NRRDGZI1'
+_GZIP_INDEX_HEADER = struct.Struct('<QqQQI')
+_GZIP_INDEX_POINT = struct.Struct('<QQbI')
+
+_Z_OK = 0
+_Z_STREAM_END = 1
+_Z_BLOCK = 5
+_Z_BUF_ERROR = -5
 
 _NRRD_REQUIRED_FIELDS = ['dimension', 'type', 'encoding', 'sizes']
 
+# Gzip data written with more than one thread is a series of concatenated gzip members, which any gzip reader decodes as
+# one stream. Each member stores its own compressed size in a 'PN' subfield of the gzip extra field (the same idea as
+# BGZF), so that member boundaries can be found by hopping from header to header and the members inflated in parallel.
+# The header layout is ID1 ID2 CM FLG MTIME XFL OS XLEN SI1 SI2 LEN SIZE.
+_GZIP_MEMBER_HEADER = struct.Struct('<4BI2BH2BHI')
+_GZIP_MEMBER_FIELDS = (0x1f, 0x8b, zlib.DEFLATED, 4)
+_GZIP_MEMBER_EXTRA = (8, ord('P'), ord('N'), 4)
+
 ALLOW_DUPLICATE_FIELD = False
 """Allow duplicate header fields when reading NRRD files
 
@@ -670,7 +721,405 @@ def read_header(file, custom_field_map=None):
     return header
 
 
-def read_data(header, fh=None, filename=None, index_order='F'):
+def _iter_decompressed(fh, new_decompobj):
+    """Yield the decompressed data from :obj:`fh` in pieces of at most :obj:`_READ_CHUNKSIZE` bytes
+
+    :obj:`new_decompobj` is called to create a decompressor for each gzip member or bzip2 stream in the data.
+    """
+
+    decompobj = new_decompobj()
+
+    # BZ2Decompressor keeps unconsumed input internally and reports when it needs more with needs_input. The zlib
+    # decompressor returns unconsumed input in unconsumed_tail instead, which must be passed back in.
+    is_bz2 = hasattr(decompobj, 'needs_input')
+
+    while True:
+        if decompobj.eof:
+            # Concatenated gzip members or bzip2 streams decompress to the concatenation of their data. Anything after
+            # the last one that is not another member, such as zero padding, is ignored.
+            compressed_data = decompobj.unused_data
+            if len(compressed_data) < 3:
+                compressed_data += fh.read(_READ_CHUNKSIZE)
+
+            if compressed_data[:2] != b'\x1f\x8b' and compressed_data[:3] != b'BZh':
+                break
+
+            decompobj = new_decompobj()
+        elif is_bz2:
+            compressed_data = fh.read(_READ_CHUNKSIZE) if decompobj.needs_input else b''
+        else:
+            compressed_data = decompobj.unconsumed_tail or fh.read(_READ_CHUNKSIZE)
+
+        decompressed_data = decompobj.decompress(compressed_data, _READ_CHUNKSIZE)
+
+        # Nothing left to read and nothing left to output means the stream is truncated, the size check in read_data
+        # reports this
+        if not compressed_data and not decompressed_data:
+            break
+
+        if decompressed_data:
+            yield decompressed_data
+
+
+def _decompress_into(fh, new_decompobj, data, byte_skip=0):
+    """Stream the decompressed data from :obj:`fh` into the preallocated 1D array :obj:`data`
+
+    A non-negative :obj:`byte_skip` discards that many bytes at the start of the decompressed data. A negative
+    :obj:`byte_skip` keeps only the last -byte_skip bytes, which must equal the size of :obj:`data`.
+
+    Returns the number of elements the decompressed data contains after the byte skip, which differs from
+    :obj:`data.size` when the data does not match the header. Only the elements that fit are written to :obj:`data`.
+    """
+
+    out = data.view(np.uint8)
+    out_size = out.size
+    position = 0
+
+    if byte_skip >= 0:
+        for chunk in _iter_decompressed(fh, new_decompobj):
+            chunk_size = len(chunk)
+
+            # Copy the part of the chunk that overlaps [byte_skip, byte_skip + out_size) of the decompressed data
+            start = max(byte_skip - position, 0)
+            end = min(byte_skip + out_size - position, chunk_size)
+            if start < end:
+                out_start = position + start - byte_skip
+                out[out_start:out_start + end - start] = np.frombuffer(chunk, np.uint8, end - start, start)
+
+            position += chunk_size
+
+        return max(position - byte_skip, 0) // data.itemsize
+
+    # The total decompressed size is unknown up front, so use data as a ring buffer that always holds the last out_size
+    # bytes seen and rotate it into place at the end
+    for chunk in _iter_decompressed(fh, new_decompobj):
+        chunk_size = len(chunk)
+        start = max(chunk_size - out_size, 0)
+        position += start
+
+        while start < chunk_size:
+            ring_start = position % out_size
+            count = min(chunk_size - start, out_size - ring_start)
+            out[ring_start:ring_start + count] = np.frombuffer(chunk, np.uint8, count, start)
+            start += count
+            position += count
+
+    shift = position % out_size if position >= out_size else 0
+    if shift:
+        # Rotate left by shift in place. Memoryview slice assignment uses memmove for overlapping ranges, so only the
+        # smaller of the two parts needs a temporary copy.
+        buffer = memoryview(out)
+        if shift <= out_size - shift:
+            head = bytes(buffer[:shift])
+            buffer[:out_size - shift] = buffer[shift:]
+            buffer[out_size - shift:] = head
+        else:
+            tail = bytes(buffer[shift:])
+            buffer[out_size - shift:] = buffer[:shift]
+            buffer[:out_size - shift] = tail
+
+    return min(position, out_size) // data.itemsize
+
+
+def _map_in_order(function, iterable, threads, processes=False):
+    """Yield :obj:`function` applied to each item of :obj:`iterable`, computed with a pool of :obj:`threads` threads
+
+    Results are yielded in order. At most two calls per thread are in flight, so only a few items and results are held
+    in memory at once no matter how long :obj:`iterable` is. With :obj:`processes` the pool is a pool of processes,
+    for functions that hold the GIL, and :obj:`function` and the items must be picklable. If there is only one item it
+    is computed right away without starting a pool.
+    """
+
+    iterable = iter(iterable)
+    head = list(itertools.islice(iterable, 2))
+    if len(head) < 2:
+        for item in head:
+            yield function(item)
+        return
+
+    with (ProcessPoolExecutor if processes else ThreadPoolExecutor)(threads) as executor:
+        pending = deque()
+
+        for item in itertools.chain(head, iterable):
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+
+            pending.append(executor.submit(function, item))
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def _iter_text_chunks(fh, chunk_size):
+    """Yield the text in :obj:`fh` in chunks of about :obj:`chunk_size` bytes that end with whitespace"""
+
+    carry = b''
+    while True:
+        text = fh.read(chunk_size)
+        if not text:
+            if carry:
+                yield carry
+            return
+
+        # Cut after the last whitespace so the number it ends is whole, the rest is the start of the next chunk
+        text = carry + text
+        end = max(text.rfind(character) for character in _TEXT_WHITESPACE)
+        if end < 0:
+            carry = text
+            continue
+
+        yield text[:end + 1]
+        carry = text[end + 1:]
+
+
+def _parse_text(text, dtype):
+    """Parse the whitespace separated numbers in :obj:`text`"""
+
+    # numpy parses a string of only whitespace as one number
+    if not text or text.isspace():
+        return np.empty(0, dtype)
+
+    return np.fromstring(text, dtype, sep=' ')
+
+
+def _parse_text_into(fh, dtype, data, threads, scale=None):
+    """Parse the ASCII data in :obj:`fh` as :obj:`dtype` into :obj:`data` a chunk at a time, see :obj:`_TEXT_CHUNKSIZE`
+
+    The values are converted like :meth:`_convert_into` does. Returns the number of values in the file, only the values
+    that fit are stored in :obj:`data`.
+    """
+
+    chunks = _iter_text_chunks(fh, _TEXT_CHUNKSIZE)
+    parse = partial(_parse_text, dtype=dtype)
+
+    return _convert_into(_map_in_order(parse, chunks, threads, processes=True) if threads > 1 else map(parse, chunks),
+                         data, scale)
+
+
+def _iter_values(chunks, dtype, byte_skip=0):
+    """Yield the values in the bytes of :obj:`chunks`, after the first :obj:`byte_skip` bytes, as arrays of :obj:`dtype`
+
+    The bytes of a value split between two chunks are joined. Bytes at the end that do not make up a whole value are
+    dropped.
+    """
+
+    carry = b''
+    for chunk in chunks:
+        if byte_skip >= len(chunk):
+            byte_skip -= len(chunk)
+            continue
+
+        if carry or byte_skip:
+            chunk = carry + chunk[byte_skip:]
+            byte_skip = 0
+
+        count = len(chunk) // dtype.itemsize
+        yield np.frombuffer(chunk, dtype, count)
+        carry = chunk[count * dtype.itemsize:]
+
+
+def _convert_into(values, data, scale=None):
+    """Store the arrays of :obj:`values` one after another in the 1D array :obj:`data`
+
+    Each array is multiplied by :obj:`scale` if it is given and cast to the datatype of :obj:`data`, the same as
+    (values * scale).astype(data.dtype) but without temporaries larger than the array. Returns the number of values,
+    only the values that fit are stored in :obj:`data`.
+    """
+
+    position = 0
+    for chunk in values:
+        out = data[position:position + len(chunk)]
+        if scale is None:
+            np.copyto(out, chunk[:len(out)], casting='unsafe')
+        else:
+            np.multiply(chunk[:len(out)], scale, out=out, casting='unsafe')
+
+        position += len(chunk)
+
+    return position
+
+
+def _decompress_convert_into(fh, new_decompobj, members, dtype, data, byte_skip, threads, scale=None):
+    """Stream the decompressed data from :obj:`fh` as :obj:`dtype` into :obj:`data`, converted like
+    :meth:`_convert_into` does
+
+    Gzip :obj:`members` found by :meth:`_scan_gzip_members` are inflated with :obj:`threads` threads, otherwise the
+    data is decompressed with :obj:`new_decompobj`. :obj:`byte_skip` and the return value are the same as for
+    :meth:`_decompress_into`. A negative :obj:`byte_skip` of a single stream needs a buffer of the unconverted data.
+    """
+
+    if members:
+        def read_members():
+            for offset, member_size, _ in members:
+                fh.seek(offset)
+                yield fh.read(member_size)
+
+        total_size = sum(decompressed_size for _, _, decompressed_size in members)
+        chunks = _map_in_order(partial(zlib.decompress, wbits=zlib.MAX_WBITS | 16), read_members(), threads)
+    elif byte_skip < 0:
+        # Which bytes are the tail is only known at the end of the data, so the tail is decompressed into a buffer of
+        # the file's datatype first, the same way as without a conversion, and converted from there
+        buffer = np.empty(data.size, dtype)
+        data_size = _decompress_into(fh, new_decompobj, buffer, byte_skip)
+        _convert_into([buffer[:data_size]], data, scale)
+
+        return data_size
+    else:
+        chunks = _iter_decompressed(fh, new_decompobj)
+
+    if byte_skip < 0:
+        byte_skip = max(total_size - data.size * dtype.itemsize, 0)
+
+    return _convert_into(_iter_values(chunks, dtype, byte_skip), data, scale)
+
+
+def _scan_gzip_members(fh):
+    """Find the gzip members written by :meth:`_compress_gzip_member` starting at the current position of :obj:`fh`
+
+    Returns a list of (offset, compressed size, decompressed size) tuples, one per member, or :obj:`None` if the data is
+    not made up entirely of such members. The position of :obj:`fh` is left unchanged.
+    """
+
+    start = fh.tell()
+    offset = start
+    members = []
+
+    while True:
+        member_header = fh.read(_GZIP_MEMBER_HEADER.size)
+        if not member_header:
+            break
+
+        if len(member_header) < _GZIP_MEMBER_HEADER.size:
+            members = None
+            break
+
+        fields = _GZIP_MEMBER_HEADER.unpack(member_header)
+        if fields[:4] != _GZIP_MEMBER_FIELDS or fields[7:11] != _GZIP_MEMBER_EXTRA:
+            members = None
+            break
+
+        # The decompressed size is the last field of the gzip trailer
+        member_size = fields[11]
+        fh.seek(offset + member_size - 4)
+        trailer = fh.read(4)
+        if len(trailer) < 4:
+            members = None
+            break
+
+        members.append((offset, member_size, struct.unpack('<I', trailer)[0]))
+        offset += member_size
+        fh.seek(offset)
+
+    fh.seek(start)
+
+    return members or None
+
+
+def _inflate_gzip_members_into(fh, members, data, byte_skip, threads):
+    """Inflate the gzip :obj:`members` found by :meth:`_scan_gzip_members` into :obj:`data` in parallel
+
+    :obj:`byte_skip` and the return value are the same as for :meth:`_decompress_into`. Members that lie entirely in the
+    skipped bytes are not read at all.
+    """
+
+    out = data.view(np.uint8)
+    out_size = out.size
+    total_size = sum(decompressed_size for _, _, decompressed_size in members)
+
+    # The total decompressed size is known from the gzip trailers, so keeping the tail is just another byte skip
+    if byte_skip < 0:
+        byte_skip = max(total_size - out_size, 0)
+
+    def read_members():
+        # File reads happen here, in the calling thread, one member at a time
+        position = 0
+        for offset, member_size, decompressed_size in members:
+            if position + decompressed_size > byte_skip and position < byte_skip + out_size:
+                fh.seek(offset)
+                yield fh.read(member_size), position
+
+            position += decompressed_size
+
+    def inflate(item):
+        member, position = item
+        chunk = zlib.decompress(member, zlib.MAX_WBITS | 16)
+        chunk_size = len(chunk)
+
+        start = max(byte_skip - position, 0)
+        end = min(byte_skip + out_size - position, chunk_size)
+        if start < end:
+            out_start = position + start - byte_skip
+            out[out_start:out_start + end - start] = np.frombuffer(chunk, np.uint8, end - start, start)
+
+    for _ in _map_in_order(inflate, read_members(), threads):
+        pass
+
+    return max(total_size - byte_skip, 0) // data.itemsize
+
+
+def _open_data_file(header, fh, filename, dtype, total_data_points):
+    """Open the data file if it is detached from the header and apply the line skip and byte skip
+
+    Returns the file object, positioned at the first byte of the data, and the byte skip that is still to be applied to
+    the decompressed data. The byte skip is 0 for uncompressed data and negative if the data is at the end of the
+    decompressed data (byte skip of -1). The returned file object must be closed by the caller.
+    """
+
+    # Determine the byte skip, line skip and the data file
+    # These all can be written with or without the space according to the NRRD spec, so we check them both
+    line_skip = header.get('lineskip', header.get('line skip', 0))
+    byte_skip = header.get('byteskip', header.get('byte skip', 0))
+    data_filename = header.get('datafile', header.get('data file', None))
+
+    # If the data file is separate from the header file, then open the data file to read from that instead
+    if data_filename is not None:
+        # If the pathname is relative, then append the current directory from the filename
+        if not os.path.isabs(data_filename):
+            if filename is None:
+                raise NRRDError('Filename parameter must be specified when a relative data file path is given')
+
+            data_filename = os.path.join(os.path.dirname(filename), data_filename)
+
+        # Override the fh parameter with the data filename
+        # Note that this is opened without a "with" block, thus it must be closed manually in all circumstances
+        fh = open(data_filename, 'rb')
+
+    # Skip the number of lines requested when line_skip >= 0
+    # Irrespective of the NRRD file having attached/detached header
+    # Lines are skipped before getting to the beginning of the data
+    if line_skip >= 0:
+        for _ in range(line_skip):
+            fh.readline()
+    else:
+        # Must close the file because if the file was opened above from detached filename, there is no "with" block to
+        # close it for us
+        fh.close()
+
+        raise NRRDError('Invalid lineskip, allowed values are greater than or equal to 0')
+
+    # Skip the requested number of bytes or seek backward
+    if byte_skip < -1:
+        # Must close the file because if the file was opened above from detached filename, there is no "with" block to
+        # close it for us
+        fh.close()
+
+        raise NRRDError('Invalid byteskip, allowed values are greater than or equal to -1')
+    elif header['encoding'] in ['gzip', 'gz', 'bzip2', 'bz2']:
+        # For compressed data the byte skip is applied after decompressing, which is up to the caller
+        if byte_skip == -1:
+            byte_skip = -dtype.itemsize * total_data_points
+    elif byte_skip >= 0:
+        fh.seek(byte_skip, os.SEEK_CUR)
+        byte_skip = 0
+    else:
+        fh.seek(-dtype.itemsize * total_data_points, os.SEEK_END)
+        byte_skip = 0
+
+    return fh, byte_skip
+
+
+def read_data(header, fh=None, filename=None, index_order='F', mmap=False, threads=1, out_dtype=None, scale=None,
+              native=True, out=None):
     """Read data from file into :class:`numpy.ndarray`
 
     The two parameters :obj:`fh` and :obj:`filename` are optional depending on the parameters but it never hurts to
@@ -693,6 +1142,30 @@ def read_data(header, fh=None, filename=None, index_order='F'):
         Specifies the index order of the resulting data array. Either 'C' (C-order) where the dimensions are ordered from
         slowest-varying to fastest-varying (e.g. (z, y, x)), or 'F' (Fortran-order) where the dimensions are ordered
         from fastest-varying to slowest-varying (e.g. (x, y, z)).
+    mmap : :class:`bool`, optional
+        Whether to return a read-only :class:`numpy.memmap` of the data instead of reading it into memory. No data is
+        copied and only the parts of the file that are accessed are paged in. Only supported for raw encoding. Defaults
+        to :obj:`False`
+    threads : :class:`int`, optional
+        Number of threads used to decompress gzip data that was written with multiple threads, see :meth:`write`, and
+        number of worker processes used to parse ASCII data. Other data is always decompressed with one thread.
+        Defaults to 1
+    out_dtype : :class:`numpy.dtype`, optional
+        Datatype of the returned data. The data is converted as it is decoded, a chunk at a time, straight into the
+        returned array, so the data of the file's datatype is never held in memory next to it, except for compressed
+        data with a byte skip of -1 that is not made of gzip members. Not supported with :obj:`mmap`. Defaults to the
+        datatype of the file, or the datatype of the data times :obj:`scale`
+    scale : :class:`float`, optional
+        Factor the data is multiplied by as it is decoded, before it is converted to :obj:`out_dtype`. The result is
+        the same as (data * scale).astype(out_dtype). Not supported with :obj:`mmap`
+    native : :class:`bool`, optional
+        Whether data of the file's datatype is returned in the native byte order, rather than the byte order of the
+        file. Big endian data is byteswapped in place. Ignored with :obj:`mmap` or :obj:`out_dtype`. Defaults to
+        :obj:`True`
+    out : :class:`numpy.ndarray`, optional
+        Array to decode the data into, e.g. an array in shared memory, instead of a new array. Its shape must be the
+        shape of the data in :obj:`index_order` and it must be contiguous in that order. The data is converted to its
+        datatype like with :obj:`out_dtype`. Not supported with :obj:`mmap`
 
     Returns
     -------
@@ -716,71 +1189,88 @@ def read_data(header, fh=None, filename=None, index_order='F'):
         raise NRRDError('Number of elements in sizes does not match dimension. Dimension: %i, len(sizes): %i' % (
             header['dimension'], len(header['sizes'])))
 
-    # Determine the data type from the header
-    dtype = _determine_datatype(header)
-
-    # Determine the byte skip, line skip and the data file
-    # These all can be written with or without the space according to the NRRD spec, so we check them both
-    line_skip = header.get('lineskip', header.get('line skip', 0))
-    byte_skip = header.get('byteskip', header.get('byte skip', 0))
-    data_filename = header.get('datafile', header.get('data file', None))
+    if mmap and header['encoding'] != 'raw':
+        raise NRRDError('Memory-mapping is only supported for raw encoding, not "%s"' % header['encoding'])
 
-    # If the data file is separate from the header file, then open the data file to read from that instead
-    if data_filename is not None:
-        # If the pathname is relative, then append the current directory from the filename
-        if not os.path.isabs(data_filename):
-            if filename is None:
-                raise NRRDError('Filename parameter must be specified when a relative data file path is given')
+    if mmap and (out_dtype is not None or scale is not None or out is not None):
+        raise NRRDError('Memory-mapped data can not be converted')
 
-            data_filename = os.path.join(os.path.dirname(filename), data_filename)
+    # Determine the data type from the header
+    dtype = _determine_datatype(header)
 
-        # Override the fh parameter with the data filename
-        # Note that this is opened without a "with" block, thus it must be closed manually in all circumstances
-        fh = open(data_filename, 'rb')
+    if out is not None:
+        # Decode straight into out, its memory in the order of the file is the 1D array the decoders fill
+        shape = tuple(int(size) for size in header['sizes'])
+        out_flat = out if index_order == 'C' else out.T
+        if out.shape != (shape[::-1] if index_order == 'C' else shape) or not out_flat.flags.c_contiguous:
+            raise NRRDError('out must be an array of shape %s contiguous in %s order'
+                            % (shape[::-1] if index_order == 'C' else shape, index_order))
+        if out_dtype is not None and np.dtype(out_dtype) != out.dtype:
+            raise NRRDError('out_dtype does not match the datatype of out')
+
+        out_flat = out_flat.reshape(-1)
+        out_dtype = out.dtype
+
+    # Data that only needs to be byteswapped is decoded as it is and byteswapped in place afterwards. Any other
+    # conversion happens while decoding, into an array of the converted datatype.
+    if out_dtype is None and scale is None:
+        out_dtype = dtype.newbyteorder('=') if native and not mmap else dtype
+    elif out_dtype is None:
+        out_dtype = np.result_type(dtype.newbyteorder('='), scale)
+    out_dtype = np.dtype(out_dtype)
+
+    byteswap = out is None and scale is None and out_dtype != dtype and out_dtype == dtype.newbyteorder('S')
+    convert = out is not None or (not byteswap and (scale is not None or out_dtype != dtype))
 
     # Get the total number of data points by multiplying the size of each dimension together
     total_data_points = header['sizes'].prod()
 
-    # Skip the number of lines requested when line_skip >= 0
-    # Irrespective of the NRRD file having attached/detached header
-    # Lines are skipped before getting to the beginning of the data
-    if line_skip >= 0:
-        for _ in range(line_skip):
-            fh.readline()
-    else:
-        # Must close the file because if the file was opened above from detached filename, there is no "with" block to
-        # close it for us
-        fh.close()
+    # Open the data file if it is detached and move to the start of the data
+    fh, byte_skip = _open_data_file(header, fh, filename, dtype, total_data_points)
 
-        raise NRRDError('Invalid lineskip, allowed values are greater than or equal to 0')
+    # If a compression encoding is used, then byte skip AFTER decompressing
+    if header['encoding'] == 'raw' and mmap:
+        # The file position is now at the first byte of the data, all skips have been applied above. Map the data from
+        # there rather than reading it, the memmap keeps its own reference to the file so fh can be closed below.
+        data_offset = fh.tell()
+        data_size = (os.fstat(fh.fileno()).st_size - data_offset) // dtype.itemsize
 
-    # Skip the requested number of bytes or seek backward, and then parse the data using NumPy
-    if byte_skip < -1:
-        # Must close the file because if the file was opened above from detached filename, there is no "with" block to
-        # close it for us
-        fh.close()
+        if total_data_points != data_size:
+            fh.close()
 
-        raise NRRDError('Invalid byteskip, allowed values are greater than or equal to -1')
-    elif byte_skip >= 0:
-        fh.seek(byte_skip, os.SEEK_CUR)
-    elif byte_skip == -1 and header['encoding'] not in ['gzip', 'gz', 'bzip2', 'bz2']:
-        fh.seek(-dtype.itemsize * total_data_points, os.SEEK_END)
-    else:
-        # The only case left should be: byte_skip == -1 and header['encoding'] == 'gzip'
-        byte_skip = -dtype.itemsize * total_data_points
+            raise NRRDError('Size of the data does not equal the product of all the dimensions: {0}-{1}={2}'
+                            .format(total_data_points, data_size, total_data_points - data_size))
 
-    # If a compression encoding is used, then byte skip AFTER decompressing
-    if header['encoding'] == 'raw':
+        data = np.memmap(fh, dtype, mode='r', offset=data_offset, shape=(total_data_points,))
+    elif header['encoding'] == 'raw' and convert:
+        # Convert the data a chunk at a time (see _READ_CHUNKSIZE) straight into the output array
+        data = np.empty(total_data_points, out_dtype) if out is None else out_flat
+        data_size = _convert_into(_iter_values(iter(partial(fh.read, _READ_CHUNKSIZE), b''), dtype), data, scale)
+
+        if total_data_points != data_size:
+            fh.close()
+
+            raise NRRDError('Size of the data does not equal the product of all the dimensions: {0}-{1}={2}'
+                            .format(total_data_points, data_size, total_data_points - data_size))
+    elif header['encoding'] == 'raw':
         data = np.fromfile(fh, dtype)
     elif header['encoding'] in ['ASCII', 'ascii', 'text', 'txt']:
-        data = np.fromfile(fh, dtype, sep=' ')
+        # Parse the text straight into the output array a chunk at a time
+        data = np.empty(total_data_points, out_dtype if convert else dtype) if out is None else out_flat
+        data_size = _parse_text_into(fh, dtype, data, threads, scale)
+
+        if total_data_points != data_size:
+            fh.close()
+
+            raise NRRDError('Size of the data does not equal the product of all the dimensions: {0}-{1}={2}'
+                            .format(total_data_points, data_size, total_data_points - data_size))
     else:
         # Handle compressed data now
-        # Construct the decompression object based on encoding
+        # Get the constructor of the decompression object based on encoding
         if header['encoding'] in ['gzip', 'gz']:
-            decompobj = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            new_decompobj = partial(zlib.decompressobj, zlib.MAX_WBITS | 16)
         elif header['encoding'] in ['bzip2', 'bz2']:
-            decompobj = bz2.BZ2Decompressor()
+            new_decompobj = bz2.BZ2Decompressor
         else:
             # Must close the file because if the file was opened above from detached filename, there is no "with" block
             # to close it for us
@@ -788,34 +1278,28 @@ def read_data(header, fh=None, filename=None, index_order='F'):
 
             raise NRRDError('Unsupported encoding: "%s"' % header['encoding'])
 
-        # Loop through the file and read a chunk at a time (see _READ_CHUNKSIZE why it is read in chunks)
-        decompressed_data = bytearray()
+        # Decompress straight into the output array a chunk at a time (see _READ_CHUNKSIZE why it is read in chunks)
+        # rather than reading the whole file and building up the decompressed data separately. Byte skip is applied
+        # AFTER the decompression.
+        data = np.empty(total_data_points, out_dtype if convert else dtype) if out is None else out_flat
 
-        # Read all of the remaining data from the file
-        # Obtain the length of the compressed data since we will be using it repeatedly, more efficient
-        compressed_data = fh.read()
-        compressed_data_len = len(compressed_data)
-        start_index = 0
+        # Gzip data written with multiple threads can also be inflated with multiple threads, one member at a time
+        members = None
+        if threads > 1 and header['encoding'] in ['gzip', 'gz']:
+            members = _scan_gzip_members(fh)
 
-        # Loop through data and decompress it chunk by chunk
-        while start_index < compressed_data_len:
-            # Calculate the end index = start index plus chunk size
-            # Set to the string length to read the remaining chunk at the end
-            end_index = min(start_index + _READ_CHUNKSIZE, compressed_data_len)
-
-            # Decompress and append data
-            decompressed_data += decompobj.decompress(compressed_data[start_index:end_index])
-
-            # Update start index
-            start_index = end_index
+        if convert:
+            data_size = _decompress_convert_into(fh, new_decompobj, members, dtype, data, byte_skip, threads, scale)
+        elif members:
+            data_size = _inflate_gzip_members_into(fh, members, data, byte_skip, threads)
+        else:
+            data_size = _decompress_into(fh, new_decompobj, data, byte_skip)
 
-        # Delete the compressed data since we do not need it anymore
-        # This could potentially be using a lot of memory
-        del compressed_data
+        if total_data_points != data_size:
+            fh.close()
 
-        # Byte skip is applied AFTER the decompression. Skip first x bytes of the decompressed data and parse it using
-        # NumPy
-        data = np.frombuffer(decompressed_data[byte_skip:], dtype)
+            raise NRRDError('Size of the data does not equal the product of all the dimensions: {0}-{1}={2}'
+                            .format(total_data_points, data_size, total_data_points - data_size))
 
     # Close the file, even if opened using "with" block, closing it manually does not hurt
     fh.close()
@@ -824,11 +1308,18 @@ def read_data(header, fh=None, filename=None, index_order='F'):
         raise NRRDError('Size of the data does not equal the product of all the dimensions: {0}-{1}={2}'
                         .format(total_data_points, data.size, total_data_points - data.size))
 
+    if byteswap:
+        data = data.byteswap(inplace=True).view(out_dtype)
+
+    if out is not None:
+        return out
+
     # In the NRRD header, the fields are specified in Fortran order, i.e, the first index is the one that changes
     # fastest and last index changes slowest. This needs to be taken into consideration since numpy uses C-order
     # indexing.
     
     # The array shape from NRRD (x,y,z) needs to be reversed as numpy expects (z,y,x).
+    # Reshaping and transposing only create new views, so a memory-mapped array stays memory-mapped.
     data = np.reshape(data, tuple(header['sizes'][::-1]))
 
     # Transpose data to enable Fortran indexing if requested.
@@ -838,7 +1329,8 @@ def read_data(header, fh=None, filename=None, index_order='F'):
     return data
 
 
-def read(filename, custom_field_map=None, index_order='F'):
+def read(filename, custom_field_map=None, index_order='F', mmap=False, threads=1, out_dtype=None, scale=None,
+         native=True, out=None):
     """Read a NRRD file and return the header and data
 
     See :ref:`user-guide:Reading NRRD files` for more information on reading NRRD files.
@@ -857,6 +1349,20 @@ def read(filename, custom_field_map=None, index_order='F'):
         Specifies the index order of the resulting data array. Either 'C' (C-order) where the dimensions are ordered from
         slowest-varying to fastest-varying (e.g. (z, y, x)), or 'F' (Fortran-order) where the dimensions are ordered
         from fastest-varying to slowest-varying (e.g. (x, y, z)).
+    mmap : :class:`bool`, optional
+        Whether to memory-map the data instead of reading it into memory, see :meth:`read_data`. Only supported for raw
+        encoding. Defaults to :obj:`False`
+    threads : :class:`int`, optional
+        Number of threads used to decompress gzip data that was written with multiple threads and number of worker
+        processes used to parse ASCII data, see :meth:`read_data`. Defaults to 1
+    out_dtype : :class:`numpy.dtype`, optional
+        Datatype to convert the data to as it is decoded, see :meth:`read_data`. Defaults to the datatype of the file
+    scale : :class:`float`, optional
+        Factor to multiply the data by as it is decoded, see :meth:`read_data`
+    native : :class:`bool`, optional
+        Whether to return the data in the native byte order, see :meth:`read_data`. Defaults to :obj:`True`
+    out : :class:`numpy.ndarray`, optional
+        Array to decode the data into instead of a new array, see :meth:`read_data`
 
     Returns
     -------
@@ -873,63 +1379,690 @@ def read(filename, custom_field_map=None, index_order='F'):
     """Read a NRRD file and return a tuple (data, header)."""
     with open(filename, 'rb') as fh:
         header = read_header(fh, custom_field_map)
-        data = read_data(header, fh, filename, index_order)
+        data = read_data(header, fh, filename, index_order, mmap, threads, out_dtype, scale, native, out)
 
     return data, header
 
-# Older versions of Python had issues when uncompressed data was larger than 4GB (2^32). This should be fixed in latest
-# version of Python 2.7 and all versions of Python 3. The fix for this issue is to read the data in smaller chunks. The
-# chunk size is set to be small here at 1MB since performance did not vary much based on the chunk size. A smaller chunk
-# size has the benefit of using less RAM at once.
-_WRITE_CHUNKSIZE = 2 ** 20
 
-_NRRD_FIELD_ORDER = [
-    'type',
-    'dimension',
-    'space dimension',
-    'space',
-    'sizes',
-    'space directions',
-    'kinds',
-    'endian',
-    'encoding',
-    'min',
-    'max',
-    'oldmin',
-    'old min',
-    'oldmax',
-    'old max',
-    'content',
-    'sample units',
-    'spacings',
-    'thicknesses',
-    'axis mins',
-    'axismins',
-    'axis maxs',
-    'axismaxs',
-    'centerings',
-    'labels',
-    'units',
-    'space units',
-    'space origin',
-    'measurement frame',
-    'data file']
+class _ZStream(ctypes.Structure):
+    """z_stream structure of the zlib C library"""
 
-_TYPEMAP_NUMPY2NRRD = {
-    'i1': 'int8',
-    'u1': 'uint8',
-    'i2': 'int16',
-    'u2': 'uint16',
-    'i4': 'int32',
-    'u4': 'uint32',
-    'i8': 'int64',
-    'u8': 'uint64',
-    'f4': 'float',
-    'f8': 'double',
-    'V': 'block'
-}
+    _fields_ = [('next_in', ctypes.c_void_p),
+                ('avail_in', ctypes.c_uint),
+                ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p),
+                ('avail_out', ctypes.c_uint),
+                ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p),
+                ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p),
+                ('zfree', ctypes.c_void_p),
+                ('opaque', ctypes.c_void_p),
+                ('data_type', ctypes.c_int),
+                ('adler', ctypes.c_ulong),
+                ('reserved', ctypes.c_ulong)]
 
-_NUMPY2NRRD_ENDIAN_MAP = {
+
+def _load_libz():
+    """Load the zlib C library with ctypes, or return :obj:`None` if it can not be found
+
+    Python's zlib module does not expose the Z_BLOCK mode of inflate, which is needed to find the DEFLATE block
+    boundaries where decompression can be resumed. Reading with an index only needs Python's zlib module.
+    """
+
+    for name in ['z', 'zlib1', 'zlib']:
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+
+        try:
+            libz = ctypes.CDLL(path)
+        except OSError:
+            continue
+
+        libz.zlibVersion.restype = ctypes.c_char_p
+        libz.inflateInit2_.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        libz.inflate.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_int]
+        libz.inflateReset.argtypes = [ctypes.POINTER(_ZStream)]
+        libz.inflateEnd.argtypes = [ctypes.POINTER(_ZStream)]
+        return libz
+
+    return None
+
+
+def _gzip_index_filename(data_filename):
+    return data_filename + '.gzidx'
+
+
+def _build_gzip_checkpoints(fh, spacing):
+    """Find points to resume decompressing the gzip data in :obj:`fh` from, roughly every :obj:`spacing` bytes of
+    decompressed data, starting at the current position of :obj:`fh`
+
+    This is the approach of zran.c from the zlib distribution. Decompression can be resumed at the boundary of any
+    DEFLATE block given the bit offset of the boundary and the last 32KB of decompressed data before it.
+
+    Returns the points, as checkpoints of :class:`NrrdVolume`, and the total size of the decompressed data.
+    """
+
+    libz = _load_libz()
+    if libz is None:
+        raise NRRDError('Building a gzip index requires the zlib C library, which could not be found')
+
+    data_offset = fh.tell()
+    version = libz.zlibVersion()
+    stream = _ZStream()
+    if libz.inflateInit2_(ctypes.byref(stream), zlib.MAX_WBITS | 16, version, ctypes.sizeof(stream)) != _Z_OK:
+        raise NRRDError('Could not initialize the zlib C library')
+
+    out_buffer = ctypes.create_string_buffer(_DEFLATE_WINDOW_SIZE * 2)
+    in_buffer = None
+    window = bytearray()
+    total_in = total_out = 0
+    checkpoints = [(0, data_offset, None)]
+
+    try:
+        while True:
+            if not stream.avail_in:
+                compressed_data = fh.read(_READ_CHUNKSIZE)
+                if not compressed_data:
+                    break
+
+                in_buffer = ctypes.create_string_buffer(compressed_data, len(compressed_data))
+                stream.next_in = ctypes.addressof(in_buffer)
+                stream.avail_in = len(compressed_data)
+
+            stream.next_out = ctypes.addressof(out_buffer)
+            stream.avail_out = len(out_buffer)
+            avail_in = stream.avail_in
+
+            # Z_BLOCK makes inflate return at the end of each DEFLATE block as well as when the output is full
+            ret = libz.inflate(ctypes.byref(stream), _Z_BLOCK)
+            if ret not in [_Z_OK, _Z_STREAM_END, _Z_BUF_ERROR]:
+                raise NRRDError('Error while decompressing gzip data: %s'
+                                % (stream.msg.decode('ascii', 'ignore') if stream.msg else ret))
+
+            total_in += avail_in - stream.avail_in
+            out_size = len(out_buffer) - stream.avail_out
+            total_out += out_size
+
+            window += ctypes.string_at(out_buffer, out_size)
+            del window[:-_DEFLATE_WINDOW_SIZE]
+
+            if ret == _Z_STREAM_END:
+                # Another gzip member may follow. It starts without a window, so its start is a point as well.
+                remaining_data = ctypes.string_at(stream.next_in, stream.avail_in)
+                if len(remaining_data) < 2:
+                    remaining_data += fh.read(_READ_CHUNKSIZE)
+
+                if remaining_data[:2] != b'\x1f\x8b':
+                    break
+
+                in_buffer = ctypes.create_string_buffer(remaining_data, len(remaining_data))
+                stream.next_in = ctypes.addressof(in_buffer)
+                stream.avail_in = len(remaining_data)
+                libz.inflateReset(ctypes.byref(stream))
+
+                checkpoints.append((total_out, data_offset + total_in, None))
+                window = bytearray()
+                continue
+
+            # Bit 128 of data_type is set at the end of a block, bit 64 if it was the last block of the member and the
+            # low 3 bits are the number of unused bits in the last byte read
+            if stream.data_type & 128 and not stream.data_type & 64 and \
+                    total_out - checkpoints[-1][0] >= spacing:
+                checkpoints.append((total_out, data_offset + total_in, (stream.data_type & 7, bytes(window))))
+    finally:
+        libz.inflateEnd(ctypes.byref(stream))
+
+    return checkpoints, total_out
+
+
+def _iter_realigned(fh, offset, bits):
+    """Yield the data in :obj:`fh` starting :obj:`bits` bits before :obj:`offset`, shifted to start on a byte boundary
+
+    DEFLATE blocks do not have to start on a byte boundary. Python's zlib module can not be given the leftover bits of
+    the previous byte, so the whole stream is shifted instead.
+    """
+
+    if not bits:
+        fh.seek(offset)
+        compressed_data = fh.read(_READ_CHUNKSIZE)
+        while compressed_data:
+            yield compressed_data
+            compressed_data = fh.read(_READ_CHUNKSIZE)
+
+        return
+
+    # The unused bits are the high bits of the byte before offset, as DEFLATE packs bits starting at the lowest bit
+    fh.seek(offset - 1)
+    carry = ord(fh.read(1))
+    shift = 8 - bits
+
+    while True:
+        compressed_data = fh.read(_READ_CHUNKSIZE)
+        if not compressed_data:
+            yield bytes([carry >> shift])
+            return
+
+        data = np.frombuffer(compressed_data, np.uint8)
+        previous = np.empty_like(data)
+        previous[0] = carry
+        previous[1:] = data[:-1]
+
+        yield ((previous >> shift) | (data << bits)).astype(np.uint8).tobytes()
+        carry = data[-1]
+
+
+def _write_gzip_index(data_filename, data_offset, checkpoints, stream_size):
+    """Write the sidecar index of :obj:`data_filename`, see :meth:`build_gzip_index`"""
+
+    index_filename = _gzip_index_filename(data_filename)
+    stat = os.stat(data_filename)
+
+    # Write to a temporary file first so that a reader never sees a partially written index
+    temp_filename = '%s.%i.tmp' % (index_filename, os.getpid())
+    with open(temp_filename, 'wb') as fh:
+        fh.write(_GZIP_INDEX_MAGIC)
+        fh.write(_GZIP_INDEX_HEADER.pack(stat.st_size, stat.st_mtime_ns, data_offset, stream_size, len(checkpoints)))
+
+        for position, offset, state in checkpoints:
+            bits, window = state if state is not None else (-1, b'')
+            window = zlib.compress(window) if window else b''
+            fh.write(_GZIP_INDEX_POINT.pack(position, offset, bits, len(window)))
+            fh.write(window)
+
+    os.replace(temp_filename, index_filename)
+
+    return index_filename
+
+
+def _read_gzip_index(data_filename, data_offset):
+    """Read the sidecar index of :obj:`data_filename`
+
+    Returns the checkpoints and the decompressed size, or :obj:`None` if there is no index or it is out of date.
+    """
+
+    index_filename = _gzip_index_filename(data_filename)
+    if not os.path.exists(index_filename):
+        return None
+
+    stat = os.stat(data_filename)
+
+    with open(index_filename, 'rb') as fh:
+        if fh.read(len(_GZIP_INDEX_MAGIC)) != _GZIP_INDEX_MAGIC:
+            return None
+
+        file_size, mtime, index_data_offset, stream_size, count = \
+            _GZIP_INDEX_HEADER.unpack(fh.read(_GZIP_INDEX_HEADER.size))
+        if (file_size, mtime, index_data_offset) != (stat.st_size, stat.st_mtime_ns, data_offset):
+            return None
+
+        checkpoints = []
+        for _ in range(count):
+            position, offset, bits, window_size = _GZIP_INDEX_POINT.unpack(fh.read(_GZIP_INDEX_POINT.size))
+            window = fh.read(window_size)
+
+            if bits < 0:
+                checkpoints.append((position, offset, None))
+            else:
+                checkpoints.append((position, offset, (bits, zlib.decompress(window) if window else b'')))
+
+    return checkpoints, stream_size
+
+
+def build_gzip_index(filename, spacing=_CHECKPOINT_INTERVAL, custom_field_map=None):
+    """Build a random access index for the gzip encoded data of a NRRD file
+
+    Reading a region of gzip data normally means decompressing everything before it. The index records points every
+    :obj:`spacing` bytes of decompressed data where decompression can be resumed, so :class:`NrrdVolume` only has to
+    decompress from the nearest point before the region. The data itself is not changed.
+
+    The index is saved next to the data file with an added .gzidx extension and is ignored once the data file changes.
+    Building it requires the zlib C library to be loadable with :mod:`ctypes`, reading with it does not.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Filename of the NRRD file
+    spacing : :class:`int`, optional
+        Number of decompressed bytes between points. Smaller values make reads faster and the index larger, each point
+        takes up to 32KB.
+    custom_field_map : :class:`dict` (:class:`str`, :class:`str`), optional
+        Dictionary used for parsing custom field types where the key is the custom field name and the value is a
+        string identifying datatype for the custom field.
+
+    Returns
+    -------
+    index_filename : :class:`str`
+        Filename of the index
+
+    See Also
+    --------
+    :class:`NrrdVolume`
+    """
+
+    with open(filename, 'rb') as fh:
+        header = read_header(fh, custom_field_map)
+
+        if header.get('encoding') not in ['gzip', 'gz']:
+            raise NRRDError('Only gzip encoded data can be indexed, not "%s"' % header.get('encoding'))
+
+        data_fh, _ = _open_data_file(header, fh, filename, _determine_datatype(header), header['sizes'].prod())
+
+        try:
+            data_filename = data_fh.name
+            data_offset = data_fh.tell()
+            checkpoints, stream_size = _build_gzip_checkpoints(data_fh, spacing)
+        finally:
+            if data_fh is not fh:
+                data_fh.close()
+
+    return _write_gzip_index(data_filename, data_offset, checkpoints, stream_size)
+
+
+
+class NrrdVolume(object):
+    """NRRD file whose data is read on demand, one region at a time
+
+    Only the header is read when the volume is created. Indexing the volume with the same syntax as a
+    :class:`numpy.ndarray`, e.g. ``volume[:, 40:60, :, 30]``, reads just the data that the region needs and returns
+    it as a new :class:`numpy.ndarray`.
+
+    How the region is read depends on the encoding. Raw data is memory-mapped, see :meth:`read_data`, so only the
+    requested bytes are read from disk. Compressed data is decompressed up to the end of the slab along the slowest
+    axis that holds the region. For gzip the decompressor state is saved at regular intervals (see
+    :obj:`_CHECKPOINT_INTERVAL`), and at each member written by :meth:`write` with multiple threads, so that later reads
+    start from the nearest saved state. If the gzip data has an index from :meth:`build_gzip_index`, its points are used
+    from the start. ASCII data cannot be read partially and is read in full on first access.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Filename of the NRRD file
+    custom_field_map : :class:`dict` (:class:`str`, :class:`str`), optional
+        Dictionary used for parsing custom field types where the key is the custom field name and the value is a
+        string identifying datatype for the custom field.
+    index_order : {'C', 'F'}, optional
+        Specifies the index order used for indexing the volume, see :meth:`read`.
+    gzip_index : :class:`bool`, optional
+        Whether to build and save the index of gzip data with :meth:`build_gzip_index` on the first read if it does not
+        have one yet. Defaults to :obj:`False`
+
+    Attributes
+    ----------
+    header : :class:`dict` (:class:`str`, :obj:`Object`)
+        Dictionary containing the header fields and their corresponding parsed value
+    shape : :class:`tuple` of :class:`int`
+        Shape of the volume in the requested index order
+    dtype : :class:`numpy.dtype`
+        Datatype of the volume
+
+    See Also
+    --------
+    :meth:`read`, :meth:`read_header`, :meth:`read_data`
+    """
+
+    def __init__(self, filename, custom_field_map=None, index_order='F', gzip_index=False):
+        if index_order not in ['F', 'C']:
+            raise NRRDError('Invalid index order')
+
+        self.filename = filename
+        self.index_order = index_order
+
+        with open(filename, 'rb') as fh:
+            self.header = read_header(fh, custom_field_map)
+
+            for field in _NRRD_REQUIRED_FIELDS:
+                if field not in self.header:
+                    raise NRRDError('Header is missing required field: "%s".' % field)
+
+            if self.header['dimension'] != len(self.header['sizes']):
+                raise NRRDError('Number of elements in sizes does not match dimension. Dimension: %i, len(sizes): %i'
+                                % (self.header['dimension'], len(self.header['sizes'])))
+
+            self.dtype = _determine_datatype(self.header)
+            sizes = tuple(int(size) for size in self.header['sizes'])
+            self.shape = sizes if index_order == 'F' else sizes[::-1]
+
+            self._encoding = self.header['encoding']
+            self._data = None
+            self._build_index = False
+
+            if self._encoding == 'raw':
+                self._data = read_data(self.header, fh, filename, index_order, mmap=True)
+                return
+            elif self._encoding in ['ASCII', 'ascii', 'text', 'txt']:
+                return
+            elif self._encoding not in ['gzip', 'gz', 'bzip2', 'bz2']:
+                raise NRRDError('Unsupported encoding: "%s"' % self._encoding)
+
+            # For compressed data remember where the data starts so that it can be decompressed later. The data file
+            # must be closed here if it is detached, otherwise it is fh and is closed by the with block.
+            data_fh, self._byte_skip = _open_data_file(self.header, fh, filename, self.dtype,
+                                                       int(np.prod(sizes, dtype=np.int64)))
+
+            try:
+                self._data_filename = data_fh.name
+                self._data_offset = data_fh.tell()
+
+                # Checkpoints are (decompressed position, file offset, decompressor state) tuples, sorted by position.
+                # A state of None is the start of a gzip member, where a new decompressor is used.
+                self._checkpoints = [(0, self._data_offset, None)]
+                self._stream_size = None
+
+                members = _scan_gzip_members(data_fh) if self._encoding in ['gzip', 'gz'] else None
+                if members:
+                    position = 0
+                    self._checkpoints = []
+                    for offset, _, decompressed_size in members:
+                        self._checkpoints.append((position, offset, None))
+                        position += decompressed_size
+
+                    self._stream_size = position
+                elif self._encoding in ['gzip', 'gz']:
+                    index = _read_gzip_index(self._data_filename, self._data_offset)
+                    if index is not None:
+                        self._checkpoints, self._stream_size = index
+
+                    self._build_index = gzip_index and index is None
+            finally:
+                if data_fh is not fh:
+                    data_fh.close()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if self._encoding in ['ASCII', 'ascii', 'text', 'txt'] and self._data is None:
+            self._data = read(self.filename, index_order=self.index_order)[0]
+
+        if self._data is not None:
+            region = self._data[key]
+            return np.array(region) if isinstance(region, np.ndarray) else region
+
+        key = self._expand_key(key)
+        axis = self.ndim - 1 if self.index_order == 'F' else 0
+
+        # A multidimensional boolean array covers several axes at once, so read all of the data
+        if len(key) != self.ndim:
+            return self._read_slab(0, self.shape[axis])[key]
+
+        # Find the range of the slowest axis that the region lies in and read that slab of the data. The key along that
+        # axis is then shifted to index into the slab instead of the whole volume.
+        start, stop, axis_key = self._slab_range(key[axis], self.shape[axis])
+        slab = self._read_slab(start, stop)
+
+        return slab[key[:axis] + (axis_key,) + key[axis + 1:]]
+
+    def _expand_key(self, key):
+        """Return :obj:`key` as a tuple with one entry per axis, replacing any Ellipsis"""
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if any(item is None for item in key):
+            raise IndexError('NrrdVolume does not support adding new axes')
+
+        ellipsis_indices = [index for index, item in enumerate(key) if item is Ellipsis]
+        if len(ellipsis_indices) > 1:
+            raise IndexError('An index can only have a single ellipsis (\'...\')')
+
+        # Boolean arrays index as many axes as they have dimensions
+        key_ndim = sum(np.ndim(item) if isinstance(item, np.ndarray) and item.dtype == bool else 1
+                       for item in key if item is not Ellipsis)
+        if key_ndim > self.ndim:
+            raise IndexError('Too many indices for volume: volume is %i-dimensional, but %i were indexed'
+                             % (self.ndim, key_ndim))
+
+        padding = (slice(None),) * (self.ndim - key_ndim)
+        if ellipsis_indices:
+            index = ellipsis_indices[0]
+            return key[:index] + padding + key[index + 1:]
+
+        return key + padding
+
+    @staticmethod
+    def _slab_range(axis_key, size):
+        """Return the start and stop of the range that :obj:`axis_key` selects on an axis of :obj:`size` elements and
+        the key shifted to index into that range"""
+
+        if isinstance(axis_key, slice):
+            start, stop, step = axis_key.indices(size)
+            indices = range(start, stop, step)
+            if not indices:
+                return 0, 0, slice(0, 0)
+
+            first, last = min(indices), max(indices)
+            shifted_stop = stop - first if stop - first >= 0 else None
+            return first, last + 1, slice(start - first, shifted_stop, step)
+
+        if isinstance(axis_key, (numbers.Integral, np.integer)):
+            index = int(axis_key)
+            if not -size <= index < size:
+                raise IndexError('Index %i is out of bounds for axis with size %i' % (index, size))
+
+            index %= size
+            return index, index + 1, 0
+
+        indices = np.asarray(axis_key)
+        if indices.dtype == bool:
+            if indices.shape != (size,):
+                raise IndexError('Boolean index has wrong length: %i instead of %i' % (indices.size, size))
+
+            indices = np.nonzero(indices)[0]
+        elif not np.issubdtype(indices.dtype, np.integer):
+            raise IndexError('Only integers, slices, ellipsis and integer or boolean arrays are valid indices')
+
+        if indices.size == 0:
+            return 0, 0, indices
+
+        if indices.min() < -size or indices.max() >= size:
+            raise IndexError('Index is out of bounds for axis with size %i' % size)
+
+        indices = indices % size
+        first = int(indices.min())
+        return first, int(indices.max()) + 1, indices - first
+
+    def _read_slab(self, start, stop):
+        """Read indices [start, stop) of the slowest axis into an array in the requested index order"""
+
+        sizes = self.header['sizes']
+        slab_size = int(np.prod(sizes[:-1], dtype=np.int64)) * self.dtype.itemsize
+
+        slab = np.empty((stop - start,) + tuple(int(size) for size in sizes[-2::-1]), self.dtype)
+        if slab.size:
+            self._decompress_range(start * slab_size, stop * slab_size, slab.view(np.uint8).reshape(-1))
+
+        return slab.T if self.index_order == 'F' else slab
+
+    def _decompress_range(self, start, stop, out):
+        """Decompress bytes [start, stop) of the data, after the byte skip, into :obj:`out`"""
+
+        if self._build_index:
+            self._build_index = False
+
+            with open(self._data_filename, 'rb') as fh:
+                fh.seek(self._data_offset)
+
+                try:
+                    self._checkpoints, self._stream_size = _build_gzip_checkpoints(fh, _CHECKPOINT_INTERVAL)
+                except NRRDError as e:
+                    warnings.warn('Could not build gzip index: %s' % e)
+                else:
+                    _write_gzip_index(self._data_filename, self._data_offset, self._checkpoints, self._stream_size)
+
+        byte_skip = self._byte_skip
+        if byte_skip < 0:
+            # The data is at the end of the decompressed data, whose size is only known after decompressing it once
+            if self._stream_size is None:
+                self._decompress_stream(0, 0, out)
+
+            byte_skip = max(self._stream_size + byte_skip, 0)
+
+        position = self._decompress_stream(byte_skip + start, byte_skip + stop, out)
+        if position < byte_skip + stop:
+            total_data_points = self.header['sizes'].prod()
+            data_size = (position - byte_skip) // self.dtype.itemsize
+            raise NRRDError('Size of the data does not equal the product of all the dimensions: {0}-{1}={2}'
+                            .format(total_data_points, data_size, total_data_points - data_size))
+
+    def _decompress_stream(self, start, stop, out):
+        """Copy bytes [start, stop) of the decompressed data into :obj:`out`
+
+        An empty range decompresses the whole stream to find its size. Returns the position in the decompressed data
+        that decompression stopped at, which is less than :obj:`stop` if the data ends early.
+        """
+
+        find_size = start == stop
+        is_gzip = self._encoding in ['gzip', 'gz']
+
+        if is_gzip:
+            new_decompobj = partial(zlib.decompressobj, zlib.MAX_WBITS | 16)
+        else:
+            new_decompobj = bz2.BZ2Decompressor
+
+        # A bzip2 decompressor can not be copied, so bzip2 data is always decompressed from the start
+        index = bisect.bisect_right([checkpoint[0] for checkpoint in self._checkpoints], start) - 1
+        position, offset, decompobj = self._checkpoints[index] if is_gzip else self._checkpoints[0]
+
+        with open(self._data_filename, 'rb') as fh:
+            # Points from a gzip index resume a raw DEFLATE stream from its window, possibly in the middle of a byte
+            realigned_data = None
+            if isinstance(decompobj, tuple):
+                bits, window = decompobj
+                decompobj = zlib.decompressobj(-zlib.MAX_WBITS, zdict=window)
+                realigned_data = _iter_realigned(fh, offset, bits)
+            else:
+                decompobj = decompobj.copy() if decompobj is not None else new_decompobj()
+                fh.seek(offset)
+
+            while find_size or position < stop:
+                # Same loop as in _iter_decompressed, but keeping track of the file offset for the checkpoints
+                if decompobj.eof and realigned_data is not None:
+                    # The gzip trailer follows the raw DEFLATE stream, continue at the next member if there is one
+                    next_members = [checkpoint[1] for checkpoint in self._checkpoints
+                                    if checkpoint[0] == position and checkpoint[2] is None]
+                    if not next_members:
+                        break
+
+                    offset = next_members[0]
+                    fh.seek(offset)
+                    realigned_data = None
+                    decompobj = new_decompobj()
+                    continue
+                elif decompobj.eof:
+                    compressed_data = decompobj.unused_data
+                    if len(compressed_data) < 3:
+                        more_data = fh.read(_READ_CHUNKSIZE)
+                        offset += len(more_data)
+                        compressed_data += more_data
+
+                    if compressed_data[:2] != b'\x1f\x8b' and compressed_data[:3] != b'BZh':
+                        break
+
+                    decompobj = new_decompobj()
+                elif realigned_data is not None:
+                    compressed_data = decompobj.unconsumed_tail or next(realigned_data, b'')
+                elif is_gzip:
+                    compressed_data = decompobj.unconsumed_tail
+                    if not compressed_data:
+                        compressed_data = fh.read(_READ_CHUNKSIZE)
+                        offset += len(compressed_data)
+                else:
+                    compressed_data = fh.read(_READ_CHUNKSIZE) if decompobj.needs_input else b''
+
+                chunk = decompobj.decompress(compressed_data, _READ_CHUNKSIZE)
+                if not compressed_data and not chunk:
+                    break
+
+                chunk_size = len(chunk)
+                chunk_start = max(start - position, 0)
+                chunk_end = min(stop - position, chunk_size)
+                if chunk_start < chunk_end:
+                    out_start = position + chunk_start - start
+                    out[out_start:out_start + chunk_end - chunk_start] = np.frombuffer(chunk, np.uint8,
+                                                                                       chunk_end - chunk_start,
+                                                                                       chunk_start)
+
+                position += chunk_size
+
+                # Only save the state once all compressed data read so far has been consumed. The copy then resumes
+                # reading from the file at offset, and does not keep a reference to any unconsumed data. Offsets in
+                # realigned data do not match the file, but those reads start from an index that has points anyway.
+                if is_gzip and realigned_data is None and \
+                        position >= self._checkpoints[-1][0] + _CHECKPOINT_INTERVAL:
+                    if decompobj.eof:
+                        self._checkpoints.append((position, offset - len(decompobj.unused_data), None))
+                    elif not decompobj.unconsumed_tail:
+                        self._checkpoints.append((position, offset, decompobj.copy()))
+
+        if find_size:
+            self._stream_size = position
+
+        return position
+
+
+# Older versions of Python had issues when uncompressed data was larger than 4GB (2^32). This should be fixed in latest
+# version of Python 2.7 and all versions of Python 3. The fix for this issue is to read the data in smaller chunks. The
+# chunk size is set to be small here at 1MB since performance did not vary much based on the chunk size. A smaller chunk
+# size has the benefit of using less RAM at once.
+_WRITE_CHUNKSIZE = 2 ** 20
+
+# Amount of uncompressed data in each gzip member when compressing with multiple threads. Larger members compress
+# slightly better, smaller ones give more parallelism on small volumes.
+_GZIP_MEMBER_SIZE = 2 ** 22
+
+_NRRD_FIELD_ORDER = [
+    'type',
+    'dimension',
+    'space dimension',
+    'space',
+    'sizes',
+    'space directions',
+    'kinds',
+    'endian',
+    'encoding',
+    'min',
+    'max',
+    'oldmin',
+    'old min',
+    'oldmax',
+    'old max',
+    'content',
+    'sample units',
+    'spacings',
+    'thicknesses',
+    'axis mins',
+    'axismins',
+    'axis maxs',
+    'axismaxs',
+    'centerings',
+    'labels',
+    'units',
+    'space units',
+    'space origin',
+    'measurement frame',
+    'data file']
+
+_TYPEMAP_NUMPY2NRRD = {
+    'i1': 'int8',
+    'u1': 'uint8',
+    'i2': 'int16',
+    'u2': 'uint16',
+    'i4': 'int32',
+    'u4': 'uint32',
+    'i8': 'int64',
+    'u8': 'uint64',
+    'f4': 'float',
+    'f8': 'double',
+    'V': 'block'
+}
+
+_NUMPY2NRRD_ENDIAN_MAP = {
     '<': 'little',
     'L': 'little',
     '>': 'big',
@@ -963,8 +2096,131 @@ def _format_field_value(value, field_type):
         raise NRRDError('Invalid field type given: %s' % field_type)
 
 
+def _prepare_header(header, dtype, sizes):
+    """Add the fields generated from the datatype and sizes of the data to :obj:`header`, see :meth:`write`"""
+
+    # Infer a number of fields from the NumPy array and overwrite values in the header dictionary.
+    # Get type string identifier from the NumPy datatype
+    header['type'] = _TYPEMAP_NUMPY2NRRD[dtype.str[1:]]
+
+    # If the datatype contains more than one byte and the encoding is not ASCII, then set the endian header value
+    # based on the datatype's endianness. Otherwise, delete the endian field from the header if present
+    if dtype.itemsize > 1 and header.get('encoding', '').lower() not in ['ascii', 'text', 'txt']:
+        header['endian'] = _NUMPY2NRRD_ENDIAN_MAP[dtype.str[:1]]
+    elif 'endian' in header:
+        del header['endian']
+
+    # If space is specified in the header, then space dimension can not. See
+    # http://teem.sourceforge.net/nrrd/format.html#space
+    if 'space' in header.keys() and 'space dimension' in header.keys():
+        del header['space dimension']
+
+    # Update the dimension and sizes fields in the header based on the data
+    header['dimension'] = len(sizes)
+    header['sizes'] = list(sizes)
+
+    # The default encoding is 'gzip'
+    if 'encoding' not in header:
+        header['encoding'] = 'gzip'
+
+
+def _data_filename(filename, header, detached_header, relative_data_path):
+    """Filenames of the header and the data and whether the header is detached, see :meth:`write`
+
+    Adds the 'data file' field to :obj:`header` if the header is detached.
+    """
+
+    # A bit of magic in handling options here.
+    # If *.nhdr filename provided, this overrides `detached_header=False`
+    # If *.nrrd filename provided AND detached_header=True, separate header and data files written.
+    # If detached_header=True and data file is present, then write the files separately
+    # For all other cases, header & data written to same file.
+    if filename.endswith('.nhdr'):
+        detached_header = True
+
+        if 'data file' not in header:
+            # Get the base filename without the extension
+            base_filename = os.path.splitext(filename)[0]
+
+            # Get the appropriate data filename based on encoding, see here for information on the standard detached
+            # filename: http://teem.sourceforge.net/nrrd/format.html#encoding
+            if header['encoding'] == 'raw':
+                data_filename = '%s.raw' % base_filename
+            elif header['encoding'] in ['ASCII', 'ascii', 'text', 'txt']:
+                data_filename = '%s.txt' % base_filename
+            elif header['encoding'] in ['gzip', 'gz']:
+                data_filename = '%s.raw.gz' % base_filename
+            elif header['encoding'] in ['bzip2', 'bz2']:
+                data_filename = '%s.raw.bz2' % base_filename
+            else:
+                raise NRRDError('Invalid encoding specification while writing NRRD file: %s' % header['encoding'])
+
+            header['data file'] = os.path.basename(data_filename) \
+                if relative_data_path else os.path.abspath(data_filename)
+        else:
+            # TODO This will cause issues for relative data files because it will not save in the correct spot
+            data_filename = header['data file']
+    elif filename.endswith('.nrrd') and detached_header:
+        data_filename = filename
+        header['data file'] = os.path.basename(data_filename) \
+            if relative_data_path else os.path.abspath(data_filename)
+        filename = '%s.nhdr' % os.path.splitext(filename)[0]
+    else:
+        # Write header & data as one file
+        data_filename = filename
+        detached_header = False
+
+    return filename, data_filename, detached_header
+
+
+def _write_header(fh, header, custom_field_map=None):
+    """Write the magic line, the fields of :obj:`header` and the blank line that ends the header to :obj:`fh`"""
+
+    fh.write(b'NRRD0005\n')
+    fh.write(b'# This NRRD file was generated by pynrrd\n')
+    fh.write(b'# on ' + datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S').encode('ascii') + b'(GMT).\n')
+    fh.write(b'# Complete NRRD file format specification at:\n')
+    fh.write(b'# http://teem.sourceforge.net/nrrd/format.html\n')
+
+    # Copy the options since dictionaries are mutable when passed as an argument
+    # Thus, to prevent changes to the actual options, a copy is made
+    # Empty ordered_options list is made (will be converted into dictionary)
+    local_options = header.copy()
+    ordered_options = []
+
+    # Loop through field order and add the key/value if present
+    # Remove the key/value from the local options so that we know not to add it again
+    for field in _NRRD_FIELD_ORDER:
+        if field in local_options:
+            ordered_options.append((field, local_options[field]))
+            del local_options[field]
+
+    # Leftover items are assumed to be the custom field/value options
+    # So get current size and any items past this index will be a custom value
+    custom_field_start_index = len(ordered_options)
+
+    # Add the leftover items to the end of the list and convert the options into a dictionary
+    ordered_options.extend(local_options.items())
+    ordered_options = OrderedDict(ordered_options)
+
+    for x, (field, value) in enumerate(ordered_options.items()):
+        # Get the field_type based on field and then get corresponding
+        # value as a str using _format_field_value
+        field_type = _get_field_type(field, custom_field_map)
+        value_str = _format_field_value(value, field_type)
+
+        # Custom fields are written as key/value pairs with a := instead of : delimeter
+        if x >= custom_field_start_index:
+            fh.write(('%s:=%s\n' % (field, value_str)).encode('ascii'))
+        else:
+            fh.write(('%s: %s\n' % (field, value_str)).encode('ascii'))
+
+    # Write the closing extra newline
+    fh.write(b'\n')
+
+
 def write(filename, data, header=None, detached_header=False, relative_data_path=True, custom_field_map=None,
-          compression_level=9, index_order='F'):
+          compression_level=9, index_order='F', threads=1):
     """Write :class:`numpy.ndarray` to NRRD file
 
     The :obj:`filename` parameter specifies the absolute or relative filename to write the NRRD file to. If the
@@ -1013,179 +2269,336 @@ def write(filename, data, header=None, detached_header=False, relative_data_path
         Specifies the index order used for writing. Either 'C' (C-order) where the dimensions are ordered from
         slowest-varying to fastest-varying (e.g. (z, y, x)), or 'F' (Fortran-order) where the dimensions are ordered
         from fastest-varying to slowest-varying (e.g. (x, y, z)).
+    threads : :class:`int`, optional
+        Number of threads used to compress gzip data. With more than one thread the data is written as a series of gzip
+        members that are compressed in parallel, which is still a valid gzip stream for any reader and can also be
+        decompressed in parallel by :meth:`read`. ASCII data is formatted by this many worker processes, which gives
+        the same text. Ignored for other encodings. Defaults to 1
 
     See Also
     --------
-    :meth:`read`, :meth:`read_header`, :meth:`read_data`
+    :meth:`read`, :meth:`read_header`, :meth:`read_data`, :class:`NrrdWriter`
     """
 
     if header is None:
         header = {}
 
-    # Infer a number of fields from the NumPy array and overwrite values in the header dictionary.
-    # Get type string identifier from the NumPy datatype
-    header['type'] = _TYPEMAP_NUMPY2NRRD[data.dtype.str[1:]]
+    # Since NRRD expects meta data to be in Fortran order we are required to reverse the shape in the case of the array
+    # being in C order. E.g., data was read using index_order='C'.
+    _prepare_header(header, data.dtype, list(data.shape) if index_order == 'F' else list(data.shape[::-1]))
+    filename, data_filename, detached_header = _data_filename(filename, header, detached_header, relative_data_path)
 
-    # If the datatype contains more than one byte and the encoding is not ASCII, then set the endian header value
-    # based on the datatype's endianness. Otherwise, delete the endian field from the header if present
-    if data.dtype.itemsize > 1 and header.get('encoding', '').lower() not in ['ascii', 'text', 'txt']:
-        header['endian'] = _NUMPY2NRRD_ENDIAN_MAP[data.dtype.str[:1]]
-    elif 'endian' in header:
-        del header['endian']
+    with open(filename, 'wb') as fh:
+        _write_header(fh, header, custom_field_map)
 
-    # If space is specified in the header, then space dimension can not. See
-    # http://teem.sourceforge.net/nrrd/format.html#space
-    if 'space' in header.keys() and 'space dimension' in header.keys():
-        del header['space dimension']
+        # If header & data in the same file is desired, write data in the file
+        if not detached_header:
+            _write_data(data, fh, header, compression_level=compression_level, index_order=index_order,
+                        threads=threads)
 
-    # Update the dimension and sizes fields in the header based on the data. Since NRRD expects meta data to be in
-    # Fortran order we are required to reverse the shape in the case of the array being in C order. E.g., data was read
-    # using index_order='C'.
-    header['dimension'] = data.ndim
-    header['sizes'] = list(data.shape) if index_order == 'F' else list(data.shape[::-1])
+    # If detached header desired, write data to different file
+    if detached_header:
+        with open(data_filename, 'wb') as data_fh:
+            _write_data(data, data_fh, header, compression_level=compression_level, index_order=index_order,
+                        threads=threads)
 
-    # The default encoding is 'gzip'
-    if 'encoding' not in header:
-        header['encoding'] = 'gzip'
 
-    # A bit of magic in handling options here.
-    # If *.nhdr filename provided, this overrides `detached_header=False`
-    # If *.nrrd filename provided AND detached_header=True, separate header and data files written.
-    # If detached_header=True and data file is present, then write the files separately
-    # For all other cases, header & data written to same file.
-    if filename.endswith('.nhdr'):
-        detached_header = True
+def _compress_gzip_member(block, compression_level):
+    """Compress :obj:`block` into one gzip member that records its own size, see :obj:`_GZIP_MEMBER_HEADER`"""
 
-        if 'data file' not in header:
-            # Get the base filename without the extension
-            base_filename = os.path.splitext(filename)[0]
+    compressobj = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated_data = compressobj.compress(block) + compressobj.flush()
 
-            # Get the appropriate data filename based on encoding, see here for information on the standard detached
-            # filename: http://teem.sourceforge.net/nrrd/format.html#encoding
-            if header['encoding'] == 'raw':
-                data_filename = '%s.raw' % base_filename
-            elif header['encoding'] in ['ASCII', 'ascii', 'text', 'txt']:
-                data_filename = '%s.txt' % base_filename
-            elif header['encoding'] in ['gzip', 'gz']:
-                data_filename = '%s.raw.gz' % base_filename
-            elif header['encoding'] in ['bzip2', 'bz2']:
-                data_filename = '%s.raw.bz2' % base_filename
-            else:
-                raise NRRDError('Invalid encoding specification while writing NRRD file: %s' % header['encoding'])
+    member_size = _GZIP_MEMBER_HEADER.size + len(deflated_data) + 8
+    member_header = _GZIP_MEMBER_HEADER.pack(*(_GZIP_MEMBER_FIELDS + (0, 0, 255) + _GZIP_MEMBER_EXTRA + (member_size,)))
+    trailer = struct.pack('<2I', zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
 
-            header['data file'] = os.path.basename(data_filename) \
-                if relative_data_path else os.path.abspath(data_filename)
-        else:
-            # TODO This will cause issues for relative data files because it will not save in the correct spot
-            data_filename = header['data file']
-    elif filename.endswith('.nrrd') and detached_header:
-        data_filename = filename
-        header['data file'] = os.path.basename(data_filename) \
-            if relative_data_path else os.path.abspath(data_filename)
-        filename = '%s.nhdr' % os.path.splitext(filename)[0]
-    else:
-        # Write header & data as one file
-        data_filename = filename
-        detached_header = False
+    return member_header + deflated_data + trailer
 
-    with open(filename, 'wb') as fh:
-        fh.write(b'NRRD0005\n')
-        fh.write(b'# This NRRD file was generated by pynrrd\n')
-        fh.write(b'# on ' + datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S').encode('ascii') + b'(GMT).\n')
-        fh.write(b'# Complete NRRD file format specification at:\n')
-        fh.write(b'# http://teem.sourceforge.net/nrrd/format.html\n')
-
-        # Copy the options since dictionaries are mutable when passed as an argument
-        # Thus, to prevent changes to the actual options, a copy is made
-        # Empty ordered_options list is made (will be converted into dictionary)
-        local_options = header.copy()
-        ordered_options = []
-
-        # Loop through field order and add the key/value if present
-        # Remove the key/value from the local options so that we know not to add it again
-        for field in _NRRD_FIELD_ORDER:
-            if field in local_options:
-                ordered_options.append((field, local_options[field]))
-                del local_options[field]
-
-        # Leftover items are assumed to be the custom field/value options
-        # So get current size and any items past this index will be a custom value
-        custom_field_start_index = len(ordered_options)
-
-        # Add the leftover items to the end of the list and convert the options into a dictionary
-        ordered_options.extend(local_options.items())
-        ordered_options = OrderedDict(ordered_options)
-
-        for x, (field, value) in enumerate(ordered_options.items()):
-            # Get the field_type based on field and then get corresponding
-            # value as a str using _format_field_value
-            field_type = _get_field_type(field, custom_field_map)
-            value_str = _format_field_value(value, field_type)
-
-            # Custom fields are written as key/value pairs with a := instead of : delimeter
-            if x >= custom_field_start_index:
-                fh.write(('%s:=%s\n' % (field, value_str)).encode('ascii'))
-            else:
-                fh.write(('%s: %s\n' % (field, value_str)).encode('ascii'))
 
-        # Write the closing extra newline
-        fh.write(b'\n')
+def _format_text(block, dtype, columns):
+    """Format the values in the bytes :obj:`block` as ASCII data with :obj:`columns` values per line
 
-        # If header & data in the same file is desired, write data in the file
-        if not detached_header:
-            _write_data(data, fh, header, compression_level=compression_level, index_order=index_order)
+    The text is the same as the text :func:`numpy.savetxt` writes with the format '%.17g'.
+    """
 
-    # If detached header desired, write data to different file
-    if detached_header:
-        with open(data_filename, 'wb') as data_fh:
-            _write_data(data, data_fh, header, compression_level=compression_level, index_order=index_order)
+    values = np.frombuffer(block, dtype).tolist()
+    line = ' '.join(['%.17g'] * columns) + '\n'
+    return ((line * (len(values) // columns)) % tuple(values)).encode('ascii')
 
 
-def _write_data(data, fh, header, compression_level=None, index_order='F'):
-    if index_order not in ['F', 'C']:
-        raise NRRDError('Invalid index order')
+def _iter_slabs(data, index_order, slab_size):
+    """Yield slabs of :obj:`data` along the slowest axis of the file, each of about :obj:`slab_size` bytes
 
-    if header['encoding'] == 'raw':
-        # Convert the data into a string
-        raw_data = data.tostring(order=index_order)
+    The slabs are views of :obj:`data` with their axes in C order, so the bytes of each slab in C order are the bytes
+    of the file. A slab holds at least one index of the slowest axis.
+    """
 
-        # Write the raw data directly to the file
-        fh.write(raw_data)
-    elif header['encoding'].lower() in ['ascii', 'text', 'txt']:
-        # savetxt only works for 1D and 2D arrays, so reshape any > 2 dim arrays into one long 1D array
-        if data.ndim > 2:
-            np.savetxt(fh, data.ravel(order=index_order), '%.17g')
-        else:
-            np.savetxt(fh, data if index_order == 'C' else data.T, '%.17g')
+    view = data.T if index_order == 'F' else data
+    if view.ndim == 0:
+        view = view.reshape(1)
 
-    else:
-        # Convert the data into a string
-        raw_data = data.tostring(order=index_order)
+    rows = max(1, slab_size // max(view[0].nbytes, 1)) if view.shape[0] else 1
+    for start_index in range(0, view.shape[0], rows):
+        yield view[start_index:start_index + rows]
 
-        # Construct the compressor object based on encoding
-        if header['encoding'] in ['gzip', 'gz']:
-            compressobj = zlib.compressobj(compression_level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
-        elif header['encoding'] in ['bzip2', 'bz2']:
-            compressobj = bz2.BZ2Compressor(compression_level)
+
+def _iter_data_blocks(data, index_order, block_size, reuse_buffer=True):
+    """Yield the bytes of :obj:`data` in the order of the file as memoryviews of :obj:`block_size` bytes
+
+    All blocks but the last one have :obj:`block_size` bytes, whatever the memory layout of :obj:`data`. If
+    :obj:`data` is contiguous in the order of the file, the blocks are views of its memory and nothing is copied.
+    Otherwise the slabs along the slowest axis of the file (see :meth:`_iter_slabs`) are copied one at a time into a
+    slab buffer and from there into the block. The block buffer is reused for the next block if :obj:`reuse_buffer` is
+    True, so a block must be consumed before the next one is requested. At least one block is yielded, which is empty
+    for an empty volume.
+    """
+
+    view = data.T if index_order == 'F' else data
+    if view.ndim == 0 or view.flags.c_contiguous:
+        flat = np.ascontiguousarray(view).reshape(-1).view(np.uint8)
+        for start_index in range(0, max(flat.size, 1), block_size):
+            yield memoryview(flat[start_index:start_index + block_size])
+        return
+
+    slab_buffer = None
+    block = np.empty(block_size, dtype=np.uint8)
+    filled = 0
+    for slab in _iter_slabs(data, index_order, block_size):
+        if slab_buffer is None:
+            slab_buffer = np.empty(slab.shape, dtype=slab.dtype)
+        slab_bytes = slab_buffer[:slab.shape[0]]
+        np.copyto(slab_bytes, slab)
+        slab_bytes = slab_bytes.reshape(-1).view(np.uint8)
+
+        position = 0
+        while position < slab_bytes.size:
+            count = min(block_size - filled, slab_bytes.size - position)
+            block[filled:filled + count] = slab_bytes[position:position + count]
+            filled += count
+            position += count
+            if filled == block_size:
+                yield memoryview(block)
+                block = block if reuse_buffer else np.empty(block_size, dtype=np.uint8)
+                filled = 0
+
+    if filled:
+        yield memoryview(block[:filled])
+
+
+class _DataEncoder(object):
+    """Encode data with the encoding of :obj:`header` and write it to :obj:`fh`, one part of the data at a time
+
+    Each part given to :meth:`write` is a slab of the volume along the slowest axis of the file, and the parts come in
+    the order of the file. The data is written one block at a time, straight from the memory of the array if it is in
+    the order of the file and otherwise through a buffer of one slab (see :meth:`_iter_data_blocks`), so at most one
+    slab of the data is copied at once. The encoded data does not depend on how the volume is split into parts, and
+    :meth:`close` must be called after the last part.
+    """
+
+    def __init__(self, fh, header, compression_level=None, index_order='F', threads=1):
+        if index_order not in ['F', 'C']:
+            raise NRRDError('Invalid index order')
+
+        self._fh = fh
+        self._encoding = header['encoding'].lower()
+        self._compression_level = compression_level
+        self._index_order = index_order
+        self._threads = threads
+        self._compressobj = None
+
+        if self._encoding in ['raw', 'ascii', 'text', 'txt']:
+            pass
+        elif threads > 1 and self._encoding in ['gzip', 'gz']:
+            # Data that does not fill a gzip member yet, and the number of members written
+            self._pending = bytearray()
+            self._members = 0
+        elif self._encoding in ['gzip', 'gz']:
+            self._compressobj = zlib.compressobj(compression_level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        elif self._encoding in ['bzip2', 'bz2']:
+            self._compressobj = bz2.BZ2Compressor(compression_level)
         else:
             raise NRRDError('Unsupported encoding: "%s"' % header['encoding'])
 
-        # Write the data in chunks (see _WRITE_CHUNKSIZE declaration for more information why)
-        # Obtain the length of the data since we will be using it repeatedly, more efficient
-        start_index = 0
-        raw_data_len = len(raw_data)
+    def _member_blocks(self, data):
+        """Yield the blocks of the gzip members that :obj:`data` fills, keeping the rest for the next part"""
+
+        for block in _iter_data_blocks(data, self._index_order, _GZIP_MEMBER_SIZE, reuse_buffer=False):
+            if not self._pending and len(block) == _GZIP_MEMBER_SIZE:
+                yield block
+                continue
+
+            self._pending += block
+            while len(self._pending) >= _GZIP_MEMBER_SIZE:
+                yield bytes(self._pending[:_GZIP_MEMBER_SIZE])
+                del self._pending[:_GZIP_MEMBER_SIZE]
+
+    def write(self, data):
+        if self._encoding == 'raw':
+            for block in _iter_data_blocks(data, self._index_order, _WRITE_CHUNKSIZE):
+                self._fh.write(block)
+        elif self._encoding in ['ascii', 'text', 'txt'] and data.size == 0:
+            # An empty 2D array can still have lines, which only savetxt writes the same way
+            if data.ndim == 2:
+                np.savetxt(self._fh, data if self._index_order == 'C' else data.T, '%.17g')
+        elif self._encoding in ['ascii', 'text', 'txt']:
+            # The rows of 2D arrays are written as lines, like savetxt does, and the values of other arrays one per
+            # line. The text is formatted a chunk of whole lines at a time, about _TEXT_CHUNKSIZE bytes of it.
+            columns = (data.shape[-1] if self._index_order == 'C' else data.shape[0]) if data.ndim == 2 else 1
+            block_size = max(_TEXT_CHUNKSIZE // 16 // columns, 1) * columns * data.itemsize
+            blocks = _iter_data_blocks(data, self._index_order, block_size)
+            text = partial(_format_text, dtype=data.dtype, columns=columns)
+
+            if self._threads > 1:
+                # The blocks are copied so the buffer can be reused while they wait to be sent to the processes
+                chunks = _map_in_order(text, (bytes(block) for block in blocks), self._threads, processes=True)
+            else:
+                chunks = map(text, blocks)
+
+            for chunk in chunks:
+                self._fh.write(chunk)
+        elif self._compressobj is None:
+            # Compress blocks of the data into separate gzip members in parallel, zlib releases the GIL while it works.
+            # The blocks are kept until they are compressed, so they can not share a buffer.
+            for member in _map_in_order(partial(_compress_gzip_member, compression_level=self._compression_level),
+                                        self._member_blocks(data), self._threads):
+                self._fh.write(member)
+                self._members += 1
+        else:
+            # Write the data in chunks (see _WRITE_CHUNKSIZE declaration for more information why)
+            for block in _iter_data_blocks(data, self._index_order, _WRITE_CHUNKSIZE):
+                self._fh.write(self._compressobj.compress(block))
+
+    def close(self):
+        if self._compressobj is not None:
+            # Finish writing the data
+            self._fh.write(self._compressobj.flush())
+        elif self._encoding in ['gzip', 'gz'] and (self._pending or not self._members):
+            # The rest of the data is the last member. An empty volume is still written as one (empty) member
+            self._fh.write(_compress_gzip_member(bytes(self._pending), self._compression_level))
+
+        self._fh.flush()
+
+
+def _write_data(data, fh, header, compression_level=None, index_order='F', threads=1):
+    encoder = _DataEncoder(fh, header, compression_level=compression_level, index_order=index_order, threads=threads)
+    encoder.write(data)
+    encoder.close()
+
 
-        # Loop through the data and write it by chunk
-        while start_index < raw_data_len:
-            # End index is start index plus the chunk size
-            # Set to the string length to read the remaining chunk at the end
-            end_index = min(start_index + _WRITE_CHUNKSIZE, raw_data_len)
+class NrrdWriter(object):
+    """Write a NRRD file one slab at a time
 
-            # Write the compressed data
-            fh.write(compressobj.compress(raw_data[start_index:end_index]))
+    The header is written when the writer is created, from :obj:`header` and the datatype and sizes of the whole
+    volume. The volume is then given to :meth:`append` in slabs along its slowest axis, the last axis of the file (z
+    for a volume, the first axis with index_order='C'), which are encoded and written as they come, so the whole
+    volume is never in memory. :meth:`close` checks that the slabs filled the volume. The file is the same as the one
+    :meth:`write` writes for the whole volume.
 
-            start_index = end_index
+    Used as a context manager, the writer is closed when the block exits, unless it exits with an exception.
 
-        # Finish writing the data
-        fh.write(compressobj.flush())
-        fh.flush()
\ No newline at end of file
+    >>> with NrrdWriter('fa.nrrd', np.float32, [160, 190, 148], {'encoding': 'gzip'}, index_order='C') as writer:
+    ...     for z in range(148):
+    ...         writer.append(fa_slice(z))
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Filename of the NRRD file, see :meth:`write`
+    dtype : :class:`numpy.dtype`
+        Datatype of the volume. Slabs of another datatype are converted to it
+    sizes : :class:`list` of :class:`int`
+        Sizes of the axes of the volume in the order of the NRRD file, x first, like the 'sizes' field
+    header : :class:`dict` (:class:`str`, :obj:`Object`), optional
+        Fields of the NRRD header, completed with the generated fields like in :meth:`write`
+    detached_header, relative_data_path, custom_field_map, compression_level, threads : optional
+        See :meth:`write`
+    index_order : {'C', 'F'}, optional
+        Index order of the slabs, see :meth:`write`. With 'F' the slowest axis is the last axis of a slab, with 'C'
+        the first one
+
+    See Also
+    --------
+    :meth:`write`
+    """
+
+    def __init__(self, filename, dtype, sizes, header=None, detached_header=False, relative_data_path=True,
+                 custom_field_map=None, compression_level=9, index_order='F', threads=1):
+        if index_order not in ['F', 'C']:
+            raise NRRDError('Invalid index order')
+        if len(sizes) < 1:
+            raise NRRDError('A volume needs at least one axis')
+
+        if header is None:
+            header = {}
+
+        self.dtype = np.dtype(dtype)
+        self.sizes = [int(size) for size in sizes]
+        self.index_order = index_order
+        self.header = header
+        self._written = 0
+
+        _prepare_header(header, self.dtype, self.sizes)
+        filename, data_filename, detached_header = _data_filename(filename, header, detached_header, relative_data_path)
+
+        self._fh = open(filename, 'wb')
+        try:
+            _write_header(self._fh, header, custom_field_map)
+            if detached_header:
+                self._fh.close()
+                self._fh = open(data_filename, 'wb')
+
+            self._encoder = _DataEncoder(self._fh, header, compression_level=compression_level,
+                                         index_order=index_order, threads=threads)
+        except Exception:
+            self._fh.close()
+            raise
+
+    def append(self, slab):
+        """Encode and write the next slab of the volume
+
+        Parameters
+        ----------
+        slab : :class:`numpy.ndarray`
+            Slab of the volume along its slowest axis, with the other axes of the volume in the index order of the
+            writer. An array without the slowest axis is one slice of it
+        """
+
+        slab = np.asarray(slab, dtype=self.dtype)
+        other_sizes = self.sizes[:-1] if self.index_order == 'F' else self.sizes[-2::-1]
+        if slab.ndim == len(self.sizes) - 1:
+            slab = slab[..., None] if self.index_order == 'F' else slab[None]
+
+        count = slab.shape[-1] if self.index_order == 'F' else slab.shape[0]
+        if slab.ndim != len(self.sizes) or \
+                list(slab.shape[:-1] if self.index_order == 'F' else slab.shape[1:]) != other_sizes:
+            raise NRRDError('Slab of shape %s does not fit a volume of sizes %s with index order %s'
+                            % (slab.shape, self.sizes, self.index_order))
+        if self._written + count > self.sizes[-1]:
+            raise NRRDError('Slabs exceed the %d indices of the slowest axis' % self.sizes[-1])
+
+        self._encoder.write(slab)
+        self._written += count
+
+    def close(self):
+        """Finish the file, raising :class:`NRRDError` if the slabs did not fill the volume"""
+
+        if self._fh.closed:
+            return
+
+        try:
+            if self._written != self.sizes[-1]:
+                raise NRRDError('Slabs filled %d of the %d indices of the slowest axis'
+                                % (self._written, self.sizes[-1]))
+            self._encoder.close()
+        finally:
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._fh.close()
@@ -0,0 +1,251 @@
+"""Multi-resolution pyramids of NRRD volumes
+
+Level n of the pyramid of a volume is the volume averaged over blocks of 2^n x 2^n x 2^n voxels, level 0 being the
+volume itself. The levels are written next to the volume as sibling NRRD files, <name>_level<n>.nrrd, with their space
+directions and space origin rescaled to the blocks, so each level is a volume of its own that can be opened lazily
+with :class:`Pyramid`.
+
+Tensor fields, volumes whose first axis holds the 9 components of a 3x3 tensor, are averaged in log-Euclidean space:
+the matrix logarithms of the tensors are averaged and the average is mapped back with the matrix exponential, which
+keeps the averages positive definite and doesn't swell them like component wise averaging. Other volumes are averaged
+component wise.
+
+    python pyramid.py DTIBrain.nrrd --levels 3
+"""
+import argparse
+import os
+
+import numpy as np
+
+from pynrrd import NrrdVolume, write
+from dti import tensor_matrices
+
+# Eigenvalues of a tensor smaller than this fraction of its largest eigenvalue are raised to it before taking the
+# logarithm, so that the logarithm of tensors that are positive semidefinite or slightly indefinite due to noise is
+# defined. Tensors without a positive eigenvalue, like the zero tensors outside the brain, are left out of the averages
+_MIN_EIGENVALUE_RATIO = 1e-6
+
+
+def _level_filename(filename, level, directory=None):
+    """Filename of level :obj:`level` of the pyramid of :obj:`filename`"""
+
+    if level == 0:
+        return filename
+
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(directory if directory is not None else os.path.dirname(filename),
+                        '%s_level%d.nrrd' % (name, level))
+
+
+def _block_sum(data, factor):
+    """Sum :obj:`data` over blocks of :obj:`factor` along its first three axes, padding them with zeros"""
+
+    shape = [-(-size // factor) for size in data.shape[:3]]
+    padding = [(0, size * factor - data_size) for size, data_size in zip(shape, data.shape[:3])]
+    padded = np.pad(data, padding + [(0, 0)] * (data.ndim - 3), mode='constant')
+
+    blocks = padded.reshape((shape[0], factor, shape[1], factor, shape[2], factor) + data.shape[3:])
+    return blocks.sum(axis=(1, 3, 5))
+
+
+def _log_tensors(tensors):
+    """Matrix logarithm of the tensors in :obj:`tensors` of shape (..., 3, 3), and whether it is defined"""
+
+    values, vectors = np.linalg.eigh(tensors)
+    largest = values[..., -1:]
+    valid = np.isfinite(values).all(axis=-1) & (largest[..., 0] > 0)
+
+    values = np.log(np.maximum(values, largest * _MIN_EIGENVALUE_RATIO), where=valid[..., None],
+                    out=np.zeros_like(values))
+    logs = np.einsum('...ij,...j,...kj->...ik', vectors, values, vectors)
+    logs[~valid] = 0
+
+    return logs, valid
+
+
+def _exp_tensors(tensors):
+    """Matrix exponential of the symmetric tensors in :obj:`tensors` of shape (..., 3, 3)"""
+
+    values, vectors = np.linalg.eigh(tensors)
+    return np.einsum('...ij,...j,...kj->...ik', vectors, np.exp(values), vectors)
+
+
+def downsample(data, factor=2, tensor=False):
+    """Average a volume over blocks of :obj:`factor` voxels along each spatial axis
+
+    Blocks at the end of an axis that isn't a multiple of :obj:`factor` are averaged over the voxels they have.
+
+    Parameters
+    ----------
+    data : :class:`numpy.ndarray`
+        Volume with its three spatial axes first, as read with index_order='C', and optionally a component axis
+    factor : :class:`int`, optional
+        Size of the blocks along each spatial axis
+    tensor : :class:`bool`, optional
+        Whether the last axis of :obj:`data` holds the 9 components of symmetric tensors, which are averaged in
+        log-Euclidean space. Blocks without a positive definite tensor average to the zero tensor
+
+    Returns
+    -------
+    data : :class:`numpy.ndarray`
+        Averaged volume as float32
+    """
+
+    if not tensor:
+        counts = _block_sum(np.ones(data.shape[:3], dtype=np.float32), factor)
+        sums = _block_sum(data.astype(np.float64), factor)
+        return (sums / counts.reshape(counts.shape + (1,) * (data.ndim - 3))).astype(np.float32)
+
+    tensors = tensor_matrices(data)
+    shape = [-(-size // factor) for size in data.shape[:3]]
+    averaged = np.zeros(shape + [9], dtype=np.float32)
+
+    # One slab of blocks along the slowest axis at a time, to keep the float64 temporaries small
+    for z in range(shape[0]):
+        logs, valid = _log_tensors(tensors[z * factor:(z + 1) * factor].astype(np.float64))
+        counts = _block_sum(valid.astype(np.float64), factor)[0]
+        sums = _block_sum(logs, factor)[0]
+
+        nonempty = counts > 0
+        averaged[z][nonempty] = _exp_tensors(sums[nonempty] / counts[nonempty, None, None]).reshape(-1, 9)
+
+    return averaged
+
+
+def level_header(header, factor):
+    """Header of a volume with header :obj:`header` averaged over blocks of :obj:`factor` voxels"""
+
+    level = dict((field, header[field]) for field in ['space', 'space units', 'kinds', 'measurement frame']
+                 if field in header)
+
+    if 'space directions' in header:
+        directions = header['space directions']
+        domain = ~np.isnan(directions).any(axis=1)
+        level['space directions'] = np.where(domain[:, None], directions * factor, directions)
+
+        # The center of the first block is the mean of the centers of the voxels in it
+        if 'space origin' in header:
+            level['space origin'] = header['space origin'] + (factor - 1) / 2 * directions[domain].sum(axis=0)
+    elif 'space origin' in header:
+        level['space origin'] = header['space origin']
+
+    return level
+
+
+def is_tensor_field(header):
+    """Whether the volume with header :obj:`header` is a tensor field with the 9 tensor components in its first axis"""
+
+    return header['dimension'] == 4 and header['sizes'][0] == 9
+
+
+def build_pyramid(filename, levels=3, directory=None, encoding='gzip'):
+    """Write the levels of the pyramid of the NRRD file :obj:`filename`
+
+    Each level is averaged from the volume itself with :func:`downsample`, as a tensor field if
+    :func:`is_tensor_field`, so the blocks at the end of an axis are averaged over the voxels they have. The volume is
+    read one slab of 2^levels z slices at a time with :class:`pynrrd.NrrdVolume`, and only the levels, an eighth of
+    the volume as float32 for level 1, are in memory as a whole until they are written.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Filename of the NRRD file, a 3D volume or a 3D volume with a component axis first
+    levels : :class:`int`, optional
+        Number of levels to write besides the volume itself
+    directory : :class:`str`, optional
+        Directory to write the levels to, defaults to the directory of :obj:`filename`
+    encoding : :class:`str`, optional
+        Encoding of the levels
+
+    Returns
+    -------
+    filenames : :class:`list` (:class:`str`)
+        Filenames of the written levels, from level 1 on
+    """
+
+    volume = NrrdVolume(filename, index_order='C')
+    header = volume.header
+    tensor = is_tensor_field(header)
+    components = volume.shape[3] if volume.ndim == 4 else 1
+
+    factors = [2 ** level for level in range(1, levels + 1)]
+    averages = [np.zeros([-(-size // factor) for size in volume.shape[:3]] + [components], dtype=np.float32)
+                for factor in factors]
+    # A slab holds whole blocks of every level
+    slab_size = 2 ** levels
+    for start in range(0, volume.shape[0] if factors else 0, slab_size):
+        slab = volume[start:start + slab_size]
+        if slab.ndim == 3:
+            slab = slab[..., None]
+        for factor, average in zip(factors, averages):
+            blocks = downsample(slab, factor, tensor)
+            average[start // factor:start // factor + len(blocks)] = blocks
+
+    if directory is not None and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    filenames = []
+    for level, data in enumerate(averages, 1):
+        level_filename = _level_filename(filename, level, directory)
+        data_header = level_header(header, 2 ** level)
+        data_header['encoding'] = encoding
+        write(level_filename, data if header['dimension'] == 4 else data[..., 0], data_header, index_order='C')
+        filenames.append(level_filename)
+
+    return filenames
+
+
+class Pyramid(object):
+    """Levels of the pyramid of a NRRD file written by :func:`build_pyramid`
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Filename of the NRRD file, level 0
+    directory : :class:`str`, optional
+        Directory of the levels, defaults to the directory of :obj:`filename`
+
+    Attributes
+    ----------
+    filenames : :class:`list` (:class:`str`)
+        Filenames of the levels, starting with :obj:`filename`
+    """
+
+    def __init__(self, filename, directory=None):
+        self.filenames = [filename]
+        while os.path.exists(_level_filename(filename, len(self.filenames), directory)):
+            self.filenames.append(_level_filename(filename, len(self.filenames), directory))
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def level(self, level, index_order='F'):
+        """Open level :obj:`level` lazily, see :class:`pynrrd.NrrdVolume`"""
+
+        return NrrdVolume(self.filenames[level], index_order=index_order)
+
+    def level_for(self, max_voxels, index_order='F'):
+        """Open the finest level lazily that has at most :obj:`max_voxels` voxels, or the coarsest level"""
+
+        for level in range(len(self.filenames)):
+            volume = self.level(level, index_order)
+            sizes = volume.shape[1:] if volume.ndim == 4 and index_order == 'F' else volume.shape[:3]
+            if np.prod(sizes) <= max_voxels or level == len(self.filenames) - 1:
+                return volume
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the levels of the multi-resolution pyramid of a NRRD file')
+    parser.add_argument('path', help='path to the nrrd file')
+    parser.add_argument('--levels', type=int, default=3, help='number of levels besides the file itself (default: 3)')
+    parser.add_argument('--output', help='directory to write the levels to, defaults to the directory of the file')
+    parser.add_argument('--encoding', choices=('raw', 'gzip'), default='gzip', help='encoding of the levels')
+    args = parser.parse_args()
+
+    for level_filename in build_pyramid(args.path, args.levels, args.output, args.encoding):
+        print('wrote ', level_filename)
+    return 0
+
+
+if __name__ == '__main__':
+    main()
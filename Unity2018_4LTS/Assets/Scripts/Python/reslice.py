@@ -0,0 +1,265 @@
+"""Oblique slices of NRRD volumes in world space
+
+Resamples a plane or a thick slab of any orientation from a volume, at a requested resolution in world space. Sample
+positions are mapped to voxels with the affine of the header, the space directions and space origin, so anisotropic
+and oblique voxel grids are handled, and the volume is sampled trilinearly, all samples at once with numpy.
+
+Only the bounding box of the voxels around the samples is read from the volume, so with a
+:class:`pynrrd.NrrdVolume` of raw data or a :class:`bricks.BrickVolume` a slice doesn't read the whole volume.
+
+The components of tensor fields and vector fields are in the measurement frame of the header, and are rotated to
+world space or to the frame of the plane.
+
+    python reslice.py DTIBrain.nrrd --center 0 0 10 --normal 0 0 1 --size 256 256 --spacing 0.5 --output slice.npy
+"""
+import argparse
+import os
+
+import numpy as np
+
+from bricks import BrickVolume
+from pynrrd import NrrdVolume
+
+# Component axis kinds of vector fields, whose components are rotated like vectors
+_VECTOR_KINDS = ['3-vector', 'covariant-vector', 'normal', 'covariant-normal', '3-gradient', '3-normal']
+
+# Corner offsets of the 8 voxels around a position, for trilinear interpolation
+_CORNERS = np.array([[z, y, x] for z in (0, 1) for y in (0, 1) for x in (0, 1)])
+
+
+def axes_from_normal(normal, up=(0.0, 0.0, 1.0)):
+    """In-plane axes of the plane with :obj:`normal`, the second one as close to :obj:`up` as possible
+
+    Returns
+    -------
+    axis_u, axis_v : :class:`numpy.ndarray`
+        Orthonormal axes such that axis_u x axis_v is the unit normal
+    """
+
+    normal = np.asarray(normal, dtype=float)
+    normal = normal / np.linalg.norm(normal)
+    up = np.asarray(up, dtype=float)
+    if abs(np.dot(up, normal)) > 0.99 * np.linalg.norm(up):
+        up = np.eye(3)[np.argmin(np.abs(normal))]
+
+    axis_v = up - np.dot(up, normal) * normal
+    axis_v /= np.linalg.norm(axis_v)
+    return np.cross(axis_v, normal), axis_v
+
+
+class ObliqueSlicer(object):
+    """Resample oblique planes and slabs of a volume
+
+    Parameters
+    ----------
+    volume : :class:`str`, :class:`pynrrd.NrrdVolume`, :class:`bricks.BrickVolume` or :class:`numpy.ndarray`
+        Volume to slice, indexed in C order with the spatial axes first and an optional component axis last. A
+        filename is opened lazily, as a :class:`bricks.BrickVolume` if it ends with .nbrk and as a
+        :class:`pynrrd.NrrdVolume` otherwise
+    header : :class:`dict` (:class:`str`, :obj:`Object`), optional
+        NRRD header of the volume, defaults to the header of the volume
+
+    Attributes
+    ----------
+    space_directions : :class:`numpy.ndarray`
+        3x3 matrix whose rows are the world space vectors of the x, y and z voxel axes
+    space_origin : :class:`numpy.ndarray`
+        World space position of voxel (0, 0, 0)
+    """
+
+    def __init__(self, volume, header=None):
+        if isinstance(volume, str):
+            if os.path.splitext(volume)[1] == '.nbrk':
+                volume = BrickVolume(volume, index_order='C')
+            else:
+                volume = NrrdVolume(volume, index_order='C')
+
+        self.volume = volume
+        self.header = header if header is not None else getattr(volume, 'header', {})
+        self.shape = tuple(volume.shape[:3])
+
+        directions = self.header.get('space directions')
+        if directions is not None:
+            directions = np.asarray(directions, dtype=float)
+            directions = directions[~np.isnan(directions).any(axis=1)]
+        self.space_directions = np.eye(3) if directions is None else directions
+        self.space_origin = np.asarray(self.header.get('space origin', np.zeros(3)), dtype=float)
+        self._to_voxels = np.linalg.inv(self.space_directions)
+
+        # Frame the components are rotated with, None for scalar components
+        components = volume.shape[3] if len(volume.shape) > 3 else 1
+        kinds = self.header.get('kinds') or [None]
+        self._components = None
+        if components == 9:
+            self._components = 'tensor'
+        elif components == 3 and kinds[0] in _VECTOR_KINDS:
+            self._components = 'vector'
+        self._measurement_frame = np.asarray(self.header.get('measurement frame', np.eye(3)), dtype=float)
+
+    def to_voxels(self, positions):
+        """Voxel coordinates in C order of world space positions of shape (..., 3)"""
+
+        return np.dot(np.asarray(positions, dtype=float) - self.space_origin, self._to_voxels)[..., ::-1]
+
+    def to_world(self, voxels):
+        """World space positions of voxel coordinates in C order of shape (..., 3)"""
+
+        return np.dot(np.asarray(voxels, dtype=float)[..., ::-1], self.space_directions) + self.space_origin
+
+    def sample(self, positions, fill=0.0):
+        """Sample the volume trilinearly at world space positions
+
+        Parameters
+        ----------
+        positions : :class:`numpy.ndarray`
+            World space positions of shape (..., 3)
+        fill : :class:`float`, optional
+            Value of samples outside the volume
+
+        Returns
+        -------
+        samples : :class:`numpy.ndarray`
+            float32 samples of shape (...) or (..., C), with the components in the measurement frame
+        inside : :class:`numpy.ndarray`
+            Whether each sample is inside the volume
+        """
+
+        voxels = self.to_voxels(positions)
+        shape = voxels.shape[:-1]
+        voxels = voxels.reshape(-1, 3)
+        extent = np.array(self.shape) - 1
+        inside = np.isfinite(voxels).all(axis=1) & (voxels >= -1e-6).all(axis=1) & (voxels <= extent + 1e-6).all(axis=1)
+
+        component_shape = tuple(self.volume.shape[3:])
+        samples = np.full((len(voxels),) + component_shape, fill, dtype=np.float32)
+        if inside.any():
+            voxels = np.clip(voxels[inside], 0, extent)
+
+            # Read the bounding box of the voxels around the samples, the lower corner of each sample being at most the
+            # one before the last voxel along each axis so the upper corner is in the volume
+            lower = np.minimum(np.floor(voxels), np.maximum(extent - 1, 0)).astype(np.int64)
+            start = lower.min(axis=0)
+            stop = np.minimum(lower.max(axis=0) + 2, self.shape)
+            region = np.asarray(self.volume[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]], dtype=np.float32)
+
+            fractions = voxels - lower
+            lower -= start
+            upper_index = np.array(region.shape[:3]) - 1
+            values = 0
+            for corner in _CORNERS:
+                index = np.minimum(lower + corner, upper_index)
+                weights = np.prod(np.where(corner == 1, fractions, 1 - fractions), axis=1)
+                values = values + region[index[:, 0], index[:, 1], index[:, 2]] * \
+                    weights.reshape((-1,) + (1,) * len(component_shape))
+            samples[inside] = values
+
+        return samples.reshape(shape + component_shape), inside.reshape(shape)
+
+    def _rotate(self, samples, frame):
+        """Rotate the components of samples from the measurement frame to the rows of :obj:`frame`"""
+
+        # The rows of the measurement frame are the world space vectors of its axes
+        rotation = np.dot(self._measurement_frame, frame.T)
+        if self._components == 'vector':
+            return np.dot(samples, rotation).astype(np.float32)
+
+        tensors = samples.reshape(samples.shape[:-1] + (3, 3))
+        return np.einsum('ji,...jk,kl->...il', rotation, tensors, rotation).reshape(samples.shape).astype(np.float32)
+
+    def plane(self, center, axis_u, axis_v, shape, spacing=1.0, thickness=0.0, samples=None, reduce='mean',
+              fill=0.0, frame='world'):
+        """Resample a plane or a slab of the volume
+
+        Pixel (row, column) of the plane is at center + (column - (width - 1) / 2) * spacing_u * axis_u +
+        (row - (height - 1) / 2) * spacing_v * axis_v.
+
+        Parameters
+        ----------
+        center : :class:`numpy.ndarray`
+            World space position of the center of the plane
+        axis_u, axis_v : :class:`numpy.ndarray`
+            World space directions of the columns and rows of the plane, see :func:`axes_from_normal`. They are
+            normalized and axis_v is made orthogonal to axis_u
+        shape : :class:`tuple` of :class:`int`
+            Height and width of the plane in pixels
+        spacing : :class:`float` or :class:`tuple` of :class:`float`, optional
+            Size of a pixel in world units, along axis_u and axis_v
+        thickness : :class:`float`, optional
+            Thickness of the slab along the normal axis_u x axis_v, 0 for a plane
+        samples : :class:`int`, optional
+            Number of planes the slab is sampled at, defaults to one per spacing_u of thickness
+        reduce : {'mean', 'max'}, optional
+            How the samples of a slab are combined, the mean or the maximum intensity
+        fill : :class:`float`, optional
+            Value of pixels outside the volume
+        frame : {'world', 'plane'}, optional
+            Frame to rotate the components of tensor and vector fields to, world space or the axes u, v and normal of
+            the plane
+
+        Returns
+        -------
+        plane : :class:`numpy.ndarray`
+            float32 array of shape (height, width) or (height, width, C)
+        """
+
+        if reduce not in ['mean', 'max']:
+            raise ValueError('Invalid reduce %r' % reduce)
+        if frame not in ['world', 'plane']:
+            raise ValueError('Invalid frame %r' % frame)
+
+        axis_u = np.asarray(axis_u, dtype=float)
+        axis_u = axis_u / np.linalg.norm(axis_u)
+        axis_v = np.asarray(axis_v, dtype=float)
+        axis_v = axis_v - np.dot(axis_v, axis_u) * axis_u
+        if np.linalg.norm(axis_v) < 1e-9:
+            raise ValueError('The axes of the plane are parallel')
+        axis_v /= np.linalg.norm(axis_v)
+        normal = np.cross(axis_u, axis_v)
+
+        spacing_u, spacing_v = np.broadcast_to(np.asarray(spacing, dtype=float), (2,))
+        height, width = shape
+        if samples is None:
+            samples = int(np.ceil(thickness / spacing_u)) + 1 if thickness > 0 else 1
+        offsets = np.linspace(-thickness / 2, thickness / 2, samples) if samples > 1 else np.zeros(1)
+
+        u = (np.arange(width) - (width - 1) / 2) * spacing_u
+        v = (np.arange(height) - (height - 1) / 2) * spacing_v
+        positions = (np.asarray(center, dtype=float) + offsets[:, None, None, None] * normal +
+                     v[None, :, None, None] * axis_v + u[None, None, :, None] * axis_u)
+
+        values, inside = self.sample(positions, np.nan)
+        inside = inside.reshape(inside.shape + (1,) * (values.ndim - inside.ndim))
+        count = inside.sum(axis=0)
+        if reduce == 'mean':
+            result = np.where(inside, values, 0).sum(axis=0) / np.maximum(count, 1)
+        else:
+            result = np.where(inside, values, -np.inf).max(axis=0)
+        if self._components is not None:
+            result = self._rotate(np.where(count > 0, result, 0),
+                                  np.eye(3) if frame == 'world' else np.stack([axis_u, axis_v, normal]))
+        return np.where(count > 0, result, fill).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resample an oblique plane or slab of a NRRD volume in world space')
+    parser.add_argument('path', help='path to the nrrd or brick file')
+    parser.add_argument('--center', type=float, nargs=3, required=True, help='world space center of the plane')
+    parser.add_argument('--normal', type=float, nargs=3, required=True, help='world space normal of the plane')
+    parser.add_argument('--up', type=float, nargs=3, default=(0.0, 0.0, 1.0), help='direction of the rows')
+    parser.add_argument('--size', type=int, nargs=2, default=(256, 256), help='height and width in pixels')
+    parser.add_argument('--spacing', type=float, default=1.0, help='size of a pixel in world units (default: 1)')
+    parser.add_argument('--thickness', type=float, default=0.0, help='thickness of the slab (default: 0)')
+    parser.add_argument('--reduce', choices=('mean', 'max'), default='mean', help='how slab samples are combined')
+    parser.add_argument('--output', default='.\\Assets\\tmp\\slice.npy', help='npy file to save the slice to')
+    args = parser.parse_args()
+
+    slicer = ObliqueSlicer(args.path)
+    axis_u, axis_v = axes_from_normal(args.normal, args.up)
+    plane = slicer.plane(args.center, axis_u, axis_v, args.size, args.spacing, args.thickness, reduce=args.reduce)
+    np.save(args.output, plane)
+    print('saved to ', args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""Publish converted volumes in memory shared with other processes
+
+A published volume is described by a JSON serializable descriptor with the dtype, shape and strides of the array, where
+to find its bytes and the spatial fields of the NRRD header, so a consumer can map the array without copying it. The
+bytes are either in a :class:`multiprocessing.shared_memory.SharedMemory` segment (Python 3.8+), which only lives as
+long as a process has it open, or in a file in /dev/shm, or the temporary directory where there is no /dev/shm, which
+lives until it is unlinked.
+"""
+import os
+import tempfile
+import threading
+import uuid
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+# Fields of the NRRD header that are copied to the descriptor
+_SPATIAL_FIELDS = ['space', 'space dimension', 'space directions', 'space origin', 'space units', 'measurement frame',
+                   'kinds']
+
+# Volumes published by this process by name, so that they stay open until they are released
+_published = {}
+_published_lock = threading.Lock()
+
+
+def _shared_directory():
+    """Directory for the files of published volumes, /dev/shm if it exists since it is kept in memory"""
+
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _json_value(value):
+    """Convert a header value to a JSON serializable value, with NaN (a 'none' vector) converted to :obj:`None`"""
+
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == 'f':
+            value = np.where(np.isnan(value), None, value.astype(object))
+        return value.tolist()
+
+    return value
+
+
+class SharedVolume(object):
+    """Array in memory shared with other processes
+
+    Use :meth:`publish` to copy an array into shared memory, or :meth:`allocate` to get an array in shared memory to
+    write or decode a volume into, and :meth:`attach` to map a published array from its descriptor.
+
+    Attributes
+    ----------
+    descriptor : :class:`dict`
+        JSON serializable description of the volume. 'kind' is 'shared_memory' with the segment name in 'name', or
+        'file' with the file name in 'path'. 'dtype', 'shape', 'strides' and 'offset' describe the array in it,
+        'index_order' the order of its axes and 'header' holds the spatial fields of the NRRD header
+    array : :class:`numpy.ndarray`
+        The array in shared memory
+    """
+
+    def __init__(self, descriptor, array, handle=None):
+        self.descriptor = descriptor
+        self.array = array
+        self._handle = handle
+
+    @classmethod
+    def allocate(cls, shape, dtype, header=None, index_order='C', use_shared_memory=False):
+        """Publish an uninitialized little endian array in shared memory
+
+        The array is published right away, the volume must be filled before its descriptor is handed out. Decoding a
+        volume straight into :attr:`array`, e.g. with the out argument of :func:`pynrrd.read`, keeps only one copy of
+        it in memory. The volume is kept open until :func:`release` is called with its name, so a shared memory
+        segment lives as long as this process unless it is released.
+
+        Parameters
+        ----------
+        shape : :class:`tuple` of :class:`int`
+            Shape of the array
+        dtype : :class:`numpy.dtype`
+            Datatype of the array, converted to little endian
+        header : :class:`dict` (:class:`str`, :obj:`Object`), optional
+            NRRD header of the array, its spatial fields are copied to the descriptor
+        index_order : {'C', 'F'}, optional
+            Index order of the array, copied to the descriptor. The array is contiguous in this order
+        use_shared_memory : :class:`bool`, optional
+            Use a shared memory segment if available (Python 3.8+), otherwise a file in /dev/shm or the temporary
+            directory. Defaults to a file, which also outlives this process
+
+        Returns
+        -------
+        volume : :class:`SharedVolume`
+            The published volume
+        """
+
+        # The published bytes are always little endian
+        dtype = np.dtype(dtype).newbyteorder('<')
+        shape = tuple(int(size) for size in shape)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        name = 'nrrd-%s' % uuid.uuid4().hex
+        descriptor = {'name': name, 'dtype': dtype.str, 'shape': list(shape), 'offset': 0,
+                      'index_order': index_order,
+                      'header': dict((field, _json_value(header[field])) for field in _SPATIAL_FIELDS
+                                     if header is not None and field in header)}
+
+        # Zero sized segments and files can't be mapped, so there is at least one byte
+        size = max(nbytes, 1)
+        if use_shared_memory and shared_memory is not None:
+            handle = shared_memory.SharedMemory(name=name, create=True, size=size)
+            buffer = handle.buf
+            descriptor['kind'] = 'shared_memory'
+        else:
+            path = os.path.join(_shared_directory(), name + '.raw')
+            handle = buffer = np.memmap(path, dtype=np.uint8, mode='w+', shape=(size,))
+            descriptor['kind'] = 'file'
+            descriptor['path'] = path
+
+        array = np.ndarray(shape, dtype, buffer=buffer, order=index_order)
+        descriptor['strides'] = list(array.strides)
+
+        volume = cls(descriptor, array, handle)
+        with _published_lock:
+            _published[name] = volume
+
+        return volume
+
+    @classmethod
+    def publish(cls, data, header=None, index_order='C', use_shared_memory=False):
+        """Copy :obj:`data` into shared memory as little endian
+
+        See :meth:`allocate` for the parameters, :obj:`data` is the array to publish. Returns the published
+        :class:`SharedVolume`.
+        """
+
+        volume = cls.allocate(data.shape, data.dtype, header, index_order, use_shared_memory)
+        volume.array[...] = data
+        volume.flush()
+
+        return volume
+
+    def flush(self):
+        """Write the array of a volume in a file to the file, so other processes see it"""
+
+        if self.descriptor['kind'] == 'file' and self._handle is not None:
+            self._handle.flush()
+
+    @classmethod
+    def attach(cls, descriptor):
+        """Map the published volume of :obj:`descriptor` without copying it
+
+        Parameters
+        ----------
+        descriptor : :class:`dict`
+            Descriptor of the volume, see :attr:`descriptor`
+
+        Returns
+        -------
+        volume : :class:`SharedVolume`
+            The volume, which must be kept referenced while its :attr:`array` is used
+        """
+
+        dtype = np.dtype(descriptor['dtype'])
+        if descriptor['kind'] == 'shared_memory':
+            if shared_memory is None:
+                raise RuntimeError('Shared memory segments require Python 3.8 or newer')
+            handle = shared_memory.SharedMemory(name=descriptor['name'])
+            buffer = handle.buf
+            # Attaching registers the segment to be unlinked when this process exits, but it belongs to the publisher
+            if os.name == 'posix':
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(handle._name, 'shared_memory')
+        else:
+            handle = buffer = np.memmap(descriptor['path'], dtype=np.uint8, mode='r+')
+
+        array = np.ndarray(descriptor['shape'], dtype, buffer=buffer, offset=descriptor['offset'],
+                           strides=descriptor['strides'])
+        return cls(descriptor, array, handle)
+
+    def close(self):
+        """Close this process's mapping of the volume, :attr:`array` must not be used afterwards"""
+
+        self.array = None
+        if self.descriptor['kind'] == 'shared_memory' and self._handle is not None:
+            self._handle.close()
+        self._handle = None
+
+    def unlink(self):
+        """Remove the shared memory segment or file of the volume, existing mappings stay valid"""
+
+        if self.descriptor['kind'] == 'shared_memory':
+            if self._handle is not None:
+                self._handle.unlink()
+            else:
+                handle = shared_memory.SharedMemory(name=self.descriptor['name'])
+                handle.close()
+                handle.unlink()
+        else:
+            os.remove(self.descriptor['path'])
+
+
+def release(name):
+    """Close and unlink the volume :obj:`name` published by this process
+
+    Returns :obj:`True` if the volume was published by this process and :obj:`False` otherwise.
+    """
+
+    with _published_lock:
+        volume = _published.pop(name, None)
+
+    if volume is None:
+        return False
+
+    volume.unlink()
+    volume.close()
+    return True
+
+
+def release_all():
+    """Close and unlink all volumes published by this process that can be unlinked"""
+
+    with _published_lock:
+        names = list(_published)
+
+    for name in names:
+        try:
+            release(name)
+        except OSError:
+            pass
@@ -0,0 +1,327 @@
+"""Storage of traced streamlines
+
+A streamline file holds streamlines packed like :func:`tractography.track` returns them, the points of all
+streamlines as little endian float32 (N, 3) and uint32 offsets, and a coarse index of the streamlines passing through
+each cell of the voxel grid. It is written batch by batch with :class:`StreamlineWriter` while the streamlines are
+traced and read with :class:`StreamlineFile`, which maps the points and offsets without reading them.
+
+The file starts with the magic bytes, the length of the JSON header as a little endian uint32 and the JSON header,
+with the 'shape' of the voxel grid in C order, its 'space directions' and 'space origin', the NRRD 'space' they are
+in, whether the points are in 'world' space or voxel coordinates in C order and the 'cell size' of the index in
+voxels. Then come the points, the offsets, the index as uint64 offsets of the cells into the uint32 streamline numbers
+of all cells, and a footer with the positions and sizes of these parts, ending with the magic bytes.
+
+Streamlines can be exported to TrackVis .trk and MRtrix .tck files with :func:`write_trk` and :func:`write_tck`.
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+_STREAMLINE_MAGIC = b'NRRDSTR1'
+_STREAMLINE_HEADER_SIZE = struct.Struct('<I')
+_STREAMLINE_FOOTER = struct.Struct('<6Q8s')
+
+# Size of the cells of the index along each axis in voxels
+_CELL_SIZE = 4
+
+# Header of a TrackVis file, see http://trackvis.org/docs/?subsect=fileformat
+_TRK_HEADER = struct.Struct('<6s3h3f3fh200sh200s64s444s4s4s6f2s6Biii')
+
+# Signs that take the world axes of a NRRD space to RAS, the world space of TrackVis. Other spaces are taken to be RAS
+_RAS_SIGNS = {'right-anterior-superior': (1, 1, 1), 'RAS': (1, 1, 1), 'left-anterior-superior': (-1, 1, 1),
+              'LAS': (-1, 1, 1), 'left-posterior-superior': (-1, -1, 1), 'LPS': (-1, -1, 1)}
+
+
+class _Grid(object):
+    """Voxel grid of a streamline file, mapping points to voxels and index cells"""
+
+    def __init__(self, shape, space_directions=None, space_origin=None, world=True, cell_size=_CELL_SIZE, space=None):
+        self.shape = tuple(int(size) for size in shape)
+        self.space_directions = np.eye(3) if space_directions is None else np.asarray(space_directions, dtype=float)
+        self.space_origin = np.zeros(3) if space_origin is None else np.asarray(space_origin, dtype=float)
+        self._inverse = np.linalg.inv(self.space_directions)
+        self.space = space
+        self.world = world
+        self.cell_size = cell_size
+        self.cell_shape = tuple(-(-size // cell_size) for size in self.shape)
+
+    def to_voxels(self, points):
+        """Voxel coordinates in C order of points"""
+
+        if not self.world:
+            return np.asarray(points, dtype=float)
+
+        return np.dot(points - self.space_origin, self._inverse)[:, ::-1]
+
+    def to_world(self, points):
+        """World space positions of points"""
+
+        if self.world:
+            return np.asarray(points, dtype=float)
+
+        return np.dot(points[:, ::-1], self.space_directions) + self.space_origin
+
+    def cells(self, points):
+        """Index cells of points, points outside the grid are put in the nearest cell"""
+
+        cells = np.rint(self.to_voxels(points)).astype(np.int64) // self.cell_size
+        cells = np.clip(cells, 0, np.array(self.cell_shape) - 1)
+        return np.ravel_multi_index(cells.T, self.cell_shape)
+
+    def header(self):
+        return {'shape': list(self.shape), 'space directions': self.space_directions.tolist(),
+                'space origin': self.space_origin.tolist(), 'space': self.space, 'world': self.world,
+                'cell size': self.cell_size}
+
+
+class StreamlineWriter(object):
+    """Write a streamline file batch by batch
+
+    The file is written to a temporary file next to :obj:`filename` and renamed to it by :meth:`close`, so a
+    streamline file is always complete.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Filename of the streamline file
+    shape : :class:`tuple` of :class:`int`
+        Shape of the voxel grid in C order, e.g. the shape of the FA map of the tensor field
+    space_directions : :class:`numpy.ndarray`, optional
+        3x3 matrix whose rows are the world space vectors of the x, y and z voxel axes. Defaults to the identity
+    space_origin : :class:`numpy.ndarray`, optional
+        World space position of voxel (0, 0, 0). Defaults to the origin
+    world : :class:`bool`, optional
+        Whether the points are in world space, otherwise they are voxel coordinates in C order
+    cell_size : :class:`int`, optional
+        Size of the cells of the index along each axis in voxels
+    space : :class:`str`, optional
+        NRRD 'space' of the world space, e.g. 'left-posterior-superior'. Exports take an unknown space to be RAS
+    """
+
+    def __init__(self, filename, shape, space_directions=None, space_origin=None, world=True, cell_size=_CELL_SIZE,
+                 space=None):
+        self.filename = filename
+        self._grid = _Grid(shape, space_directions, space_origin, world, cell_size, space)
+        self._offsets = [np.zeros(1, dtype=np.int64)]
+        self._pairs = []
+        self._point_count = 0
+        self._count = 0
+
+        header = json.dumps(self._grid.header()).encode('utf-8')
+        self._fh = open(filename + '.tmp', 'wb')
+        self._fh.write(_STREAMLINE_MAGIC + _STREAMLINE_HEADER_SIZE.pack(len(header)) + header)
+        self._data_start = self._fh.tell()
+
+    def append(self, points, offsets):
+        """Append a batch of streamlines packed like :func:`tractography.track` returns them"""
+
+        points = np.asarray(points, dtype='<f4').reshape(-1, 3)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if self._point_count + len(points) >= 2 ** 32:
+            raise ValueError('A streamline file holds less than 2^32 points')
+
+        self._fh.write(np.ascontiguousarray(points).data)
+
+        # Unique cell and streamline number pairs, as cell * 2^32 + number
+        numbers = np.repeat(np.arange(self._count, self._count + len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+        self._pairs.append(np.unique(self._grid.cells(points) << 32 | numbers))
+
+        self._offsets.append(offsets[1:] - offsets[0] + self._point_count)
+        self._point_count += len(points)
+        self._count += len(offsets) - 1
+
+    def close(self):
+        """Write the offsets and the index and rename the file to :obj:`filename`"""
+
+        offsets_start = self._fh.tell()
+        self._fh.write(np.concatenate(self._offsets).astype('<u4').data)
+
+        pairs = np.sort(np.concatenate(self._pairs)) if self._pairs else np.zeros(0, dtype=np.int64)
+        cell_count = int(np.prod(self._grid.cell_shape))
+        cell_offsets = np.searchsorted(pairs >> 32, np.arange(cell_count + 1)).astype('<u8')
+
+        index_start = self._fh.tell()
+        self._fh.write(cell_offsets.data)
+        self._fh.write((pairs & 0xffffffff).astype('<u4').data)
+        self._fh.write(_STREAMLINE_FOOTER.pack(self._data_start, self._point_count, offsets_start, self._count,
+                                               index_start, len(pairs), _STREAMLINE_MAGIC))
+        self._fh.close()
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._fh.close()
+            os.remove(self.filename + '.tmp')
+
+
+class StreamlineFile(object):
+    """Streamline file written by :class:`StreamlineWriter`
+
+    The points, offsets and index are memory-mapped. Indexing the file with a streamline number returns the (n, 3)
+    points of that streamline.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Filename of the streamline file
+
+    Attributes
+    ----------
+    points : :class:`numpy.ndarray`
+        (N, 3) float32 points of all streamlines
+    offsets : :class:`numpy.ndarray`
+        uint32 offsets of the streamlines in :attr:`points`, one more than there are streamlines
+    shape : :class:`tuple` of :class:`int`
+        Shape of the voxel grid in C order
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, 'rb') as fh:
+            if fh.read(len(_STREAMLINE_MAGIC)) != _STREAMLINE_MAGIC:
+                raise ValueError('Not a streamline file: %s' % filename)
+
+            header_size, = _STREAMLINE_HEADER_SIZE.unpack(fh.read(_STREAMLINE_HEADER_SIZE.size))
+            info = json.loads(fh.read(header_size).decode('utf-8'))
+
+            fh.seek(-_STREAMLINE_FOOTER.size, os.SEEK_END)
+            footer = _STREAMLINE_FOOTER.unpack(fh.read(_STREAMLINE_FOOTER.size))
+            if footer[-1] != _STREAMLINE_MAGIC:
+                raise ValueError('Streamline file is incomplete: %s' % filename)
+
+        data_start, point_count, offsets_start, count, index_start, pair_count, _ = footer
+        self._grid = _Grid(info['shape'], info['space directions'], info['space origin'], info['world'],
+                           info['cell size'], info.get('space'))
+        self.shape = self._grid.shape
+
+        mapped = np.memmap(filename, dtype=np.uint8, mode='r')
+        self.points = mapped[data_start:data_start + 12 * point_count].view('<f4').reshape(-1, 3)
+        self.offsets = mapped[offsets_start:offsets_start + 4 * (count + 1)].view('<u4')
+
+        cell_count = int(np.prod(self._grid.cell_shape))
+        self._cell_offsets = mapped[index_start:index_start + 8 * (cell_count + 1)].view('<u8')
+        numbers_start = index_start + 8 * (cell_count + 1)
+        self._numbers = mapped[numbers_start:numbers_start + 4 * pair_count].view('<u4')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, number):
+        return self.points[self.offsets[number]:self.offsets[number + 1]]
+
+    def __iter__(self):
+        for number in range(len(self)):
+            yield self[number]
+
+    def streamlines_in_region(self, start, stop, exact=False):
+        """Numbers of the streamlines passing through a box of voxels
+
+        Parameters
+        ----------
+        start, stop : :class:`tuple` of :class:`int`
+            Corners of the box of voxels in C order, :obj:`stop` being exclusive
+        exact : :class:`bool`, optional
+            Only return the streamlines with a point in the box. Otherwise all streamlines passing through the cells of
+            the index that the box touches are returned, which is a lookup in the index without reading points
+
+        Returns
+        -------
+        numbers : :class:`numpy.ndarray`
+            Sorted streamline numbers
+        """
+
+        start = np.maximum(np.asarray(start), 0)
+        stop = np.minimum(np.asarray(stop), self.shape)
+        if (stop <= start).any():
+            return np.zeros(0, dtype=np.uint32)
+
+        cell_size = self._grid.cell_size
+        ranges = [np.arange(a // cell_size, (b - 1) // cell_size + 1) for a, b in zip(start, stop)]
+        cells = np.ravel_multi_index(np.meshgrid(*ranges, indexing='ij'), self._grid.cell_shape).ravel()
+        numbers = np.unique(np.concatenate([self._numbers[self._cell_offsets[cell]:self._cell_offsets[cell + 1]]
+                                            for cell in cells]))
+        if not exact:
+            return numbers
+
+        def passes(number):
+            voxels = np.rint(self._grid.to_voxels(self[number]))
+            return ((voxels >= start) & (voxels < stop)).all(axis=1).any()
+
+        return numbers[[passes(number) for number in numbers]] if len(numbers) else numbers
+
+    def world_points(self, number):
+        """Points of streamline :obj:`number` in world space"""
+
+        return self._grid.to_world(self[number])
+
+    def voxel_points(self, number):
+        """Points of streamline :obj:`number` in voxel coordinates in C order"""
+
+        return self._grid.to_voxels(self[number])
+
+
+def write_tck(streamlines, filename):
+    """Export a :class:`StreamlineFile` to a MRtrix .tck file, with the points in world space"""
+
+    with open(filename, 'wb') as fh:
+        # The offset of the data is in the header, so the header is written with a placeholder of the same size first
+        header = 'mrtrix tracks\ncount: %d\ndatatype: Float32LE\nfile: . %%10d\nEND\n' % len(streamlines)
+        data_start = len((header % 0).encode('ascii'))
+        fh.write((header % data_start).encode('ascii'))
+
+        separator = np.full((1, 3), np.nan, dtype='<f4')
+        for number in range(len(streamlines)):
+            fh.write(streamlines.world_points(number).astype('<f4').data)
+            fh.write(separator.data)
+        fh.write(np.full((1, 3), np.inf, dtype='<f4').data)
+
+
+def _voxel_order(space_directions):
+    """TrackVis voxel order of voxel axes in RAS space, the letter of the world axis closest to each of x, y and z
+
+    LPS, the default of the format, when two voxel axes are closest to the same world axis.
+    """
+
+    axes = np.abs(space_directions).argmax(axis=1)
+    if len(set(axes)) < 3:
+        return b'LPS'
+    return bytes(bytearray(ord('RAS'[axis] if direction[axis] > 0 else 'LPI'[axis])
+                           for axis, direction in zip(axes, space_directions)))
+
+
+def write_trk(streamlines, filename):
+    """Export a :class:`StreamlineFile` to a TrackVis .trk file (version 2)
+
+    The points are written in the voxel millimeter space of TrackVis, where the corner of the first voxel is the origin
+    and the axes are the voxel axes x, y and z scaled by the voxel size. The voxel to world matrix of the header is
+    made from the space directions and space origin of the file, taken from its space to RAS, and the voxel order from
+    the space directions in RAS.
+    """
+
+    grid = streamlines._grid
+    signs = np.array(_RAS_SIGNS.get(grid.space, (1, 1, 1)), dtype=float)
+    space_directions = grid.space_directions * signs
+    voxel_size = np.linalg.norm(space_directions, axis=1)
+    vox_to_ras = np.eye(4)
+    vox_to_ras[:3, :3] = space_directions.T
+    vox_to_ras[:3, 3] = grid.space_origin * signs
+    voxel_order = _voxel_order(space_directions)
+
+    header = _TRK_HEADER.pack(b'TRACK', *(grid.shape[::-1] + tuple(voxel_size) + (0.0, 0.0, 0.0) + (0, b'', 0, b'') +
+                                          (vox_to_ras.astype('<f4').tobytes(), b'', voxel_order, b'') + (0.0,) * 6 +
+                                          (b'',) + (0,) * 6 + (len(streamlines), 2, _TRK_HEADER.size)))
+
+    with open(filename, 'wb') as fh:
+        fh.write(header)
+        for number in range(len(streamlines)):
+            voxmm = (streamlines.voxel_points(number)[:, ::-1] + 0.5) * voxel_size
+            fh.write(struct.pack('<i', len(voxmm)))
+            fh.write(voxmm.astype('<f4').data)
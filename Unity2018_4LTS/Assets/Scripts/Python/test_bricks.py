@@ -0,0 +1,94 @@
+"""Tests of brick files, compared with :func:`pynrrd.read` of the NRRD files they are converted from
+
+    python -m unittest test_bricks
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import bricks
+import pynrrd
+
+# Bricks that do not divide the volume, so the bricks at the end of each axis are cut off
+_BRICK = (4, 3, 5)
+
+
+class BrickVolumeTest(unittest.TestCase):
+    """Regions of brick files"""
+
+    # Keys with slices, negative steps, integers, negative integers, Ellipsis and empty slices, in C order
+    KEYS = [Ellipsis, (slice(None),), (slice(2, 7), 3, slice(None, None, -2)), (-1,), (Ellipsis, 0),
+            (slice(8, 1, -3),), (1, 2, 3), (slice(None), slice(-4, None), Ellipsis), (slice(3, 3),),
+            (Ellipsis, slice(9, 0, -4), slice(None)), (0, Ellipsis, -2)]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def convert(self, data, encoding='raw', **kwargs):
+        """Write :obj:`data` in C order to a NRRD file, convert it to a brick file and return both filenames"""
+
+        filename = os.path.join(self.directory, 'volume.nrrd')
+        output = os.path.join(self.directory, 'volume.nbrk')
+        pynrrd.write(filename, data, {'encoding': encoding}, index_order='C')
+        bricks.convert(filename, output, **kwargs)
+        return filename, output
+
+    def check_keys(self, filename, output, threads=None):
+        for index_order in ['C', 'F']:
+            expected = pynrrd.read(filename, index_order=index_order)[0]
+            with bricks.BrickVolume(output, index_order=index_order, threads=threads) as volume:
+                self.assertEqual(volume.shape, expected.shape)
+                self.assertEqual(volume.dtype, expected.dtype.newbyteorder('<'))
+                self.assertEqual(len(volume), len(expected))
+                np.testing.assert_array_equal(volume.header['sizes'], pynrrd.read(filename)[1]['sizes'])
+
+                for key in self.KEYS:
+                    with self.subTest(index_order=index_order, key=key):
+                        np.testing.assert_array_equal(volume[key], expected[key])
+
+    def test_codecs(self):
+        data = np.random.RandomState(0).randint(-1000, 1000, size=(9, 10, 11)).astype('<i2')
+        for codec in ['zlib', 'bz2', 'lzma', 'none']:
+            for threads in [1, 3]:
+                with self.subTest(codec=codec, threads=threads):
+                    filename, output = self.convert(data, brick=_BRICK, codec=codec, threads=threads)
+                    self.check_keys(filename, output, threads)
+
+    def test_components(self):
+        # The axes after the spatial axes are kept whole in each brick, the source is read in slabs from gzip data
+        data = np.random.RandomState(1).standard_normal((9, 10, 11, 6)).astype('>f4')
+        filename, output = self.convert(data, 'gzip', brick=_BRICK, threads=2)
+        self.check_keys(filename, output, threads=2)
+
+    def test_read_region(self):
+        data = np.arange(9 * 10 * 11, dtype=np.int32).reshape(9, 10, 11)
+        _, output = self.convert(data, brick=_BRICK)
+        with bricks.BrickVolume(output) as volume:
+            for start, stop in [((0, 0, 0), (9, 10, 11)), ((3, 2, 4), (5, 9, 11)), ((8, 9, 10), (9, 10, 11)),
+                                ((4, 3, 5), (8, 6, 10)), ((2, 2, 2), (2, 5, 5))]:
+                with self.subTest(start=start, stop=stop):
+                    np.testing.assert_array_equal(volume.read_region(start, stop),
+                                                  data[tuple(slice(a, b) for a, b in zip(start, stop))])
+
+    def test_invalid(self):
+        _, output = self.convert(np.zeros((4, 5, 6), dtype=np.uint8), brick=_BRICK)
+        with bricks.BrickVolume(output) as volume:
+            for key in [(0, 0, 0, 0), (4,), (Ellipsis, -7), ([0, 1],), (np.zeros(4, dtype=bool),), (1.5,)]:
+                with self.subTest(key=key):
+                    with self.assertRaises(IndexError):
+                        volume[key]
+
+        with self.assertRaises(ValueError):
+            self.convert(np.zeros((4, 5, 6), dtype=np.uint8), codec='zip')
+        with self.assertRaises(ValueError):
+            self.convert(np.zeros((4, 5), dtype=np.uint8))
+        with self.assertRaises(ValueError):
+            bricks.BrickVolume(os.path.join(self.directory, 'volume.nrrd'))
+
+
+if __name__ == '__main__':
+    unittest.main()
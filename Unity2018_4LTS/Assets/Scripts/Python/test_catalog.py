@@ -0,0 +1,123 @@
+"""Tests of the catalog of NRRD and npy files and of its incremental rescan
+
+    python -m unittest test_catalog
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import catalog
+import pynrrd
+
+
+class CatalogTest(unittest.TestCase):
+    """Catalog of a directory with an attached and a detached NRRD file and a npy file"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        os.makedirs(os.path.join(self.directory, 'sub'))
+        self.data = np.arange(2 * 3 * 4, dtype=np.int16).reshape(2, 3, 4)
+        pynrrd.write(self.path('a.nrrd'), self.data, {'encoding': 'gzip', 'space directions': np.diag([1, 2, 3])},
+                     index_order='C')
+        pynrrd.write(self.path('sub', 'b.nhdr'), self.data, {'encoding': 'raw'}, detached_header=True,
+                     index_order='C')
+        np.save(self.path('c.npy'), self.data.astype(np.float32))
+        with open(self.path('notes.txt'), 'w') as fh:
+            fh.write('not cataloged\n')
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def touch(self, name, seconds=1):
+        """Move the modification time of :obj:`name` by :obj:`seconds` without changing its size"""
+
+        stat = os.stat(self.path(name))
+        os.utime(self.path(name), ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10 ** 9))
+
+    def scan(self):
+        """Scan and save the catalog, and reload it from its file as the next run would"""
+
+        entries = catalog.Catalog(self.directory)
+        scanned = entries.scan()
+        entries.save()
+        return catalog.Catalog(self.directory), scanned
+
+    def test_entries(self):
+        entries, scanned = self.scan()
+        self.assertEqual(scanned, (3, 0, 0))
+        self.assertEqual(sorted(entries.entries), ['a.nrrd', 'c.npy', 'sub/b.nhdr'])
+
+        entry = entries.entries['a.nrrd']
+        self.assertEqual((entry['shape'], entry['spacing'], entry['encoding']), ([4, 3, 2], [1, 2, 3], 'gzip'))
+        self.assertIsNone(entry['data file'])
+        self.assertEqual(entry['data offset'] + entry['data size'], os.path.getsize(self.path('a.nrrd')))
+
+        entry = entries.entries['sub/b.nhdr']
+        self.assertEqual(entry['data file'], os.path.abspath(self.path('sub', 'b.raw')))
+        self.assertEqual(entry['data size'], self.data.nbytes)
+
+        entry = entries.entries['c.npy']
+        self.assertEqual((entry['shape'], entry['dtype'], entry['fortran order']), ([2, 3, 4], '<f4', False))
+        self.assertEqual(entry['data size'], self.data.size * 4)
+
+    def test_rescan(self):
+        entries, _ = self.scan()
+        self.assertEqual(entries.scan(), (0, 3, 0))
+
+        # Headers are only read for the files whose modification time or size changed
+        with mock.patch.object(catalog, 'scan_nrrd', wraps=catalog.scan_nrrd) as scan_nrrd:
+            self.touch('a.nrrd')
+            self.assertEqual(entries.scan(), (1, 2, 0))
+            scan_nrrd.assert_called_once_with(self.path('a.nrrd'))
+
+            scan_nrrd.reset_mock()
+            self.assertEqual(entries.scan(), (0, 3, 0))
+            scan_nrrd.assert_not_called()
+
+        # The same modification time with a different size, and a detached data file that changed size
+        with open(self.path('a.nrrd'), 'ab') as fh:
+            fh.write(b'\0')
+        self.touch('a.nrrd', 0)
+        with open(self.path('sub', 'b.raw'), 'ab') as fh:
+            fh.write(b'\0\0')
+        self.assertEqual(entries.scan(), (2, 1, 0))
+        self.assertEqual(entries.entries['sub/b.nhdr']['data size'], self.data.nbytes + 2)
+
+        # New files are scanned and the entries of removed files dropped
+        os.remove(self.path('c.npy'))
+        np.save(self.path('sub', 'd.npy'), np.zeros(3))
+        self.assertEqual(entries.scan(), (1, 2, 1))
+        self.assertEqual(sorted(entries.entries), ['a.nrrd', 'sub/b.nhdr', 'sub/d.npy'])
+
+    def test_unreadable(self):
+        with open(self.path('broken.nrrd'), 'w') as fh:
+            fh.write('not a NRRD file\n')
+        entries, scanned = self.scan()
+        self.assertEqual(scanned, (4, 0, 0))
+        self.assertIn('error', entries.entries['broken.nrrd'])
+
+        # Files whose header could not be read are not read again until they change
+        self.assertEqual(entries.scan(), (0, 4, 0))
+
+    def test_header_blocks(self):
+        # Header fields spanning several blocks, with the blank line that ends the header across two blocks
+        expected = catalog.scan_nrrd(self.path('a.nrrd'))
+        for block_size in [1, 2, 7]:
+            with self.subTest(block_size=block_size):
+                with mock.patch.object(catalog, '_HEADER_BLOCK_SIZE', block_size):
+                    self.assertEqual(catalog.scan_nrrd(self.path('a.nrrd')), expected)
+
+        # The size limit is checked between blocks
+        with mock.patch.object(catalog, '_HEADER_BLOCK_SIZE', 4), mock.patch.object(catalog, '_HEADER_SIZE_LIMIT', 16):
+            with self.assertRaises(ValueError):
+                catalog.scan_nrrd(self.path('a.nrrd'))
+
+
+if __name__ == '__main__':
+    unittest.main()
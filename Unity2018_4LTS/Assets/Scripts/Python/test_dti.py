@@ -0,0 +1,173 @@
+"""Tests of the eigen decomposition and scalar maps of tensor fields
+
+    python -m unittest test_dti
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import dti
+import pynrrd
+
+
+def _rotation(rng):
+    """Random rotation matrix"""
+
+    q, r = np.linalg.qr(rng.standard_normal((3, 3)))
+    q *= np.sign(np.diagonal(r))
+    return q if np.linalg.det(q) > 0 else -q
+
+
+def _tensor_field(rng, shape):
+    """Field of :obj:`shape` of symmetric tensors with random eigenvalues in (0, 1) and their eigen decomposition"""
+
+    eigenvalues = -np.sort(-rng.uniform(0, 1, shape + (3,)), axis=-1)
+    rotations = np.array([_rotation(rng) for _ in range(int(np.prod(shape)))]).reshape(shape + (3, 3))
+    tensors = np.einsum('...ij,...j,...kj->...ik', rotations, eigenvalues, rotations)
+    return tensors.reshape(shape + (9,)), eigenvalues, rotations[..., 0]
+
+
+class EigenMapsTest(unittest.TestCase):
+    """Maps of known tensors"""
+
+    def test_known_tensors(self):
+        rng = np.random.RandomState(0)
+        data, eigenvalues, evec = _tensor_field(rng, (3, 4, 5))
+        for chunk_size in [1, 7, 2 ** 14]:
+            with self.subTest(chunk_size=chunk_size):
+                maps = dti.eigen_maps(data.astype(np.float32), chunk_size)
+                for name, shape in [('eigenvalues', (3, 4, 5, 3)), ('evec', (3, 4, 5, 3)), ('fa', (3, 4, 5)),
+                                    ('md', (3, 4, 5))]:
+                    self.assertEqual((maps[name].shape, maps[name].dtype), (shape, np.float32))
+
+                np.testing.assert_allclose(maps['eigenvalues'], eigenvalues, atol=1e-5)
+                # The sign of an eigenvector is arbitrary
+                np.testing.assert_allclose(np.abs((maps['evec'] * evec).sum(axis=-1)), 1, atol=1e-4)
+                np.testing.assert_allclose(maps['md'], eigenvalues.mean(axis=-1), atol=1e-5)
+                deviation = eigenvalues - eigenvalues.mean(axis=-1, keepdims=True)
+                np.testing.assert_allclose(maps['fa'], np.sqrt(1.5 * (deviation ** 2).sum(axis=-1)
+                                                               / (eigenvalues ** 2).sum(axis=-1)), atol=1e-5)
+
+    def test_special_tensors(self):
+        data = np.zeros((4, 9))
+        data[1] = np.diag([3, 2, 1]).ravel()
+        data[2] = np.eye(3).ravel()
+        data[3] = np.diag([1, 1, np.inf]).ravel()
+        maps = dti.eigen_maps(data)
+
+        np.testing.assert_allclose(maps['eigenvalues'], [[0, 0, 0], [3, 2, 1], [1, 1, 1], [0, 0, 0]])
+        np.testing.assert_allclose(np.abs(maps['evec'][1]), [1, 0, 0])
+        # Zero and non-finite tensors have no anisotropy, nor has an isotropic one
+        np.testing.assert_allclose(maps['fa'], [0, np.sqrt(3 / 14), 0, 0], atol=1e-7)
+        np.testing.assert_allclose(maps['md'], [0, 2, 1, 0])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            dti.eigen_maps(np.zeros((2, 3, 6)))
+        with self.assertRaises(ValueError):
+            dti.magnitude_map(np.zeros((2, 9, 3)))
+        with self.assertRaises(ValueError):
+            dti.fa_map(np.zeros(8))
+
+
+class MagnitudeMapTest(unittest.TestCase):
+    """Largest column norms of random tensors"""
+
+    def test_random(self):
+        data = np.random.RandomState(1).standard_normal((4, 5, 6, 9))
+        expected = np.linalg.norm(data.reshape(4, 5, 6, 3, 3), axis=-2).max(axis=-1)
+        for chunk_size in [1, 11, 2 ** 14]:
+            with self.subTest(chunk_size=chunk_size):
+                magnitude = dti.magnitude_map(data, chunk_size)
+                self.assertEqual(magnitude.dtype, np.float32)
+                np.testing.assert_allclose(magnitude, expected, rtol=1e-6)
+
+        # Columns, not rows
+        tensor = np.array([[3, 4, 0], [0, 0, 0], [0, 0, 0]], dtype=np.float32)
+        np.testing.assert_allclose(dti.magnitude_map(tensor.reshape(9)), 4)
+
+        # The axes don't need to be contiguous
+        np.testing.assert_allclose(dti.magnitude_map(data[:, ::2]), expected[:, ::2], rtol=1e-6)
+
+
+class FaMapTest(unittest.TestCase):
+    """FA without the decomposition, compared with the FA of the eigenvalues"""
+
+    def check(self, data):
+        for chunk_size in [1, 13, 2 ** 14]:
+            with self.subTest(chunk_size=chunk_size):
+                fa = dti.fa_map(data, chunk_size)
+                self.assertEqual((fa.shape, fa.dtype), (data.shape[:-1], np.float32))
+                np.testing.assert_allclose(fa, dti.eigen_maps(data)['fa'], atol=1e-5)
+
+    def test_symmetric(self):
+        data, _, _ = _tensor_field(np.random.RandomState(3), (4, 5, 6))
+        self.check(data.astype(np.float32))
+
+        # Tensors with negative eigenvalues as well
+        tensors = np.random.RandomState(4).standard_normal((4, 5, 6, 3, 3))
+        self.check((tensors + np.swapaxes(tensors, -1, -2)).reshape(4, 5, 6, 9))
+
+    def test_non_symmetric(self):
+        # Both take the lower triangle
+        data = np.random.RandomState(5).standard_normal((4, 5, 6, 9))
+        self.check(data)
+        lower = data.reshape(4, 5, 6, 3, 3)
+        lower = np.tril(lower) + np.swapaxes(np.tril(lower, -1), -1, -2)
+        np.testing.assert_allclose(dti.fa_map(data), dti.fa_map(lower.reshape(4, 5, 6, 9)), atol=1e-6)
+
+    def test_non_finite(self):
+        data = np.random.RandomState(6).standard_normal((50, 9)).astype(np.float32)
+        data[[3, 10, 20]] = np.eye(3).ravel()
+        data[3, 4] = np.nan
+        data[10, 0] = np.inf
+        data[20, 8] = -np.inf
+        data[30] = 0
+        self.check(data)
+        np.testing.assert_array_equal(dti.fa_map(data)[[3, 10, 20, 30]], 0)
+
+
+class WriteEigenMapsTest(unittest.TestCase):
+    """Maps of a tensor field of (z, y, x) shape (7, 3, 4) in a NRRD file"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_slabs(self):
+        data, _, _ = _tensor_field(np.random.RandomState(2), (7, 3, 4))
+        data = data.astype('>f4')
+        filename = os.path.join(self.directory, 'tensors.nhdr')
+        header = {'encoding': 'gzip', 'space': 'left-posterior-superior', 'space origin': [1, 2, 3],
+                  'space directions': np.vstack([np.full(3, np.nan), np.diag([1, 2, 3])]),
+                  'kinds': ['3D-matrix', 'domain', 'domain', 'domain'], 'measurement frame': np.eye(3)[[1, 0, 2]]}
+        pynrrd.write(filename, data, header, detached_header=True, index_order='C')
+        expected = dti.eigen_maps(data)
+
+        # Slabs of 1 slice, of 2 slices with a last slab of 1 and the whole field
+        for slab_voxels in [1, 24, 2 ** 20]:
+            with self.subTest(slab_voxels=slab_voxels):
+                output = os.path.join(self.directory, str(slab_voxels))
+                with mock.patch.object(dti, '_SLAB_VOXELS', slab_voxels):
+                    filenames = dti.write_eigen_maps(filename, output, chunk_size=5)
+
+                self.assertEqual([os.path.basename(name) for name in filenames],
+                                 ['tensors_%s.nrrd' % name for name, _ in dti._EIGEN_MAPS])
+                for (name, kind), map_filename in zip(dti._EIGEN_MAPS, filenames):
+                    values, map_header = pynrrd.read(map_filename, index_order='C')
+                    np.testing.assert_array_equal(values, expected[name])
+                    np.testing.assert_array_equal(map_header['space origin'], [1, 2, 3])
+                    if kind is None:
+                        np.testing.assert_array_equal(map_header['space directions'], np.diag([1, 2, 3]))
+                        self.assertNotIn('measurement frame', map_header)
+                    else:
+                        self.assertEqual(map_header['kinds'][0], kind)
+                        np.testing.assert_array_equal(map_header['measurement frame'], np.eye(3)[[1, 0, 2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
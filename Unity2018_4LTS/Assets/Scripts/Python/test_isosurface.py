@@ -0,0 +1,115 @@
+"""Tests of isosurface meshes of spheres, which must wind counterclockwise seen from outside
+
+    python -m unittest test_isosurface
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import isosurface
+import pynrrd
+
+# World space center and radius of the spheres
+_CENTER = np.array([3.0, -2.0, 5.0])
+_RADIUS = 9.0
+
+
+def _sphere(shape, space_directions, space_origin):
+    """Volume of :obj:`shape` in C order of the distance inside the sphere, with the given space directions"""
+
+    voxels = np.stack(np.meshgrid(*[np.arange(size) for size in shape], indexing='ij'), axis=-1).reshape(-1, 3)
+    world = isosurface.to_world(voxels.astype(float), space_directions, space_origin)
+    return (_RADIUS - np.linalg.norm(world - _CENTER, axis=1)).reshape(shape).astype(np.float32)
+
+
+class SurfaceTest(unittest.TestCase):
+    """Spheres through volumes whose space directions mirror space or not"""
+
+    # Space directions, as rows x, y and z, and the shape in C order that holds the sphere
+    DIRECTIONS = {'negative determinant': (np.diag([-1.0, 1.5, 1.25]), (18, 16, 23)),
+                  'positive determinant': (np.diag([1.0, 1.5, 1.25]), (18, 16, 23)),
+                  'mixed signs, negative determinant': (np.array([[0, -1.5, 0], [1.25, 0, 0], [0, 0, -1.0]]),
+                                                        (23, 18, 16)),
+                  'mixed signs, positive determinant': (np.array([[0, -1.5, 0], [1.25, 0, 0], [0, 0, 1.0]]),
+                                                        (23, 18, 16))}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def check_outward(self, vertices, triangles, all_triangles=True):
+        """Check that the triangles wind counterclockwise seen from outside the sphere in world space"""
+
+        corners = vertices[triangles].astype(float) - _CENTER
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        outward = (normals * corners.mean(axis=1)).sum(axis=1)
+
+        # The signed volume of the mesh is positive for outward normals, and about the volume of the sphere
+        volume = np.einsum('ij,ij->i', corners[:, 0], np.cross(corners[:, 1], corners[:, 2])).sum() / 6
+        self.assertAlmostEqual(volume / (4 / 3 * np.pi * _RADIUS ** 3), 1, delta=0.1)
+        if all_triangles:
+            # Triangles with their 3 vertices on a line have no normal
+            self.assertFalse((outward < 0).any())
+        else:
+            self.assertGreater((outward > 0).mean(), 0.95)
+
+    def test_surface_nets(self):
+        # Voxel coordinates are world space with the identity directions, where an axis-aligned sphere is closed
+        shape = (21, 21, 21)
+        volume = _sphere(shape, np.eye(3), _CENTER - 10)
+        vertices, triangles = isosurface.surface_nets(volume, 0)
+
+        # The vertices are in C order, reversed they are world space with a mirrored winding
+        self.check_outward(vertices[:, ::-1] + _CENTER - 10, triangles[:, ::-1])
+        np.testing.assert_allclose(np.linalg.norm(vertices - 10, axis=1), _RADIUS, atol=0.1)
+
+        # Every edge of a closed mesh is shared by two triangles that walk it in opposite directions
+        edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+        self.assertEqual(len(np.unique(edges, axis=0)), len(edges))
+        np.testing.assert_array_equal(np.unique(edges, axis=0), np.unique(edges[:, ::-1], axis=0))
+
+    def test_extract(self):
+        for name, (directions, shape) in sorted(self.DIRECTIONS.items()):
+            # The sphere is in the middle of the volume
+            origin = _CENTER - isosurface.to_world((np.array(shape, dtype=float)[None] - 1) / 2, directions)[0]
+            filename = os.path.join(self.directory, 'sphere.nrrd')
+            pynrrd.write(filename, _sphere(shape, directions, origin),
+                         {'encoding': 'raw', 'space directions': directions, 'space origin': origin},
+                         index_order='C')
+
+            for max_triangles in [None, 2000, 500]:
+                with self.subTest(directions=name, max_triangles=max_triangles):
+                    vertices, normals, triangles = isosurface.extract(filename, 0, max_triangles=max_triangles)
+                    if max_triangles is not None:
+                        self.assertLessEqual(len(triangles), max_triangles)
+                    self.check_outward(vertices, triangles, max_triangles is None)
+
+                    # The vertex normals point outwards too
+                    self.assertGreater(((vertices - _CENTER) * normals).sum(axis=1).min(), 0)
+
+    def test_mesh_file(self):
+        volume = _sphere((21, 21, 21), np.eye(3), _CENTER - 10)
+        vertices, triangles = isosurface.surface_nets(volume, 0)
+        vertices = vertices.astype(np.float32)
+        normals = isosurface.vertex_normals(vertices, triangles).astype(np.float32)
+
+        filename = os.path.join(self.directory, 'mesh.bin')
+        for count in [len(vertices), 2 ** 16]:
+            with self.subTest(count=count):
+                padded = np.zeros((max(count, len(vertices)), 3), dtype=np.float32)
+                padded[:len(vertices)] = vertices
+                isosurface.write_mesh(filename, padded, padded, triangles)
+                actual = isosurface.read_mesh(filename)
+                np.testing.assert_array_equal(actual[0], padded)
+                np.testing.assert_array_equal(actual[2], triangles)
+                self.assertEqual(actual[2].dtype.itemsize, 2 if count < 2 ** 16 else 4)
+
+        isosurface.write_mesh(filename, vertices, normals, triangles)
+        np.testing.assert_array_equal(isosurface.read_mesh(filename)[1], normals)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+"""Tests of the JSON lines protocol of loadNrrd.py --serve and of its --batch mode
+
+    python -m unittest test_loadNrrd
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+import loadNrrd
+import pynrrd
+import sharedvolume
+
+
+def _args(**kwargs):
+    """Command line options of the server, with the defaults of loadNrrd.py"""
+
+    args = dict(format='npy', float16=False, cache=None, cache_size=2048, slices=None, workers=1, magnitude=False,
+                fa=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+class _Responses(object):
+    """Output of the server that queues the responses it writes"""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def write(self, text):
+        for line in text.splitlines():
+            self.queue.put(json.loads(line))
+
+    def flush(self):
+        pass
+
+    def get(self):
+        return self.queue.get(timeout=60)
+
+
+class ServeTest(unittest.TestCase):
+    """Requests to convert a tensor field of (z, y, x) shape (2, 3, 4)"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.data = np.random.RandomState(0).standard_normal((2, 3, 4, 9)).astype(np.float32)
+        self.filename = os.path.join(self.directory, 'tensors.nrrd')
+        pynrrd.write(self.filename, self.data, {'encoding': 'raw', 'space': 'left-posterior-superior'},
+                     index_order='C')
+        self.output = os.path.join(self.directory, 'output')
+
+    def serve(self, requests, **kwargs):
+        """Serve the lines :obj:`requests` until their end and return the responses"""
+
+        stdout = io.StringIO()
+        self.assertEqual(loadNrrd.serve(_args(**kwargs), io.StringIO(''.join(requests)), stdout), 0)
+        return [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    def request(self, **request):
+        return json.dumps(dict(request, directory=self.output)) + '\n'
+
+    def test_convert(self):
+        cache = os.path.join(self.directory, 'cache')
+        responses = self.serve([self.request(id=1, path=self.filename, cache=cache, maps=['fa']),
+                                self.request(id='2', command='header', path=self.filename)])
+
+        self.assertEqual([response['stage'] for response in responses if response['status'] == 'progress'],
+                         ['reading', 'saving', 'computing fa'])
+        convert, header = responses[-2:]
+        self.assertEqual((convert['id'], convert['status'], convert['cached']), (1, 'done', False))
+        np.testing.assert_array_equal(np.load(convert['output']), self.data)
+        self.assertEqual((header['id'], header['status']), ('2', 'done'))
+        self.assertEqual(header['header']['sizes'], [9, 4, 3, 2])
+        self.assertEqual(header['header']['space'], 'left-posterior-superior')
+
+        # The second conversion is found in the cache
+        responses = self.serve([self.request(id=3, path=self.filename, cache=cache, maps=['fa'])])
+        self.assertEqual((responses[-1]['output'], responses[-1]['cached']), (convert['output'], True))
+
+    def test_errors(self):
+        responses = self.serve(['not json\n', '\n', '[1, 2]\n',
+                                self.request(id=1, command='rotate'),
+                                self.request(id=2, path=os.path.join(self.directory, 'missing.nrrd')),
+                                self.request(id=3, path=self.filename, format='int64', float16=True),
+                                self.request(command='shutdown'),
+                                self.request(id=4, path=self.filename)])
+
+        # The blank line is skipped and the request after the shutdown is not read
+        responses = [response for response in responses if response['status'] != 'progress']
+        self.assertEqual([(response['id'], response['status']) for response in responses],
+                         [(None, 'error'), (None, 'error'), (1, 'error'), (2, 'error'), (3, 'error')])
+        self.assertTrue(responses[0]['error'].startswith('Invalid request: '))
+        self.assertEqual(responses[1]['error'], 'Invalid request: expected an object')
+        self.assertEqual(responses[2]['error'], "ValueError: Unknown command 'rotate'")
+        self.assertTrue(responses[3]['error'].startswith('FileNotFoundError: '))
+
+        # The request directories of the failed conversions are removed
+        self.assertEqual(os.listdir(self.output), [])
+
+    def test_request_directories(self):
+        responses = self.serve([self.request(id='a/1', path=self.filename),
+                                self.request(id='a/1', path=self.filename, format='raw')])
+
+        # Requests with the same id get different directories, named after the id, which are removed at exit
+        outputs = [response['output'] for response in responses if response['status'] == 'done']
+        self.assertEqual(len(set(os.path.dirname(output) for output in outputs)), 2)
+        for output in outputs:
+            self.assertTrue(os.path.basename(os.path.dirname(output)).startswith('request-a_1-'))
+        self.assertEqual(os.listdir(self.output), [])
+
+    def test_release(self):
+        # The server reads the requests as they are queued
+        requests = queue.Queue()
+        stdin = io.StringIO()
+        stdin.readline = requests.get
+        responses = _Responses()
+        server = threading.Thread(target=loadNrrd.serve, args=(_args(format='shm'), stdin, responses))
+        server.start()
+        self.addCleanup(server.join, 60)
+        self.addCleanup(requests.put, '')
+
+        names = []
+        for request_id in [1, 2]:
+            requests.put(self.request(id=request_id, path=self.filename))
+            response = responses.get()
+            while response['status'] == 'progress':
+                response = responses.get()
+            self.assertEqual(response['status'], 'done')
+
+            with open(response['output']) as fh:
+                descriptor = json.load(fh)
+            # Attaching in the publishing process would unregister the segment from its resource tracker
+            np.testing.assert_array_equal(sharedvolume._published[descriptor['name']].array, self.data)
+            names.append((descriptor, os.path.dirname(response['output'])))
+
+        # Releasing the first volume removes it and its request directory
+        requests.put(self.request(id=3, command='release', name=names[0][0]['name']))
+        self.assertEqual(responses.get(), {'id': 3, 'status': 'done', 'released': True})
+        self.assertFalse(os.path.exists(names[0][1]))
+        with self.assertRaises(OSError):
+            sharedvolume.SharedVolume.attach(names[0][0])
+
+        requests.put(self.request(id=4, command='release', name=names[0][0]['name']))
+        self.assertEqual(responses.get(), {'id': 4, 'status': 'done', 'released': False})
+
+        # Shutting down releases the second volume and removes its directory
+        self.assertTrue(os.path.exists(names[1][1]))
+        requests.put(self.request(command='shutdown'))
+        server.join(60)
+        self.assertFalse(server.is_alive())
+        self.assertEqual(os.listdir(self.output), [])
+        with self.assertRaises(OSError):
+            sharedvolume.SharedVolume.attach(names[1][0])
+
+
+
+class BatchTest(unittest.TestCase):
+    """Batches of tensor fields of (z, y, x) shape (2, 3, 4), skipping the studies that are up to date"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.studies = os.path.join(self.directory, 'studies')
+        self.data = np.random.RandomState(0).standard_normal((2, 3, 4, 9)).astype(np.float32)
+        os.makedirs(os.path.join(self.studies, 'b'))
+        for name in ['a.nrrd', os.path.join('b', 'c.nhdr')]:
+            pynrrd.write(os.path.join(self.studies, name), self.data, {'encoding': 'gzip'}, index_order='C')
+        self.filename = os.path.join(self.studies, 'a.nrrd')
+        self.output = os.path.join(self.studies, 'converted')
+
+    def test_convert_study(self):
+        directory = os.path.join(self.output, 'a')
+        manifest, up_to_date = loadNrrd.convert_study(self.filename, directory, 'npy', maps=['fa', 'magnitude'],
+                                                      levels=1)
+        self.assertFalse(up_to_date)
+        self.assertEqual(manifest['outputs'], ['a_level1.nrrd', 'sample.npy', 'sample_fa.npy', 'sample_magnitude.npy'])
+        self.assertEqual((manifest['bytes'], manifest['voxels']), (self.data.nbytes, 24))
+        self.assertEqual(sorted(manifest['stages']), ['computing fa', 'computing magnitude', 'pyramid', 'reading',
+                                                      'saving'])
+        np.testing.assert_array_equal(np.load(os.path.join(directory, 'sample.npy')), self.data)
+
+        # The same options with the maps in any order are up to date
+        self.assertEqual(loadNrrd.convert_study(self.filename, directory, 'npy', maps=['magnitude', 'fa'], levels=1),
+                         (manifest, True))
+
+        # A changed source, other options or a missing output convert the study again
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertFalse(loadNrrd.convert_study(self.filename, directory, 'npy', maps=['fa', 'magnitude'],
+                                                levels=1)[1])
+        self.assertFalse(loadNrrd.convert_study(self.filename, directory, 'npy', maps=['fa'])[1])
+        os.remove(os.path.join(directory, 'sample_fa.npy'))
+        self.assertFalse(loadNrrd.convert_study(self.filename, directory, 'npy', maps=['fa'])[1])
+        self.assertTrue(loadNrrd.convert_study(self.filename, directory, 'npy', maps=['fa'])[1])
+
+        # An interrupted study without a manifest is converted again
+        os.remove(os.path.join(directory, 'batch.json'))
+        self.assertFalse(loadNrrd.convert_study(self.filename, directory, 'npy', maps=['fa'])[1])
+
+    def batch(self, workers=2):
+        """Run the batch of the studies, returns the number of failed studies and the lines it prints"""
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            failed = loadNrrd.batch(self.studies, self.output, 'npy', maps=['magnitude'], workers=workers)
+        return failed, stdout.getvalue().splitlines()
+
+    def test_batch(self):
+        with open(os.path.join(self.studies, 'broken.nrrd'), 'w') as fh:
+            fh.write('not a NRRD file\n')
+
+        failed, lines = self.batch()
+        self.assertEqual(failed, 1)
+        self.assertIn('converted  %s' % self.filename, lines)
+        self.assertTrue(any(line.startswith('failed  %s' % os.path.join(self.studies, 'broken.nrrd'))
+                            for line in lines))
+        self.assertTrue(any(line.startswith('2 converted, 0 up to date, 1 failed') for line in lines))
+        for study in ['a', os.path.join('b', 'c')]:
+            np.testing.assert_array_equal(np.load(os.path.join(self.output, study, 'sample.npy')), self.data)
+
+        # The outputs of the batch, in the directory of the studies, are not studies themselves
+        os.remove(os.path.join(self.studies, 'broken.nrrd'))
+        failed, lines = self.batch(workers=1)
+        self.assertEqual(failed, 0)
+        self.assertIn('up to date  %s' % self.filename, lines)
+        self.assertTrue(any(line.startswith('0 converted, 2 up to date, 0 failed') for line in lines))
+
+        # Only the changed study is converted
+        pynrrd.write(self.filename, self.data * 2, {'encoding': 'gzip'}, index_order='C')
+        failed, lines = self.batch()
+        self.assertTrue(any(line.startswith('1 converted, 1 up to date, 0 failed') for line in lines))
+        np.testing.assert_array_equal(np.load(os.path.join(self.output, 'a', 'sample.npy')), self.data * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
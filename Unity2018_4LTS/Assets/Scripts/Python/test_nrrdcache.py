@@ -0,0 +1,123 @@
+"""Tests of the cache keys of NRRD conversions and of the least recently used eviction of the cache
+
+    python -m unittest test_nrrdcache
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import loadNrrd
+import pynrrd
+from nrrdcache import ConversionCache, conversion_key
+
+
+class ConversionKeyTest(unittest.TestCase):
+    """Keys of a tensor field of (z, y, x) shape (2, 3, 4), with an attached or a detached data file"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.data = np.random.RandomState(0).standard_normal((2, 3, 4, 9)).astype(np.float32)
+        self.filename = os.path.join(self.directory, 'tensors.nrrd')
+        pynrrd.write(self.filename, self.data, {'encoding': 'raw'}, index_order='C')
+        self.detached = os.path.join(self.directory, 'tensors.nhdr')
+        pynrrd.write(self.detached, self.data, {'encoding': 'raw'}, detached_header=True, index_order='C')
+
+    def test_params(self):
+        key = conversion_key(self.filename, format='npy', maps=['fa'])
+        self.assertEqual(conversion_key(self.filename, maps=['fa'], format='npy'), key)
+        self.assertNotEqual(conversion_key(self.filename, format='npy', maps=['magnitude']), key)
+        self.assertNotEqual(conversion_key(self.filename, format='raw', maps=['fa']), key)
+
+    def test_maps_in_any_order(self):
+        cache = os.path.join(self.directory, 'cache')
+        for maps in [['fa', 'magnitude'], ['magnitude', 'fa']]:
+            with self.subTest(maps=maps):
+                filename, cached = loadNrrd.convert(self.filename, 'npy', cache_dir=cache, maps=maps)
+                self.assertEqual(cached, maps[0] == 'magnitude')
+                np.testing.assert_array_equal(np.load(filename), self.data)
+                np.testing.assert_array_equal(np.load(os.path.join(os.path.dirname(filename), 'sample_fa.npy')),
+                                              loadNrrd.dti.fa_map(self.data))
+
+        self.assertEqual(len(os.listdir(cache)), 1)
+
+    def test_modification_time(self):
+        data_filename = os.path.join(self.directory, 'tensors.raw')
+        for filename, source in [(self.filename, self.filename), (self.detached, self.detached),
+                                 (self.detached, data_filename)]:
+            with self.subTest(filename=filename, source=source):
+                key = conversion_key(filename, format='npy')
+                self.assertEqual(conversion_key(filename, format='npy'), key)
+
+                stat = os.stat(source)
+                os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+                self.assertNotEqual(conversion_key(filename, format='npy'), key)
+
+    def test_size(self):
+        key = conversion_key(self.detached)
+        stat = os.stat(self.detached)
+        with open(os.path.join(self.directory, 'tensors.raw'), 'ab') as fh:
+            fh.write(b'\0')
+        os.utime(os.path.join(self.directory, 'tensors.raw'), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertNotEqual(conversion_key(self.detached), key)
+
+
+class ConversionCacheTest(unittest.TestCase):
+    """Entries of 100 bytes in a cache of 250 bytes"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = ConversionCache(os.path.join(self.directory, 'cache'), max_size=250)
+
+    def put(self, key, last_used=None):
+        """Store an entry of 100 bytes, used last at :obj:`last_used` seconds since the epoch if given"""
+
+        def convert(directory):
+            with open(os.path.join(directory, 'sample.npy'), 'wb') as fh:
+                fh.write(b'\0' * 100)
+
+        entry = self.cache.put(key, convert)
+        if last_used is not None:
+            os.utime(entry, (last_used, last_used))
+        return entry
+
+    def keys(self):
+        return sorted(os.listdir(self.cache.directory))
+
+    def test_least_recently_used(self):
+        self.put('a', 1000)
+        self.put('b', 2000)
+        self.assertEqual(self.keys(), ['a', 'b'])
+
+        # 'a' is used after 'b', so storing 'c' evicts 'b'
+        os.utime(self.cache.get('a'), (3000, 3000))
+        self.put('c')
+        self.assertEqual(self.keys(), ['a', 'c'])
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_keep_new_entry(self):
+        # An entry larger than the cache is still stored, all other entries are evicted
+        self.put('a', 1000)
+        self.cache.max_size = 50
+        self.put('b')
+        self.assertEqual(self.keys(), ['b'])
+
+        self.cache.evict()
+        self.assertEqual(self.keys(), [])
+
+    def test_failed_conversion(self):
+        def convert(directory):
+            raise RuntimeError('conversion failed')
+
+        with self.assertRaises(RuntimeError):
+            self.cache.put('a', convert)
+        self.assertEqual(self.keys(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
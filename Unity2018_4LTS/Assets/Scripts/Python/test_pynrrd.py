@@ -0,0 +1,632 @@
+"""Round trip tests of the read and write paths of :mod:`pynrrd` on small volumes
+
+Each path is checked against :func:`pynrrd.write` and :func:`pynrrd.read` with their default options, for both index
+orders and all encodings that the path supports. The chunk sizes of the module are made small where a path works in
+chunks, so that the small volumes still span many of them.
+
+    python -m unittest test_pynrrd
+"""
+import bz2
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import pynrrd
+
+_ENCODINGS = ['raw', 'gzip', 'bzip2', 'ascii']
+_INDEX_ORDERS = ['F', 'C']
+
+# Shape of the test volumes in the index order they are written with
+_SHAPE = (5, 6, 7)
+
+
+def _volume(dtype, shape=_SHAPE, seed=0):
+    """Random volume of :obj:`dtype`, with negative values for signed datatypes"""
+
+    rng = np.random.RandomState(seed)
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return (rng.standard_normal(shape) * 100).astype(dtype)
+
+    info = np.iinfo(dtype)
+    return rng.randint(max(info.min, -1000), min(info.max, 1000) + 1, size=shape).astype(dtype)
+
+
+def _compress(payload, encoding):
+    return gzip.compress(payload) if encoding == 'gzip' else bz2.compress(payload)
+
+
+class _VolumeTestCase(unittest.TestCase):
+    """Test case with a temporary directory to write volumes to"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, data, encoding, index_order='F', header=None, **kwargs):
+        """Write :obj:`data` to the file :obj:`name` with :func:`pynrrd.write` and return its filename"""
+
+        filename = self.path(name)
+        header = dict(header or {}, encoding=encoding)
+        pynrrd.write(filename, data, header, index_order=index_order, **kwargs)
+        return filename
+
+    def write_data_file(self, filename, payload):
+        """Replace the data file of the detached header :obj:`filename` with the bytes :obj:`payload`"""
+
+        with open(filename, 'rb') as fh:
+            data_filename = pynrrd.read_header(fh)['data file']
+
+        with open(os.path.join(self.directory, data_filename), 'wb') as fh:
+            fh.write(payload)
+
+    def data_bytes(self, filename):
+        """Bytes of the data file of the detached header :obj:`filename`"""
+
+        with open(filename, 'rb') as fh:
+            data_filename = pynrrd.read_header(fh)['data file']
+
+        with open(self.path(data_filename), 'rb') as fh:
+            return fh.read()
+
+    def assertVolumeEqual(self, actual, expected):
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertEqual(actual.dtype.newbyteorder('='), expected.dtype.newbyteorder('='))
+        np.testing.assert_array_equal(actual, expected)
+
+
+class MmapTest(_VolumeTestCase):
+    """Memory-mapped reads of raw data"""
+
+    def test_round_trip(self):
+        for index_order in _INDEX_ORDERS:
+            for dtype in ['u1', '<i2', '>i2', '<f4', '>f8']:
+                with self.subTest(index_order=index_order, dtype=dtype):
+                    data = _volume(dtype)
+                    filename = self.write('mmap.nrrd', data, 'raw', index_order)
+                    mapped, _ = pynrrd.read(filename, index_order=index_order, mmap=True)
+
+                    self.assertIsInstance(mapped, np.memmap)
+                    self.assertFalse(mapped.flags.writeable)
+                    # No data is converted, so the data stays in the byte order of the file
+                    self.assertEqual(mapped.dtype, np.dtype(dtype))
+                    self.assertVolumeEqual(mapped, data)
+                    self.assertVolumeEqual(mapped, pynrrd.read(filename, index_order=index_order)[0])
+                    del mapped
+
+    def test_detached_header_and_byte_skip(self):
+        data = _volume('<i2')
+        for index_order in _INDEX_ORDERS:
+            for header in [{}, {'byte skip': -1}]:
+                with self.subTest(index_order=index_order, header=header):
+                    filename = self.write('mmap.nhdr', data, 'raw', index_order, header)
+                    mapped, _ = pynrrd.read(filename, index_order=index_order, mmap=True)
+
+                    self.assertVolumeEqual(mapped, data)
+                    del mapped
+
+    def test_compressed_data_is_not_mapped(self):
+        for encoding in _ENCODINGS[1:]:
+            with self.subTest(encoding=encoding):
+                filename = self.write('mmap.nrrd', _volume('<i2'), encoding)
+                with self.assertRaises(pynrrd.NRRDError):
+                    pynrrd.read(filename, mmap=True)
+
+
+class StreamingDecompressTest(_VolumeTestCase):
+    """Gzip and bzip2 data decompressed straight into the array a chunk at a time"""
+
+    def setUp(self):
+        super(StreamingDecompressTest, self).setUp()
+        patcher = mock.patch.object(pynrrd, '_READ_CHUNKSIZE', 7)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_round_trip(self):
+        for encoding in ['gzip', 'bzip2']:
+            for index_order in _INDEX_ORDERS:
+                for dtype in ['u1', '<i2', '>f4', '<f8']:
+                    with self.subTest(encoding=encoding, index_order=index_order, dtype=dtype):
+                        data = _volume(dtype)
+                        filename = self.write('stream.nrrd', data, encoding, index_order)
+
+                        self.assertVolumeEqual(pynrrd.read(filename, index_order=index_order)[0], data)
+
+    def test_byte_skip(self):
+        data = _volume('<i2')
+        junk = bytes(bytearray(range(1, 38)))
+        for encoding in ['gzip', 'bzip2']:
+            for index_order in _INDEX_ORDERS:
+                for byte_skip, payload in [(len(junk), junk + data.tobytes(index_order)),
+                                           (-1, junk + data.tobytes(index_order))]:
+                    with self.subTest(encoding=encoding, index_order=index_order, byte_skip=byte_skip):
+                        filename = self.write('stream.nhdr', data, encoding, index_order, {'byte skip': byte_skip})
+                        self.write_data_file(filename, _compress(payload, encoding))
+
+                        self.assertVolumeEqual(pynrrd.read(filename, index_order=index_order)[0], data)
+
+    def test_size_mismatch(self):
+        data = _volume('<i2')
+        for encoding in ['gzip', 'bzip2']:
+            for payload in [data.tobytes()[:-2], data.tobytes() + b'\0\0']:
+                with self.subTest(encoding=encoding, size=len(payload)):
+                    filename = self.write('stream.nhdr', data, encoding)
+                    self.write_data_file(filename, _compress(payload, encoding))
+
+                    with self.assertRaises(pynrrd.NRRDError):
+                        pynrrd.read(filename)
+
+
+class GzipMembersTest(_VolumeTestCase):
+    """Gzip data written and read as members compressed and inflated by several threads"""
+
+    def setUp(self):
+        super(GzipMembersTest, self).setUp()
+        patcher = mock.patch.object(pynrrd, '_GZIP_MEMBER_SIZE', 64)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read_data_file(self, filename):
+        with open(filename, 'rb') as fh:
+            data_filename = pynrrd.read_header(fh)['data file']
+
+        return open(os.path.join(self.directory, data_filename), 'rb')
+
+    def test_round_trip(self):
+        for index_order in _INDEX_ORDERS:
+            for dtype in ['u1', '<i2', '>f4', '<f8']:
+                with self.subTest(index_order=index_order, dtype=dtype):
+                    data = _volume(dtype)
+                    filename = self.write('members.nhdr', data, 'gzip', index_order, threads=3)
+
+                    with self.read_data_file(filename) as fh:
+                        members = pynrrd._scan_gzip_members(fh)
+                        # The members are still one valid gzip stream
+                        self.assertEqual(gzip.decompress(fh.read()), data.tobytes(index_order))
+                    self.assertGreater(len(members), 1)
+
+                    for threads in [1, 3]:
+                        self.assertVolumeEqual(pynrrd.read(filename, index_order=index_order, threads=threads)[0],
+                                               data)
+
+    def test_same_data_as_one_thread(self):
+        data = _volume('<i2')
+        for index_order in _INDEX_ORDERS:
+            with self.subTest(index_order=index_order):
+                single = self.write('single.nhdr', data, 'gzip', index_order)
+                multiple = self.write('multiple.nhdr', data, 'gzip', index_order, threads=3)
+
+                with self.read_data_file(single) as fh, self.read_data_file(multiple) as other_fh:
+                    self.assertIsNone(pynrrd._scan_gzip_members(fh))
+                    self.assertEqual(gzip.decompress(fh.read()), gzip.decompress(other_fh.read()))
+
+                self.assertVolumeEqual(pynrrd.read(single, index_order=index_order, threads=3)[0], data)
+
+    def test_byte_skip(self):
+        data = _volume('<i2')
+        junk = bytes(bytearray(range(1, 101)))
+        for index_order in _INDEX_ORDERS:
+            for byte_skip in [len(junk), -1]:
+                with self.subTest(index_order=index_order, byte_skip=byte_skip):
+                    payload = junk + data.tobytes(index_order)
+                    filename = self.write('members.nhdr', data, 'gzip', index_order, {'byte skip': byte_skip})
+                    # The first member lies entirely in the skipped bytes
+                    self.write_data_file(filename, b''.join(pynrrd._compress_gzip_member(payload[start:start + 64], 9)
+                                                            for start in range(0, len(payload), 64)))
+
+                    for threads in [1, 3]:
+                        self.assertVolumeEqual(pynrrd.read(filename, index_order=index_order, threads=threads)[0],
+                                               data)
+
+
+class _RegionTestCase(_VolumeTestCase):
+    """Test case comparing regions of :class:`pynrrd.NrrdVolume` with the same regions of :func:`pynrrd.read`"""
+
+    # Keys covering the whole volume, slabs and single slices of each axis, steps and integer arrays, and a boolean
+    # array along the first axis. They are read out of order so that reads also start from the saved decompressor
+    # states.
+    KEYS = [(4, Ellipsis), Ellipsis, (slice(1, 4), 2, slice(None, None, 2)), (Ellipsis, -1), (Ellipsis, 0),
+            (Ellipsis, slice(5, 1, -2)), (slice(None), [4, 0, 2]), (0, 0, 0), (Ellipsis, slice(3, 3)),
+            (Ellipsis, slice(2, 6))]
+
+    def setUp(self):
+        super(_RegionTestCase, self).setUp()
+        for name, value in [('_READ_CHUNKSIZE', 7), ('_CHECKPOINT_INTERVAL', 40), ('_GZIP_MEMBER_SIZE', 64)]:
+            patcher = mock.patch.object(pynrrd, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def check_regions(self, filename, index_order, **kwargs):
+        expected = pynrrd.read(filename, index_order=index_order)[0]
+        volume = pynrrd.NrrdVolume(filename, index_order=index_order, **kwargs)
+
+        self.assertEqual(volume.shape, expected.shape)
+        self.assertEqual(volume.dtype, pynrrd.read(filename, index_order=index_order, native=False)[0].dtype)
+        self.assertEqual(len(volume), len(expected))
+        for key in self.KEYS + [(np.arange(len(expected)) % 3 == 1,)]:
+            with self.subTest(key=key):
+                np.testing.assert_array_equal(volume[key], expected[key])
+
+        return volume
+
+
+class NrrdVolumeTest(_RegionTestCase):
+    """Regions of a lazily read volume"""
+
+    def test_regions(self):
+        for encoding in _ENCODINGS:
+            for index_order in _INDEX_ORDERS:
+                for dtype in ['<i2', '>f4']:
+                    with self.subTest(encoding=encoding, index_order=index_order, dtype=dtype):
+                        filename = self.write('volume.nrrd', _volume(dtype), encoding, index_order)
+                        self.check_regions(filename, index_order)
+
+    def test_gzip_members(self):
+        for index_order in _INDEX_ORDERS:
+            with self.subTest(index_order=index_order):
+                filename = self.write('volume.nhdr', _volume('<i2'), 'gzip', index_order, threads=3)
+                self.check_regions(filename, index_order)
+
+    def test_invalid_keys(self):
+        volume = pynrrd.NrrdVolume(self.write('volume.nrrd', _volume('<i2'), 'gzip'))
+        for key in [(None, 0), (Ellipsis, Ellipsis), (0, 0, 0, 0), (Ellipsis, 7), (Ellipsis, 1.5)]:
+            with self.subTest(key=key):
+                with self.assertRaises(IndexError):
+                    volume[key]
+
+
+class GzipIndexTest(_RegionTestCase):
+    """Regions of gzip data read with the checkpoints of a .gzidx index"""
+
+    # Points can only be at the boundaries of deflate blocks, so the volume must span several blocks
+    SHAPE = (20, 30, 40)
+
+    def test_regions(self):
+        for name in ['index.nrrd', 'index.nhdr']:
+            for index_order in _INDEX_ORDERS:
+                with self.subTest(name=name, index_order=index_order):
+                    filename = self.write(name, _volume('<f4', self.SHAPE), 'gzip', index_order)
+                    index_filename = pynrrd.build_gzip_index(filename, spacing=40)
+                    self.assertTrue(os.path.isfile(index_filename))
+                    self.assertTrue(index_filename.endswith('.gzidx'))
+
+                    volume = pynrrd.NrrdVolume(filename, index_order=index_order)
+                    # The points of the index are used before anything is read
+                    self.assertGreater(len(volume._checkpoints), 1)
+                    self.check_regions(filename, index_order)
+
+    def test_built_on_first_read(self):
+        filename = self.write('index.nhdr', _volume('<f4', self.SHAPE), 'gzip')
+        index_filename = pynrrd.build_gzip_index(filename)
+        os.remove(index_filename)
+
+        volume = self.check_regions(filename, 'F', gzip_index=True)
+        self.assertTrue(os.path.isfile(index_filename))
+        self.assertGreater(len(volume._checkpoints), 1)
+
+    def test_stale_index_is_ignored(self):
+        filename = self.write('index.nhdr', _volume('<f4', self.SHAPE), 'gzip')
+        pynrrd.build_gzip_index(filename, spacing=40)
+
+        # The index no longer matches once the data file changes
+        self.write('index.nhdr', _volume('<f4', self.SHAPE, seed=1), 'gzip', compression_level=1)
+        self.assertEqual(len(pynrrd.NrrdVolume(filename)._checkpoints), 1)
+        self.check_regions(filename, 'F')
+
+    def test_only_gzip(self):
+        for encoding in ['raw', 'bzip2', 'ascii']:
+            with self.subTest(encoding=encoding):
+                with self.assertRaises(pynrrd.NRRDError):
+                    pynrrd.build_gzip_index(self.write('index.nrrd', _volume('<i2'), encoding))
+
+
+class WriteDataTest(_VolumeTestCase):
+    """Data written a block at a time, straight from the array or through a slab buffer"""
+
+    def setUp(self):
+        super(WriteDataTest, self).setUp()
+        for name, value in [('_WRITE_CHUNKSIZE', 10), ('_TEXT_CHUNKSIZE', 64), ('_GZIP_MEMBER_SIZE', 64)]:
+            patcher = mock.patch.object(pynrrd, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def views(self):
+        """Arrays with the memory layouts that are written differently, by name"""
+
+        data = _volume('<f4', (7, 6, 5))
+        return [('C', data), ('F', np.asfortranarray(data)), ('transposed', data.transpose(1, 2, 0)),
+                ('strided', data[::2, :, 1:]), ('reversed', data[:, ::-1]), ('big endian', data.astype('>f4')),
+                ('2D', data[:, 2, :]), ('2D transposed', data[:, :, 3].T), ('1D', data[:, 1, 2]),
+                ('empty', data[:, :0])]
+
+    def test_same_file_as_contiguous_data(self):
+        for encoding in _ENCODINGS:
+            for index_order in _INDEX_ORDERS:
+                for threads in [1, 2] if encoding in ['gzip', 'ascii'] else [1]:
+                    for name, view in self.views():
+                        with self.subTest(encoding=encoding, index_order=index_order, threads=threads, view=name):
+                            # A copy in the order of the file is written straight from its memory
+                            expected = self.write('expected.nhdr', np.array(view, order=index_order), encoding,
+                                                  index_order, threads=threads)
+                            actual = self.write('actual.nhdr', view, encoding, index_order, threads=threads)
+
+                            self.assertEqual(self.data_bytes(actual), self.data_bytes(expected))
+                            if view.size:
+                                self.assertVolumeEqual(pynrrd.read(actual, index_order=index_order)[0], view)
+
+    def test_raw_bytes(self):
+        for index_order in _INDEX_ORDERS:
+            for name, view in self.views():
+                with self.subTest(index_order=index_order, view=name):
+                    filename = self.write('raw.nhdr', view, 'raw', index_order)
+                    self.assertEqual(self.data_bytes(filename), view.tobytes(index_order))
+
+    def test_ascii_lines(self):
+        # The rows of 2D arrays are lines of text like numpy.savetxt writes them, other values are one per line
+        for index_order in _INDEX_ORDERS:
+            for name, view in self.views():
+                with self.subTest(index_order=index_order, view=name):
+                    filename = self.write('ascii.nhdr', view, 'ascii', index_order)
+
+                    expected = view if index_order == 'C' else view.T
+                    text = io.BytesIO()
+                    np.savetxt(text, expected if view.ndim == 2 else expected.reshape(-1, 1), '%.17g')
+                    self.assertEqual(self.data_bytes(filename), text.getvalue())
+
+
+class NrrdWriterTest(_VolumeTestCase):
+    """Files written one slab at a time"""
+
+    def setUp(self):
+        super(NrrdWriterTest, self).setUp()
+        for name, value in [('_WRITE_CHUNKSIZE', 10), ('_TEXT_CHUNKSIZE', 64), ('_GZIP_MEMBER_SIZE', 64)]:
+            patcher = mock.patch.object(pynrrd, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_slabs(self, name, data, encoding, index_order, counts, threads=1):
+        """Write :obj:`data` with :class:`pynrrd.NrrdWriter` in slabs of :obj:`counts` indices of the slowest axis"""
+
+        filename = self.path(name)
+        sizes = data.shape if index_order == 'F' else data.shape[::-1]
+        with pynrrd.NrrdWriter(filename, data.dtype, sizes, {'encoding': encoding}, index_order=index_order,
+                               threads=threads) as writer:
+            start = 0
+            for count in counts:
+                # A count of None is one slice without the slowest axis
+                stop = start + (count or 1)
+                if index_order == 'F':
+                    writer.append(data[..., start] if count is None else data[..., start:stop])
+                else:
+                    writer.append(data[start] if count is None else data[start:stop])
+                start = stop
+
+        return filename
+
+    def test_same_file_as_write(self):
+        for encoding in _ENCODINGS:
+            for index_order in _INDEX_ORDERS:
+                data = _volume('>f4')
+                slowest = data.shape[-1] if index_order == 'F' else data.shape[0]
+                for threads in [1, 2] if encoding in ['gzip', 'ascii'] else [1]:
+                    for counts in [[slowest], [1] * slowest, [2, None, slowest - 3], [0, slowest, 0]]:
+                        with self.subTest(encoding=encoding, index_order=index_order, threads=threads, counts=counts):
+                            expected = self.write('expected.nhdr', data, encoding, index_order, threads=threads)
+                            actual = self.write_slabs('actual.nhdr', data, encoding, index_order, counts, threads)
+
+                            with open(expected, 'rb') as fh, open(actual, 'rb') as other_fh:
+                                header = pynrrd.read_header(fh)
+                                other_header = pynrrd.read_header(other_fh)
+                            self.assertEqual(sorted(header), sorted(other_header))
+                            for field in ['type', 'endian', 'encoding']:
+                                self.assertEqual(other_header.get(field), header.get(field))
+                            np.testing.assert_array_equal(other_header['sizes'], header['sizes'])
+                            self.assertEqual(self.data_bytes(actual), self.data_bytes(expected))
+                            self.assertVolumeEqual(pynrrd.read(actual, index_order=index_order)[0], data)
+
+    def test_attached_data(self):
+        data = _volume('<i2')
+        for encoding in _ENCODINGS:
+            for index_order in _INDEX_ORDERS:
+                with self.subTest(encoding=encoding, index_order=index_order):
+                    slowest = data.shape[-1] if index_order == 'F' else data.shape[0]
+                    filename = self.write_slabs('writer.nrrd', data, encoding, index_order, [1] * slowest)
+                    self.assertVolumeEqual(pynrrd.read(filename, index_order=index_order)[0], data)
+
+    def test_slabs_are_converted(self):
+        data = _volume('<f8')
+        with pynrrd.NrrdWriter(self.path('writer.nrrd'), np.int16, data.shape, {'encoding': 'raw'}) as writer:
+            writer.append(data)
+
+        self.assertVolumeEqual(pynrrd.read(self.path('writer.nrrd'))[0], data.astype(np.int16))
+
+    def test_invalid_slabs(self):
+        data = _volume('<i2')
+        for index_order in _INDEX_ORDERS:
+            with self.subTest(index_order=index_order):
+                sizes = data.shape if index_order == 'F' else data.shape[::-1]
+                writer = pynrrd.NrrdWriter(self.path('writer.nrrd'), data.dtype, sizes, {'encoding': 'gzip'},
+                                           index_order=index_order)
+                with self.assertRaises(pynrrd.NRRDError):
+                    writer.append(data.T)
+                with self.assertRaises(pynrrd.NRRDError):
+                    writer.append(np.concatenate([data, data], axis=-1 if index_order == 'F' else 0))
+
+                writer.append(data[..., :1] if index_order == 'F' else data[:1])
+                with self.assertRaises(pynrrd.NRRDError):
+                    writer.close()
+
+
+class AsciiTest(_VolumeTestCase):
+    """ASCII data parsed and formatted in chunks, by one or several processes"""
+
+    def setUp(self):
+        super(AsciiTest, self).setUp()
+        # Chunks this small split most numbers across chunks
+        patcher = mock.patch.object(pynrrd, '_TEXT_CHUNKSIZE', 16)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_round_trip(self):
+        for index_order in _INDEX_ORDERS:
+            for dtype in ['i1', 'u2', '>i4', 'i8', 'f4', '>f8']:
+                data = _volume(dtype)
+                if dtype == 'i8':
+                    # The text is formatted with '%.17g' like numpy.savetxt does, exact for integers up to 2**53
+                    data.flat[:2] = -2 ** 53, 2 ** 53
+                elif dtype == '>f8':
+                    data.flat[:6] = [np.inf, -np.inf, -0.0, 1e-300, np.finfo(dtype).max, np.pi]
+
+                for threads in [1, 2]:
+                    with self.subTest(index_order=index_order, dtype=dtype, threads=threads):
+                        filename = self.write('ascii.nhdr', data, 'ascii', index_order, threads=threads)
+                        self.assertEqual(self.data_bytes(filename),
+                                         self.data_bytes(self.write('expected.nhdr', data, 'ascii', index_order)))
+
+                        for read_threads in [1, 2]:
+                            self.assertVolumeEqual(pynrrd.read(filename, index_order=index_order,
+                                                               threads=read_threads)[0], data)
+
+    def test_nan(self):
+        data = np.array([[np.nan, 1.5], [-np.nan, 2.5]])
+        for threads in [1, 2]:
+            with self.subTest(threads=threads):
+                filename = self.write('ascii.nrrd', data, 'ascii', threads=threads)
+                self.assertVolumeEqual(pynrrd.read(filename, threads=threads)[0], data)
+
+    def test_whitespace(self):
+        text = b' 1 2\t3\r\n4\n\n  5   6\x0b7\x0c8\t 9 10 11 12 13 14 15 16 17 18 19 20 21 22 23 -24'
+        data = np.arange(1, 25, dtype=np.int16).reshape(2, 3, 4)
+        data.flat[-1] *= -1
+        for threads in [1, 2]:
+            with self.subTest(threads=threads):
+                filename = self.write('ascii.nhdr', data, 'ascii', 'C')
+                self.write_data_file(filename, text)
+                self.assertVolumeEqual(pynrrd.read(filename, index_order='C', threads=threads)[0], data)
+
+    def test_size_mismatch(self):
+        data = np.arange(24, dtype=np.int16)
+        for text in [b'1 2 3\n' * 7, b'1 2 3\n' * 9]:
+            for threads in [1, 2]:
+                with self.subTest(size=len(text), threads=threads):
+                    filename = self.write('ascii.nhdr', data, 'ascii')
+                    self.write_data_file(filename, text)
+                    with self.assertRaises(pynrrd.NRRDError):
+                        pynrrd.read(filename, threads=threads)
+
+
+class ConversionTest(_VolumeTestCase):
+    """Data converted to another datatype and scaled while it is decoded"""
+
+    # (out_dtype, scale) pairs
+    CONVERSIONS = [('f4', None), (None, 0.5), ('i4', 2), ('f8', 1e-3), ('=i2', None), ('u1', None)]
+
+    def setUp(self):
+        super(ConversionTest, self).setUp()
+        for name, value in [('_READ_CHUNKSIZE', 7), ('_TEXT_CHUNKSIZE', 16), ('_GZIP_MEMBER_SIZE', 64)]:
+            patcher = mock.patch.object(pynrrd, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def files(self, data, index_order):
+        """Files of :obj:`data` in all encodings and as gzip members, by name"""
+
+        files = [(encoding, self.write('%s.nhdr' % encoding, data, encoding, index_order))
+                 for encoding in _ENCODINGS]
+        files.append(('gzip members', self.write('members.nhdr', data, 'gzip', index_order, threads=3)))
+        return files
+
+    def assertConverted(self, actual, data, out_dtype, scale):
+        expected = data if scale is None else data * scale
+        expected = expected if out_dtype is None else expected.astype(out_dtype)
+
+        self.assertEqual(actual.dtype, expected.dtype)
+        self.assertVolumeEqual(actual, expected)
+
+    def test_round_trip(self):
+        for index_order in _INDEX_ORDERS:
+            for dtype in ['u1', '>i2', '<u2', '>f4', '<f8']:
+                data = _volume(dtype)
+                for name, filename in self.files(data, index_order):
+                    for out_dtype, scale in self.CONVERSIONS:
+                        for threads in [1, 3]:
+                            with self.subTest(index_order=index_order, dtype=dtype, file=name, out_dtype=out_dtype,
+                                              scale=scale, threads=threads):
+                                actual = pynrrd.read(filename, index_order=index_order, threads=threads,
+                                                     out_dtype=out_dtype, scale=scale)[0]
+                                self.assertConverted(actual, data.astype(data.dtype.newbyteorder('=')), out_dtype,
+                                                     scale)
+
+    def test_byte_skip(self):
+        data = _volume('>i2')
+        junk = bytes(bytearray(range(1, 101)))
+        for encoding in ['gzip', 'bzip2', 'gzip members']:
+            for index_order in _INDEX_ORDERS:
+                for byte_skip in [len(junk), -1]:
+                    with self.subTest(encoding=encoding, index_order=index_order, byte_skip=byte_skip):
+                        payload = junk + data.tobytes(index_order)
+                        filename = self.write('skip.nhdr', data, encoding.split()[0], index_order,
+                                              {'byte skip': byte_skip})
+                        if encoding == 'gzip members':
+                            self.write_data_file(filename, b''.join(pynrrd._compress_gzip_member(
+                                payload[start:start + 64], 9) for start in range(0, len(payload), 64)))
+                        else:
+                            self.write_data_file(filename, _compress(payload, encoding))
+
+                        for threads in [1, 3]:
+                            actual = pynrrd.read(filename, index_order=index_order, threads=threads, out_dtype='f4',
+                                                 scale=0.25)[0]
+                            self.assertConverted(actual, data.astype('=i2'), 'f4', 0.25)
+
+    def test_native(self):
+        data = _volume('>f4')
+        for index_order in _INDEX_ORDERS:
+            for name, filename in self.files(data, index_order):
+                with self.subTest(index_order=index_order, file=name):
+                    native = pynrrd.read(filename, index_order=index_order)[0]
+                    self.assertTrue(native.dtype.isnative)
+                    self.assertVolumeEqual(native, data)
+
+                    if name != 'ascii':
+                        as_stored = pynrrd.read(filename, index_order=index_order, native=False)[0]
+                        self.assertEqual(as_stored.dtype, data.dtype)
+                        self.assertVolumeEqual(as_stored, data)
+
+    def test_out(self):
+        data = _volume('>i2')
+        for index_order in _INDEX_ORDERS:
+            for name, filename in self.files(data, index_order):
+                for out_dtype, scale in self.CONVERSIONS:
+                    with self.subTest(index_order=index_order, file=name, out_dtype=out_dtype, scale=scale):
+                        out_dtype = out_dtype or np.result_type(np.int16, scale)
+                        out = np.full(data.shape, 99, dtype=out_dtype, order=index_order)
+                        actual = pynrrd.read(filename, index_order=index_order, scale=scale, out=out)[0]
+
+                        self.assertIs(actual, out)
+                        self.assertConverted(actual, data.astype('=i2'), out_dtype, scale)
+
+    def test_invalid(self):
+        data = _volume('>i2')
+        for index_order in _INDEX_ORDERS:
+            filename = self.write('invalid.nrrd', data, 'raw', index_order)
+            other_order = 'C' if index_order == 'F' else 'F'
+            for kwargs in [{'out': np.empty(data.shape, order=other_order)}, {'out': np.empty(data.shape[::-1])},
+                           {'out': np.empty(data.shape, 'f4', order=index_order), 'out_dtype': 'f8'},
+                           {'mmap': True, 'out_dtype': 'f4'}, {'mmap': True, 'scale': 2},
+                           {'mmap': True, 'out': np.empty(data.shape, order=index_order)}]:
+                with self.subTest(index_order=index_order, kwargs=sorted(kwargs)):
+                    with self.assertRaises(pynrrd.NRRDError):
+                        pynrrd.read(filename, index_order=index_order, **kwargs)
+
+
+if __name__ == '__main__':
+    unittest.main()
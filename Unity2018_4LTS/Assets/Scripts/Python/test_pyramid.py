@@ -0,0 +1,129 @@
+"""Tests of the levels of multi-resolution pyramids, compared with averages over the blocks of the volume
+
+    python -m unittest test_pyramid
+"""
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import pynrrd
+import pyramid
+
+# Shape in C order that no level divides, so every level has blocks cut off at the end of each axis
+_SHAPE = (3, 7, 10)
+
+
+def _block_means(data, factor, mean):
+    """Apply :obj:`mean` to the voxels of each block of :obj:`factor` voxels along the first three axes of
+    :obj:`data`, which returns the average of an array of voxels"""
+
+    shape = [-(-size // factor) for size in data.shape[:3]]
+    averages = np.zeros(shape + list(data.shape[3:]))
+    for index in itertools.product(*[range(size) for size in shape]):
+        block = data[tuple(slice(i * factor, (i + 1) * factor) for i in index)]
+        averages[index] = mean(block.reshape((-1,) + data.shape[3:]))
+    return averages
+
+
+def _log_euclidean_mean(tensors):
+    """Log-Euclidean mean of the positive definite tensors of shape (n, 9)"""
+
+    values, vectors = np.linalg.eigh(tensors.reshape(-1, 3, 3))
+    logs = np.einsum('...ij,...j,...kj->...ik', vectors, np.log(values), vectors).mean(axis=0)
+    values, vectors = np.linalg.eigh(logs)
+    return np.dot(vectors * np.exp(values), vectors.T).ravel()
+
+
+class LevelHeaderTest(unittest.TestCase):
+    """Space directions and origin of blocks of a volume with a component axis"""
+
+    def test_known_volume(self):
+        header = {'space': 'left-posterior-superior', 'kinds': ['3D-matrix', 'domain', 'domain', 'domain'],
+                  'space directions': np.array([[np.nan] * 3, [-1, 0, 0], [0, 0, 2], [0, 0.5, 0]]),
+                  'space origin': np.array([10.0, 20, 30]), 'measurement frame': np.eye(3), 'encoding': 'gzip'}
+        for factor in [1, 2, 4]:
+            with self.subTest(factor=factor):
+                level = pyramid.level_header(header, factor)
+                self.assertEqual(set(level), {'space', 'kinds', 'space directions', 'space origin',
+                                              'measurement frame'})
+                np.testing.assert_array_equal(level['space directions'][0], [np.nan] * 3)
+                np.testing.assert_array_equal(level['space directions'][1:], header['space directions'][1:] * factor)
+
+                # The center of the first block is (factor - 1) / 2 voxels from the center of the first voxel
+                offset = (factor - 1) / 2
+                np.testing.assert_allclose(level['space origin'], [10 - offset, 20 + 0.5 * offset, 30 + 2 * offset])
+
+    def test_no_directions(self):
+        self.assertEqual(pyramid.level_header({'space origin': [1, 2, 3]}, 2), {'space origin': [1, 2, 3]})
+
+
+class BuildPyramidTest(unittest.TestCase):
+    """Levels of volumes of (z, y, x) shape (3, 7, 10)"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def build(self, data, levels, header=None):
+        filename = os.path.join(self.directory, 'volume.nrrd')
+        pynrrd.write(filename, data, dict(header or {}, encoding='raw'), index_order='C')
+        output = os.path.join(self.directory, 'levels')
+        filenames = pyramid.build_pyramid(filename, levels, output)
+        self.assertEqual(filenames, [os.path.join(output, 'volume_level%d.nrrd' % level)
+                                     for level in range(1, levels + 1)])
+        return filename, filenames
+
+    def test_scalar(self):
+        data = np.random.RandomState(0).randint(0, 1000, _SHAPE).astype(np.int16)
+        header = {'space directions': np.diag([1.0, 2, 3]), 'space origin': [1.0, 2, 3]}
+        _, filenames = self.build(data, 3, header)
+        for level, filename in enumerate(filenames, 1):
+            with self.subTest(level=level):
+                values, level_header = pynrrd.read(filename, index_order='C')
+                self.assertEqual(values.dtype, np.float32)
+                np.testing.assert_allclose(values, _block_means(data, 2 ** level, np.mean), rtol=1e-6)
+                np.testing.assert_array_equal(level_header['space directions'], np.diag([1.0, 2, 3]) * 2 ** level)
+
+    def test_components(self):
+        data = np.random.RandomState(1).standard_normal(_SHAPE + (2,)).astype(np.float32)
+        _, filenames = self.build(data, 2)
+        for level, filename in enumerate(filenames, 1):
+            with self.subTest(level=level):
+                np.testing.assert_allclose(pynrrd.read(filename, index_order='C')[0],
+                                           _block_means(data, 2 ** level, lambda block: block.mean(axis=0)),
+                                           rtol=1e-5, atol=1e-6)
+
+    def test_tensors(self):
+        rng = np.random.RandomState(2)
+        tensors = rng.standard_normal(_SHAPE + (3, 3))
+        tensors = np.einsum('...ij,...kj->...ik', tensors, tensors) + 0.1 * np.eye(3)
+        data = tensors.reshape(_SHAPE + (9,)).astype(np.float32)
+
+        # Zero tensors are left out of the averages, a block of zero tensors averages to zero
+        data[:, :2, :2] = 0
+
+        _, filenames = self.build(data, 2, {'kinds': ['3D-matrix', 'domain', 'domain', 'domain']})
+        for level, filename in enumerate(filenames, 1):
+            with self.subTest(level=level):
+                def mean(block):
+                    block = block[block.any(axis=1)]
+                    return _log_euclidean_mean(block.astype(np.float64)) if len(block) else 0
+
+                np.testing.assert_allclose(pynrrd.read(filename, index_order='C')[0],
+                                           _block_means(data, 2 ** level, mean), rtol=1e-4, atol=1e-5)
+
+    def test_pyramid(self):
+        filename, filenames = self.build(np.zeros(_SHAPE, dtype=np.uint8), 2)
+        levels = pyramid.Pyramid(filename, os.path.join(self.directory, 'levels'))
+        self.assertEqual(levels.filenames, [filename] + filenames)
+        self.assertEqual(levels.level(1, 'C').shape, (2, 4, 5))
+        self.assertEqual(levels.level_for(40, 'C').shape, (2, 4, 5))
+        self.assertEqual(levels.level_for(1, 'F').shape, (3, 2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""Tests of oblique slicing against voxel slices of volumes with known affines
+
+    python -m unittest test_reslice
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import pynrrd
+from reslice import ObliqueSlicer, axes_from_normal
+
+# Space directions with negative x and y axes and anisotropic voxels, as rows x, y and z
+_SPACE_DIRECTIONS = np.array([[-1.0, 0, 0], [0, -2.0, 0], [0, 0, 1.5]])
+_SPACE_ORIGIN = np.array([10.0, 20.0, -3.0])
+
+# Measurement frame rotated by 90 degrees around z, its rows are the world space vectors of its axes
+_MEASUREMENT_FRAME = np.array([[0.0, 1, 0], [-1, 0, 0], [0, 0, 1]])
+
+
+class PlaneTest(unittest.TestCase):
+    """Planes along the world axes of a volume in (z, y, x) shape (5, 6, 7)"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def slicer(self, data, kind=None):
+        """Slicer of :obj:`data` in C order written to a NRRD file, with a component axis if :obj:`kind` is given"""
+
+        header = {'encoding': 'raw', 'space': 'left-posterior-superior', 'space origin': _SPACE_ORIGIN}
+        if kind is None:
+            header['space directions'] = _SPACE_DIRECTIONS
+        else:
+            header['space directions'] = np.vstack([np.full(3, np.nan), _SPACE_DIRECTIONS])
+            header['kinds'] = [kind, 'domain', 'domain', 'domain']
+            header['measurement frame'] = _MEASUREMENT_FRAME
+
+        filename = os.path.join(self.directory, 'volume.nrrd')
+        pynrrd.write(filename, data, header, index_order='C')
+        return ObliqueSlicer(filename)
+
+    def voxel_plane(self, slicer, z, thickness=0.0):
+        """Plane along world x and y through the voxel slice z, each pixel at the center of a voxel"""
+
+        center = slicer.to_world([z, 2.5, 3])
+        return slicer.plane(center, [1, 0, 0], [0, 1, 0], (6, 7), spacing=(1, 2), thickness=thickness)
+
+    def test_scalar(self):
+        data = np.random.RandomState(0).standard_normal((5, 6, 7)).astype(np.float32)
+        slicer = self.slicer(data)
+
+        # World x and y run against the voxel x and y axes
+        for z in range(5):
+            np.testing.assert_allclose(self.voxel_plane(slicer, z), data[z, ::-1, ::-1], atol=1e-5)
+
+        # A slab 3 mm thick spans 3 slices along z, sampled at 1.5 mm
+        np.testing.assert_allclose(self.voxel_plane(slicer, 2, thickness=3), data[1:4, ::-1, ::-1].mean(axis=0),
+                                   atol=1e-5)
+
+    def test_tensors(self):
+        rng = np.random.RandomState(1)
+        tensors = rng.standard_normal((5, 6, 7, 3, 3))
+        tensors = (tensors + np.swapaxes(tensors, -1, -2)).astype(np.float32)
+        slicer = self.slicer(tensors.reshape(5, 6, 7, 9), '3D-matrix')
+
+        # The tensors are rotated from the measurement frame to world space
+        world = np.einsum('ji,...jk,kl->...il', _MEASUREMENT_FRAME, tensors, _MEASUREMENT_FRAME)
+        plane = self.voxel_plane(slicer, 3)
+        np.testing.assert_allclose(plane, world[3, ::-1, ::-1].reshape(6, 7, 9), atol=1e-5)
+
+    def test_vectors(self):
+        vectors = np.random.RandomState(2).standard_normal((5, 6, 7, 3)).astype(np.float32)
+        slicer = self.slicer(vectors, '3-vector')
+
+        plane = self.voxel_plane(slicer, 1)
+        np.testing.assert_allclose(plane, np.dot(vectors[1, ::-1, ::-1], _MEASUREMENT_FRAME), atol=1e-5)
+
+        # In the frame of the plane with u along world y and v along world -x, the components are (y, -x, z)
+        center = slicer.to_world([1, 2.5, 3])
+        plane = slicer.plane(center, [0, 1, 0], [-1, 0, 0], (7, 6), spacing=(2, 1), frame='plane')
+        world = np.dot(vectors[1], _MEASUREMENT_FRAME)
+        expected = np.stack([world[..., 1], -world[..., 0], world[..., 2]], axis=-1)
+        np.testing.assert_allclose(plane, np.transpose(expected, (1, 0, 2))[:, ::-1], atol=1e-5)
+
+    def test_outside(self):
+        slicer = self.slicer(np.ones((5, 6, 7), dtype=np.float32))
+        plane = slicer.plane(slicer.to_world([2, 2.5, 3]), [1, 0, 0], [0, 1, 0], (8, 9), spacing=(1, 2), fill=-1)
+
+        # The plane is one pixel larger than the volume on each side
+        self.assertTrue((plane[1:-1, 1:-1] == 1).all())
+        self.assertTrue((plane[[0, -1]] == -1).all() and (plane[:, [0, -1]] == -1).all())
+
+    def test_axes_from_normal(self):
+        for normal in [[0, 0, 1], [1, 2, 3], [0, 0, -2], [1, 0, 0]]:
+            with self.subTest(normal=normal):
+                axis_u, axis_v = axes_from_normal(normal)
+                np.testing.assert_allclose(np.cross(axis_u, axis_v), np.asarray(normal) / np.linalg.norm(normal),
+                                           atol=1e-12)
+                self.assertAlmostEqual(np.dot(axis_u, axis_v), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
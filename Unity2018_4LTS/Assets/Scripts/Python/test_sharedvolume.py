@@ -0,0 +1,98 @@
+"""Tests of volumes published in shared memory and attached by another process
+
+    python -m unittest test_sharedvolume
+"""
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+import numpy as np
+
+import sharedvolume
+
+# Attaches the volume of the descriptor in argv, prints the sum of its array and negates it
+_CONSUMER = '''
+import json, sys
+import sharedvolume
+volume = sharedvolume.SharedVolume.attach(json.loads(sys.argv[1]))
+print(repr(float(volume.array.astype(float).sum())))
+volume.array[...] = -volume.array
+volume.flush()
+volume.close()
+'''
+
+
+class SharedVolumeTest(unittest.TestCase):
+    """Volumes in a file and in a shared memory segment"""
+
+    KINDS = ['file'] + (['shared_memory'] if sharedvolume.shared_memory is not None else [])
+
+    def consume(self, descriptor):
+        """Run the consumer on :obj:`descriptor` in another process, sent as JSON, and return the sum it prints"""
+
+        output = subprocess.check_output([sys.executable, '-c', _CONSUMER, json.dumps(descriptor)],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        return float(output)
+
+    def test_round_trip(self):
+        header = {'space': 'left-posterior-superior', 'space directions': np.array([[np.nan] * 3, [1, 0, 0],
+                                                                                     [0, 2, 0], [0, 0, 3]]),
+                  'kinds': ['3D-matrix', 'domain', 'domain', 'domain'], 'encoding': 'raw'}
+        for kind in self.KINDS:
+            for dtype, index_order in [('>f4', 'C'), ('<i2', 'F'), (np.float16, 'C')]:
+                with self.subTest(kind=kind, dtype=dtype, index_order=index_order):
+                    data = np.arange(2 * 3 * 4 * 9).reshape(2, 3, 4, 9).astype(dtype)
+                    volume = sharedvolume.SharedVolume.allocate(data.shape, data.dtype, header, index_order,
+                                                                use_shared_memory=kind == 'shared_memory')
+                    name = volume.descriptor['name']
+                    self.addCleanup(sharedvolume.release, name)
+
+                    descriptor = json.loads(json.dumps(volume.descriptor))
+                    self.assertEqual(descriptor['kind'], kind)
+                    self.assertEqual(descriptor['dtype'], np.dtype(dtype).newbyteorder('<').str)
+                    self.assertEqual(descriptor['index_order'], index_order)
+                    self.assertEqual(descriptor['header'], {
+                        'space': 'left-posterior-superior', 'kinds': header['kinds'],
+                        'space directions': [[None] * 3, [1, 0, 0], [0, 2, 0], [0, 0, 3]]})
+                    self.assertTrue(volume.array.flags['C_CONTIGUOUS' if index_order == 'C' else 'F_CONTIGUOUS'])
+
+                    volume.array[...] = data
+                    volume.flush()
+                    self.assertEqual(self.consume(descriptor), data.astype(float).sum())
+
+                    # The consumer writes to the same memory
+                    np.testing.assert_array_equal(volume.array, -data)
+
+                    self.assertTrue(sharedvolume.release(name))
+                    self.assertFalse(sharedvolume.release(name))
+                    with self.assertRaises(OSError):
+                        sharedvolume.SharedVolume.attach(descriptor)
+
+    def test_publish(self):
+        data = np.random.RandomState(0).standard_normal((3, 4, 5)).astype('>f8')
+        for kind in self.KINDS:
+            with self.subTest(kind=kind):
+                volume = sharedvolume.SharedVolume.publish(data, use_shared_memory=kind == 'shared_memory')
+                self.addCleanup(sharedvolume.release, volume.descriptor['name'])
+                self.assertEqual(volume.array.dtype, np.dtype('<f8'))
+                np.testing.assert_array_equal(volume.array, data)
+                self.assertAlmostEqual(self.consume(volume.descriptor), data.sum())
+
+    def test_empty(self):
+        volume = sharedvolume.SharedVolume.publish(np.zeros((0, 4), dtype=np.uint8))
+        self.addCleanup(sharedvolume.release, volume.descriptor['name'])
+        self.assertEqual(volume.array.shape, (0, 4))
+        self.assertEqual(self.consume(volume.descriptor), 0)
+
+    def test_release_all(self):
+        names = [sharedvolume.SharedVolume.publish(np.ones(4), use_shared_memory=kind == 'shared_memory')
+                 .descriptor['name'] for kind in self.KINDS]
+        sharedvolume.release_all()
+        for name in names:
+            self.assertFalse(sharedvolume.release(name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+"""Tests of the streamline file and its TrackVis export
+
+    python -m unittest test_streamlines
+"""
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+import streamlines
+
+
+class WriteTrkTest(unittest.TestCase):
+    """Streamlines exported to TrackVis, read back into RAS world space"""
+
+    # World space points of two streamlines
+    POINTS = np.array([[10, -20, 30], [12, -17.5, 33], [14, -15, 36], [11, -19, 31], [13, -18, 39]], dtype=np.float32)
+    OFFSETS = np.array([0, 3, 5])
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def export(self, space, space_directions, space_origin):
+        """Write the streamlines to a streamline file, export it to .trk and return the file and the .trk filename"""
+
+        filename = os.path.join(self.directory, 'fibers.nsl')
+        with streamlines.StreamlineWriter(filename, (8, 9, 10), space_directions, space_origin, space=space) as writer:
+            writer.append(self.POINTS, self.OFFSETS)
+
+        store = streamlines.StreamlineFile(filename)
+        trk_filename = os.path.join(self.directory, 'fibers.trk')
+        streamlines.write_trk(store, trk_filename)
+        return store, trk_filename
+
+    def read_trk(self, filename):
+        """Voxel order of a .trk file and its points in RAS world space, as TrackVis and nibabel compute them"""
+
+        with open(filename, 'rb') as fh:
+            header = streamlines._TRK_HEADER.unpack(fh.read(streamlines._TRK_HEADER.size))
+            voxel_size = np.array(header[4:7])
+            vox_to_ras = np.frombuffer(header[-20], '<f4').reshape(4, 4).astype(float)
+
+            points = []
+            for _ in range(header[-3]):
+                count, = struct.unpack('<i', fh.read(4))
+                points.append(np.frombuffer(fh.read(12 * count), '<f4').reshape(count, 3))
+
+        # The points are in voxel millimeters, where the center of the first voxel is at half a voxel
+        voxels = np.concatenate(points) / voxel_size - 0.5
+        ras = np.dot(voxels, vox_to_ras[:3, :3].T) + vox_to_ras[:3, 3]
+        return header[-18].rstrip(b'\0'), ras
+
+    def check(self, space, space_directions, space_origin, signs, voxel_order):
+        store, filename = self.export(space, np.asarray(space_directions, dtype=float), space_origin)
+        self.assertEqual(store._grid.space, space)
+
+        actual_order, ras = self.read_trk(filename)
+        self.assertEqual(actual_order, voxel_order)
+        np.testing.assert_allclose(ras, self.POINTS * np.array(signs), atol=1e-4)
+
+    def test_lps(self):
+        # Positive directions in LPS point left, posterior and superior, which TrackVis calls LPS
+        self.check('left-posterior-superior', np.diag([2, 2.5, 3]), [10, -20, 30], [-1, -1, 1], b'LPS')
+
+    def test_ras(self):
+        self.check('right-anterior-superior', np.diag([2, 2.5, 3]), [10, -20, 30], [1, 1, 1], b'RAS')
+
+    def test_mixed_signs(self):
+        self.check('left-posterior-superior', np.diag([-2, 2.5, -3]), [10, -20, 30], [-1, -1, 1], b'RPI')
+        self.check('LAS', [[0, 2, 0], [-2.5, 0, 0], [0, 0, 3]], [1, 2, 3], [-1, 1, 1], b'ARS')
+
+    def test_unknown_space_is_ras(self):
+        self.check(None, np.diag([2, 2.5, 3]), [10, -20, 30], [1, 1, 1], b'RAS')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Tests of streamline tractography on synthetic fields
+
+    python -m unittest test_tractography
+"""
+import unittest
+
+import numpy as np
+
+import tractography
+
+
+def _constant_field(fa=0.8):
+    """Field of (z, y, x) shape (4, 12, 5) whose direction is world y everywhere, with 0.5 mm voxels along y"""
+
+    directions = np.zeros((4, 12, 5, 3), dtype=np.float32)
+    directions[..., 1] = 1
+    fa = np.full((4, 12, 5), fa, dtype=np.float32)
+    return tractography.TensorField(directions, fa, np.diag([1, 0.5, 2]), [10, 20, 30])
+
+
+def _curved_field():
+    """Field of directions circling the z axis with a random FA"""
+
+    z, y, x = np.meshgrid(np.arange(6), np.arange(14), np.arange(15), indexing='ij')
+    angle = np.arctan2(y - 6.5, x - 7)
+    directions = np.stack([-np.sin(angle), np.cos(angle), 0.1 * np.ones_like(angle)], axis=-1)
+    directions /= np.linalg.norm(directions, axis=-1, keepdims=True)
+    fa = np.random.RandomState(0).uniform(0.25, 0.9, z.shape)
+    return tractography.TensorField(directions.astype(np.float32), fa.astype(np.float32), np.diag([1.5, 1, 2]),
+                                    [-5, 3, 1])
+
+
+class TrackTest(unittest.TestCase):
+    """Streamlines along a constant direction"""
+
+    def test_constant_direction(self):
+        field = _constant_field()
+        seeds = np.array([[1, 5, 2], [3, 0, 4]], dtype=float)
+        for method in ['euler', 'rk2', 'rk4']:
+            with self.subTest(method=method):
+                points, offsets = tractography.track(field, seeds, step_size=0.5, method=method, world=False)
+
+                # A step of 0.5 mm is one voxel along y, the streamlines run through the whole volume from y = 0
+                np.testing.assert_array_equal(offsets, [0, 12, 24])
+                for number, (z, x) in enumerate([(1, 2), (3, 4)]):
+                    expected = np.stack([np.full(12, z), np.arange(12), np.full(12, x)], axis=1)
+                    np.testing.assert_allclose(points[offsets[number]:offsets[number + 1]], expected, atol=1e-5)
+
+                world_points, world_offsets = tractography.track(field, seeds, step_size=0.5, method=method)
+                np.testing.assert_array_equal(world_offsets, offsets)
+                np.testing.assert_allclose(world_points, field.to_world(points.astype(float)), atol=1e-4)
+                np.testing.assert_allclose(np.diff(world_points[:12], axis=0), [[0, 0.5, 0]] * 11, atol=1e-5)
+
+    def test_stops(self):
+        field = _constant_field()
+        seeds = np.array([[1, 5, 2]], dtype=float)
+
+        # The FA drops below the threshold from y = 8
+        field.fa[:, 8:] = 0.1
+        points, offsets = tractography.track(field, seeds, world=False)
+        np.testing.assert_allclose(points[:, 1], np.arange(8))
+
+        points, offsets = tractography.track(field, seeds, max_steps=2, world=False)
+        np.testing.assert_allclose(points[:, 1], np.arange(3, 8))
+
+        # A seed below the threshold can't be traced and has only 1 point
+        points, offsets = tractography.track(field, np.array([[1, 9, 2]], dtype=float), world=False)
+        np.testing.assert_array_equal(offsets, [0])
+        points, offsets = tractography.track(field, np.array([[1, 9, 2]], dtype=float), min_points=1, world=False)
+        np.testing.assert_array_equal(offsets, [0, 1])
+
+    def test_invalid_method(self):
+        with self.assertRaises(ValueError):
+            tractography.track(_constant_field(), np.zeros((1, 3)), method='rk3')
+
+
+class TrackParallelTest(unittest.TestCase):
+    """Streamlines traced on a pool of processes"""
+
+    def test_same_output_for_any_number_of_processes(self):
+        field = _curved_field()
+        mask = field.fa >= 0.3
+        options = dict(step_size=0.7, method='rk4', max_angle=60)
+
+        outputs = []
+        for processes in [1, 3]:
+            points, offsets = tractography.concatenate(tractography.track_parallel(
+                field, mask, per_voxel=2, seed=5, processes=processes, block_size=97, **options))
+            outputs.append((points.tobytes(), offsets.tobytes()))
+
+        self.assertGreater(len(offsets), 100)
+        self.assertEqual(outputs[0], outputs[1])
+
+        # The seeds depend on the seed of the run
+        points, _ = tractography.concatenate(tractography.track_parallel(
+            field, mask, per_voxel=2, seed=6, processes=1, block_size=97, **options))
+        self.assertNotEqual(points.tobytes(), outputs[0][0])
+
+    def test_block_seeds(self):
+        voxels = np.argwhere(np.ones((2, 3, 4), dtype=bool))
+        np.testing.assert_array_equal(tractography.block_seeds(voxels, 7), voxels)
+
+        seeds = tractography.block_seeds(voxels, 7, per_voxel=3, seed=1)
+        np.testing.assert_array_equal(seeds, tractography.block_seeds(voxels, 7, per_voxel=3, seed=1))
+        self.assertLessEqual(np.abs(seeds - np.repeat(voxels, 3, axis=0)).max(), 0.5)
+        self.assertFalse(np.array_equal(seeds, tractography.block_seeds(voxels, 8, per_voxel=3, seed=1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
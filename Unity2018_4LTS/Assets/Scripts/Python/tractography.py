@@ -0,0 +1,461 @@
+"""Streamline tractography on the principal eigenvector field of a DTI tensor field
+
+All seeds are traced together: each step advances every streamline that is still running as one batch of numpy arrays
+and drops the ones that stopped. The principal eigenvectors are interpolated trilinearly, with the eigenvectors at the
+8 corners flipped to the side of the current direction since their sign is arbitrary, and the streamlines are
+integrated with Euler, RK2 (midpoint) or RK4 steps. A streamline stops when it leaves the volume, when the FA drops
+below a threshold or when it would turn by more than a maximum angle in one step. Each seed is traced in both
+directions.
+
+Positions in the volume are voxel coordinates in C order, (z, y, x) like the arrays read with index_order='C'. The
+directions, step size and angles are in world space, given by the space directions, space origin and measurement frame
+of the header, so anisotropic voxels are handled.
+
+The streamlines are returned packed: the points of all streamlines in one (N, 3) float32 array and the offsets of the
+streamlines in it, streamline i being points[offsets[i]:offsets[i + 1]].
+
+Whole-brain tracking is spread over processes by :func:`track_parallel`, with the field in shared memory.
+
+The streamlines are written batch by batch to a streamline file, see :mod:`streamlines`.
+
+    python tractography.py DTIBrain.nrrd --output fibers.nsl --processes 8
+"""
+import argparse
+import multiprocessing
+import os
+
+import numpy as np
+
+import dti
+import sharedvolume
+import streamlines
+from pynrrd import read
+
+# Corner offsets of the 8 voxels around a position, for trilinear interpolation
+_CORNERS = np.array([[z, y, x] for z in (0, 1) for y in (0, 1) for x in (0, 1)])
+
+_METHODS = ['euler', 'rk2', 'rk4']
+
+# Number of seed voxels in a block, the unit of work of track_parallel
+_BLOCK_VOXELS = 1024
+
+# Field of a worker process of track_parallel and the shared volumes it is mapped from, set by _init_worker
+_worker_field = None
+_worker_volumes = None
+
+
+class TensorField(object):
+    """Principal eigenvector and FA field of a tensor field, in world space
+
+    Parameters
+    ----------
+    directions : :class:`numpy.ndarray`
+        (z, y, x, 3) principal eigenvectors in world space as (x, y, z) vectors
+    fa : :class:`numpy.ndarray`
+        (z, y, x) fractional anisotropy
+    space_directions : :class:`numpy.ndarray`, optional
+        3x3 matrix whose rows are the world space vectors of the x, y and z voxel axes, like the 'space directions'
+        field without the tensor axis. Defaults to the identity
+    space_origin : :class:`numpy.ndarray`, optional
+        World space position of voxel (0, 0, 0). Defaults to the origin
+    space : :class:`str`, optional
+        NRRD 'space' of the world space, kept for the streamline files of the field
+    """
+
+    def __init__(self, directions, fa, space_directions=None, space_origin=None, space=None):
+        if min(fa.shape) < 2:
+            raise ValueError('Tracking needs at least 2 voxels along each axis, got a volume of %s' % (fa.shape,))
+
+        self.directions = directions
+        self.fa = fa
+        self.space_directions = np.eye(3) if space_directions is None else np.asarray(space_directions, dtype=float)
+        self.space_origin = np.zeros(3) if space_origin is None else np.asarray(space_origin, dtype=float)
+        self.space = space
+
+        # Maps a world space vector to the voxel coordinates in C order it moves by
+        self._to_voxels = np.linalg.inv(self.space_directions.T)[::-1].T
+        self._upper = np.array(fa.shape, dtype=float) - 1
+
+    @classmethod
+    def from_tensors(cls, data, header=None):
+        """Compute the field from the tensor field :obj:`data` read with index_order='C' and its header"""
+
+        maps = dti.eigen_maps(data)
+        header = header if header is not None else {}
+
+        # The eigenvectors are in the measurement frame, whose rows are the world space vectors of its axes
+        directions = maps['evec']
+        if 'measurement frame' in header:
+            directions = np.dot(directions, header['measurement frame']).astype(np.float32)
+
+        space_directions = header.get('space directions')
+        if space_directions is not None:
+            space_directions = space_directions[~np.isnan(space_directions).any(axis=1)]
+
+        return cls(directions, maps['fa'], space_directions, header.get('space origin'), header.get('space'))
+
+    @classmethod
+    def from_file(cls, filename):
+        """Compute the field of the tensor field in NRRD file :obj:`filename`"""
+
+        data, header = read(filename, index_order='C')
+        return cls.from_tensors(data, header)
+
+    def to_world(self, positions):
+        """World space positions of voxel coordinates in C order"""
+
+        return np.dot(positions[:, ::-1], self.space_directions) + self.space_origin
+
+    def to_voxels(self, points):
+        """Voxel coordinates in C order of world space positions"""
+
+        return np.dot(points - self.space_origin, np.linalg.inv(self.space_directions))[:, ::-1]
+
+    def inside(self, positions):
+        """Whether the positions are inside the volume"""
+
+        return ((positions >= 0) & (positions <= self._upper)).all(axis=1)
+
+    def _corners(self, positions):
+        """Indices of the 8 voxels around each position and their trilinear interpolation weights"""
+
+        base = np.clip(np.floor(positions), 0, self._upper - 1).astype(np.intp)
+        fraction = positions - base
+        indices = base[:, None, :] + _CORNERS
+        weights = np.where(_CORNERS, fraction[:, None, :], 1 - fraction[:, None, :]).prod(axis=2)
+        return (indices[..., 0], indices[..., 1], indices[..., 2]), weights
+
+    def fa_at(self, positions):
+        """FA at the positions, interpolated trilinearly"""
+
+        indices, weights = self._corners(positions)
+        return (self.fa[indices] * weights).sum(axis=1)
+
+    def direction_at(self, positions, reference=None):
+        """Unit principal direction at the positions, interpolated trilinearly on the side of :obj:`reference`
+
+        Without :obj:`reference` the direction of the nearest voxel is returned. Directions that are zero, e.g. outside
+        the brain, stay zero.
+        """
+
+        if reference is None:
+            nearest = np.clip(np.rint(positions), 0, self._upper).astype(np.intp)
+            direction = self.directions[nearest[:, 0], nearest[:, 1], nearest[:, 2]].astype(float)
+        else:
+            indices, weights = self._corners(positions)
+            corners = self.directions[indices]
+            signs = np.where(np.einsum('ijk,ik->ij', corners, reference) < 0, -weights, weights)
+            direction = np.einsum('ijk,ij->ik', corners, signs)
+
+        norm = np.linalg.norm(direction, axis=1, keepdims=True)
+        return np.divide(direction, norm, out=np.zeros_like(direction), where=norm > 0)
+
+    def _step(self, positions, previous, step_size, method):
+        """Take one step of :obj:`step_size` from the positions, returning the new positions and step directions"""
+
+        def move(by, direction):
+            return positions + by * np.dot(direction, self._to_voxels)
+
+        k1 = self.direction_at(positions, previous)
+        if method == 'euler':
+            direction = k1
+        elif method == 'rk2':
+            direction = self.direction_at(move(step_size / 2, k1), k1)
+        else:
+            k2 = self.direction_at(move(step_size / 2, k1), k1)
+            k3 = self.direction_at(move(step_size / 2, k2), k1)
+            k4 = self.direction_at(move(step_size, k3), k1)
+            direction = k1 + 2 * k2 + 2 * k3 + k4
+            norm = np.linalg.norm(direction, axis=1, keepdims=True)
+            direction = np.divide(direction, norm, out=np.zeros_like(direction), where=norm > 0)
+
+        return move(step_size, direction), direction
+
+
+def _integrate(field, positions, directions, step_size, method, fa_threshold, min_cosine, max_steps):
+    """Trace streamlines from the positions in the directions
+
+    Returns a list with the ids (indices into :obj:`positions`) and new positions of the streamlines still running
+    after each step.
+    """
+
+    ids = np.arange(len(positions))
+    running = (field.inside(positions) & (field.fa_at(positions) >= fa_threshold) &
+               (np.abs(directions).sum(axis=1) > 0))
+    ids, positions, directions = ids[running], positions[running], directions[running]
+
+    steps = []
+    for _ in range(max_steps):
+        if not len(ids):
+            break
+
+        new_positions, new_directions = field._step(positions, directions, step_size, method)
+
+        # A zero direction has a cosine of 0 with the previous one, so it stops the streamline too
+        inside = field.inside(new_positions)
+        running = inside & (np.einsum('ij,ij->i', new_directions, directions) >= min_cosine)
+        running[inside] &= field.fa_at(new_positions[inside]) >= fa_threshold
+
+        ids, positions, directions = ids[running], new_positions[running], new_directions[running]
+        steps.append((ids, positions))
+
+    return steps
+
+
+def track(field, seeds, step_size=0.5, method='rk2', fa_threshold=0.15, max_angle=45.0, max_steps=1000,
+          min_points=2, world=True):
+    """Trace a streamline from each seed in both directions
+
+    Parameters
+    ----------
+    field : :class:`TensorField`
+        Field to trace
+    seeds : :class:`numpy.ndarray`
+        (N, 3) seed positions in voxel coordinates in C order
+    step_size : :class:`float`, optional
+        Length of a step in world space units (mm)
+    method : {'euler', 'rk2', 'rk4'}, optional
+        Integration method
+    fa_threshold : :class:`float`, optional
+        Streamlines stop where the FA is below this
+    max_angle : :class:`float`, optional
+        Streamlines stop before turning by more than this many degrees in one step
+    max_steps : :class:`int`, optional
+        Maximum number of steps in each direction
+    min_points : :class:`int`, optional
+        Streamlines with fewer points are left out, a seed that can't be traced has 1 point
+    world : :class:`bool`, optional
+        Return the points in world space (x, y, z) instead of voxel coordinates in C order
+
+    Returns
+    -------
+    points : :class:`numpy.ndarray`
+        (M, 3) float32 points of all streamlines, each streamline running from its backward end through its seed to
+        its forward end
+    offsets : :class:`numpy.ndarray`
+        int64 offsets of the streamlines in :obj:`points`, one more than there are streamlines. Streamlines are in the
+        order of their seeds
+    """
+
+    if method not in _METHODS:
+        raise ValueError('Unknown method %r, expected one of %s' % (method, ', '.join(_METHODS)))
+
+    seeds = np.asarray(seeds, dtype=float).reshape(-1, 3)
+    count = len(seeds)
+    initial = field.direction_at(seeds)
+    min_cosine = np.cos(np.radians(max_angle))
+
+    forward = _integrate(field, seeds, initial, step_size, method, fa_threshold, min_cosine, max_steps)
+    backward = _integrate(field, seeds, -initial, step_size, method, fa_threshold, min_cosine, max_steps)
+
+    # The ids still running after a step are a subset of those after the previous one, so the step count of each
+    # streamline is the number of steps its id is in
+    forward_counts = np.bincount(np.concatenate([ids for ids, _ in forward] + [np.zeros(0, int)]), minlength=count)
+    backward_counts = np.bincount(np.concatenate([ids for ids, _ in backward] + [np.zeros(0, int)]), minlength=count)
+    lengths = backward_counts + 1 + forward_counts
+
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    seed_offsets = offsets[:-1] + backward_counts
+
+    points = np.empty((offsets[-1], 3), dtype=float)
+    points[seed_offsets] = seeds
+    for step, (ids, positions) in enumerate(forward, 1):
+        points[seed_offsets[ids] + step] = positions
+    for step, (ids, positions) in enumerate(backward, 1):
+        points[seed_offsets[ids] - step] = positions
+
+    keep = lengths >= min_points
+    if not keep.all():
+        points = points[np.repeat(keep, lengths)]
+        lengths = lengths[keep]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+    if world:
+        points = field.to_world(points)
+
+    return points.astype(np.float32), offsets
+
+
+def seeds_from_mask(mask, per_voxel=1, rng=None):
+    """Seed positions in the voxels of a mask
+
+    Parameters
+    ----------
+    mask : :class:`numpy.ndarray`
+        Boolean (z, y, x) mask of the voxels to seed, e.g. ``field.fa > 0.3``
+    per_voxel : :class:`int`, optional
+        Number of seeds per voxel. One seed is at the center of the voxel, more are spread uniformly over it
+    rng : :class:`numpy.random.RandomState`, optional
+        Random state for spreading the seeds
+
+    Returns
+    -------
+    seeds : :class:`numpy.ndarray`
+        (N, 3) seed positions in voxel coordinates in C order
+    """
+
+    centers = np.argwhere(mask).astype(float)
+    if per_voxel == 1:
+        return centers
+
+    rng = rng if rng is not None else np.random.RandomState()
+    seeds = np.repeat(centers, per_voxel, axis=0)
+    return seeds + rng.uniform(-0.5, 0.5, seeds.shape)
+
+
+def block_seeds(voxels, block_index, per_voxel=1, seed=0):
+    """Seed positions in a block of voxels
+
+    Like :func:`seeds_from_mask`, but the seeds are spread with a random state made from :obj:`seed` and
+    :obj:`block_index`, so they only depend on the block and not on the process that computes them.
+
+    Parameters
+    ----------
+    voxels : :class:`numpy.ndarray`
+        (N, 3) integer voxel coordinates in C order of the block
+    block_index : :class:`int`
+        Index of the block
+    per_voxel : :class:`int`, optional
+        Number of seeds per voxel
+    seed : :class:`int`, optional
+        Random seed of the run
+
+    Returns
+    -------
+    seeds : :class:`numpy.ndarray`
+        (N * per_voxel, 3) seed positions in voxel coordinates in C order
+    """
+
+    centers = voxels.astype(float)
+    if per_voxel == 1:
+        return centers
+
+    seeds = np.repeat(centers, per_voxel, axis=0)
+    return seeds + np.random.RandomState([seed, block_index]).uniform(-0.5, 0.5, seeds.shape)
+
+
+def _init_worker(directions, fa, space_directions, space_origin):
+    """Map the field of track_parallel from shared memory in a worker process"""
+
+    global _worker_field, _worker_volumes
+    _worker_volumes = (sharedvolume.SharedVolume.attach(directions), sharedvolume.SharedVolume.attach(fa))
+    _worker_field = TensorField(_worker_volumes[0].array, _worker_volumes[1].array, space_directions, space_origin)
+
+
+def _track_block(task, field=None):
+    """Track the seeds of a block of track_parallel, on the field of the worker process if :obj:`field` is None"""
+
+    block_index, voxels, per_voxel, seed, options = task
+    return track(field if field is not None else _worker_field, block_seeds(voxels, block_index, per_voxel, seed),
+                 **options)
+
+
+def track_parallel(field, mask, per_voxel=1, seed=0, processes=None, block_size=_BLOCK_VOXELS, **options):
+    """Trace streamlines from seeds in every voxel of a mask on a pool of processes
+
+    The voxels of the mask are split into blocks of :obj:`block_size` voxels, which are tracked by the processes as
+    they become free. The directions and FA of :obj:`field` are published in shared memory once with
+    :class:`sharedvolume.SharedVolume` and mapped by every process. The output is the same for any number of
+    processes: the seeds of a block are spread by :func:`block_seeds` and the batches come in the order of the blocks.
+
+    Parameters
+    ----------
+    field : :class:`TensorField`
+        Field to trace
+    mask : :class:`numpy.ndarray`
+        Boolean (z, y, x) mask of the voxels to seed
+    per_voxel : :class:`int`, optional
+        Number of seeds per voxel
+    seed : :class:`int`, optional
+        Random seed for spreading the seeds
+    processes : :class:`int`, optional
+        Number of processes, defaults to the number of CPUs. With 1 the blocks are tracked in this process
+    block_size : :class:`int`, optional
+        Number of voxels in a block
+    options
+        Options of :func:`track`
+
+    Yields
+    ------
+    points, offsets : :class:`numpy.ndarray`
+        Streamlines of each block, see :func:`track`
+    """
+
+    voxels = np.argwhere(mask)
+    tasks = ((index, voxels[start:start + block_size], per_voxel, seed, options)
+             for index, start in enumerate(range(0, len(voxels), block_size)))
+
+    if processes == 1:
+        for task in tasks:
+            yield _track_block(task, field)
+        return
+
+    directions = sharedvolume.SharedVolume.publish(field.directions)
+    try:
+        fa = sharedvolume.SharedVolume.publish(field.fa)
+        try:
+            initargs = (directions.descriptor, fa.descriptor, field.space_directions, field.space_origin)
+            with multiprocessing.Pool(processes, _init_worker, initargs) as pool:
+                for batch in pool.imap(_track_block, tasks):
+                    yield batch
+        finally:
+            sharedvolume.release(fa.descriptor['name'])
+    finally:
+        sharedvolume.release(directions.descriptor['name'])
+
+
+def concatenate(batches):
+    """Concatenate batches of packed streamlines into one, see :func:`track`"""
+
+    points, offsets = [], [np.zeros(1, dtype=np.int64)]
+    for batch_points, batch_offsets in batches:
+        points.append(batch_points)
+        offsets.append(batch_offsets[1:] + offsets[-1][-1])
+
+    return (np.concatenate(points) if points else np.zeros((0, 3), dtype=np.float32)), np.concatenate(offsets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Trace streamlines through a NRRD tensor field, seeded in every '
+                                                 'voxel with at least the seed FA')
+    parser.add_argument('path', help='path to the nrrd file')
+    parser.add_argument('--output', default='fibers.nsl', help='streamline file to write the streamlines to')
+    parser.add_argument('--export', help='also export the streamlines to a .trk or .tck file')
+    parser.add_argument('--seed-fa', type=float, default=0.3, help='minimum FA of the seed voxels (default: 0.3)')
+    parser.add_argument('--seeds-per-voxel', type=int, default=1, help='number of seeds per voxel (default: 1)')
+    parser.add_argument('--step', type=float, default=0.5, help='step size in mm (default: 0.5)')
+    parser.add_argument('--method', choices=_METHODS, default='rk2', help='integration method (default: rk2)')
+    parser.add_argument('--fa-threshold', type=float, default=0.15, help='FA to stop at (default: 0.15)')
+    parser.add_argument('--max-angle', type=float, default=45.0, help='maximum angle per step (default: 45)')
+    parser.add_argument('--max-steps', type=int, default=1000, help='maximum steps in each direction (default: 1000)')
+    parser.add_argument('--voxels', action='store_true', help='save voxel coordinates instead of world coordinates')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for spreading the seeds (default: 0)')
+    parser.add_argument('--processes', type=int, help='number of tracking processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    export = {'.trk': streamlines.write_trk, '.tck': streamlines.write_tck}
+    if args.export and os.path.splitext(args.export)[1].lower() not in export:
+        parser.error('can only export to .trk or .tck files')
+
+    field = TensorField.from_file(args.path)
+    batches = track_parallel(field, field.fa >= args.seed_fa, args.seeds_per_voxel, args.seed, args.processes,
+                             step_size=args.step, method=args.method, fa_threshold=args.fa_threshold,
+                             max_angle=args.max_angle, max_steps=args.max_steps, world=not args.voxels)
+    with streamlines.StreamlineWriter(args.output, field.fa.shape, field.space_directions, field.space_origin,
+                                      world=not args.voxels, space=field.space) as writer:
+        for points, offsets in batches:
+            writer.append(points, offsets)
+
+    store = streamlines.StreamlineFile(args.output)
+    print('traced %d streamlines with %d points to %s' % (len(store), len(store.points), args.output))
+
+    if args.export:
+        export[os.path.splitext(args.export)[1].lower()](store, args.export)
+        print('exported to %s' % args.export)
+    return 0
+
+
+if __name__ == '__main__':
+    main()